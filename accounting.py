@@ -0,0 +1,223 @@
+# accounting.py
+# -------------------------------------------------------------
+# Request-scoped accounting of LLM and embedding calls.
+#   with ledger(user_id, "chat") as led:   # one chat request / ingest job
+#       ...                                # every generate / embed call
+#   led.summary()                          # → calls, tokens, bytes, seconds
+#
+# Calls are recorded by llm_providers (every generate, incl. image
+# parts), utils._embed (backend calls, not cache hits) and a LangChain
+# callback for the Gemini chat model, under the innermost
+# metrics.span / QueryPlan node name ("query.answer", "ingest.summarize")
+# so the breakdown shows which path costs what.
+# The ledger lives in a ContextVar; QueryPlan and the ingest threads run
+# in copies of the caller's context, so their calls land in it too.
+# Closed ledgers are added to the per-user, per-day `usage` table in
+# users.db; USER_DAILY_TOKENS (0 = off) caps a user's tokens per day.
+# -------------------------------------------------------------
+from __future__ import annotations
+import contextvars
+import datetime
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+from logging_config import logger
+from metrics import Counter, current_stage
+
+IMAGE_TOKENS = 258                     # Gemini bills an image part as 258 tokens
+
+LLM_TOKENS = Counter("rag_llm_tokens_total", "Tokens by call kind, stage and direction",
+                     ("kind", "stage", "direction"))
+LLM_CALLS  = Counter("rag_llm_calls_total", "Generate / embed calls by kind and stage",
+                     ("kind", "stage"))
+
+
+class QuotaExceeded(Exception):
+    """The user has used up their daily token allowance."""
+
+
+@dataclass
+class Usage:
+    calls: int = 0
+    in_tokens: int = 0
+    out_tokens: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+    def add(self, other: "Usage") -> None:
+        self.calls      += other.calls
+        self.in_tokens  += other.in_tokens
+        self.out_tokens += other.out_tokens
+        self.bytes      += other.bytes
+        self.seconds    += other.seconds
+
+
+class Ledger:
+    """Usage of one request, keyed by (kind, stage); safe across threads."""
+
+    def __init__(self, user_id: int | None, label: str):
+        self.user_id = user_id
+        self.label   = label
+        self.by: Dict[Tuple[str, str], Usage] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, stage: str, usage: Usage) -> None:
+        with self._lock:
+            self.by.setdefault((kind, stage), Usage()).add(usage)
+
+    def totals(self) -> Dict[str, Usage]:
+        out: Dict[str, Usage] = {}
+        with self._lock:
+            for (kind, _), u in self.by.items():
+                out.setdefault(kind, Usage()).add(u)
+        return out
+
+    def summary(self) -> Dict:
+        with self._lock:
+            stages = {f"{k}:{s}": asdict(u) for (k, s), u in self.by.items()}
+        return {"totals": {k: asdict(u) for k, u in self.totals().items()}, "stages": stages}
+
+
+_LEDGER: contextvars.ContextVar[Ledger | None] = contextvars.ContextVar("ledger", default=None)
+
+
+# ─────────────────── token / byte estimates ─────────────────────
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+def prompt_size(prompt) -> Tuple[int, int]:
+    """(estimated tokens, bytes) of a str or Gemini-style parts list."""
+    parts = prompt if isinstance(prompt, list) else [prompt]
+    tokens = size = 0
+    for p in parts:
+        if isinstance(p, dict):                         # {"mime_type", "data"} image part
+            tokens += IMAGE_TOKENS
+            size   += len(p.get("data") or b"")
+        else:
+            s = str(p)
+            tokens += estimate_tokens(s)
+            size   += len(s.encode("utf-8"))
+    return tokens, size
+
+
+# ─────────────────── recording ──────────────────────────────────
+def record(kind: str, calls: int = 1, in_tokens: int = 0, out_tokens: int = 0,
+           nbytes: int = 0, seconds: float = 0.0) -> None:
+    """Attribute one call to the current stage and the active ledger (if any)."""
+    stage = current_stage() or "other"
+    LLM_CALLS.inc(calls, kind=kind, stage=stage)
+    LLM_TOKENS.inc(in_tokens, kind=kind, stage=stage, direction="in")
+    LLM_TOKENS.inc(out_tokens, kind=kind, stage=stage, direction="out")
+    led = _LEDGER.get()
+    if led is not None:
+        led.add(kind, stage, Usage(calls, in_tokens, out_tokens, nbytes, seconds))
+
+
+def record_llm(prompt, text: str, seconds: float,
+               in_tokens: int | None = None, out_tokens: int | None = None) -> None:
+    """One generate call; provider-reported token counts win over estimates."""
+    est_in, nbytes = prompt_size(prompt)
+    record("llm", 1,
+           est_in if in_tokens is None else in_tokens,
+           estimate_tokens(text) if out_tokens is None else out_tokens,
+           nbytes, seconds)
+
+
+def current_ledger() -> Ledger | None:
+    return _LEDGER.get()
+
+
+@contextmanager
+def ledger(user_id: int | None, label: str) -> Iterator[Ledger]:
+    """Collect every call made inside the block; persist the totals on exit."""
+    led = Ledger(user_id, label)
+    token = _LEDGER.set(led)
+    try:
+        yield led
+    finally:
+        _LEDGER.reset(token)
+        if user_id is not None and led.by:
+            try:
+                USAGE.add(user_id, led.totals())
+            except sqlite3.Error as e:              # accounting must not fail the request
+                logger.warning(f"usage not recorded for user {user_id}: {e}")
+        if led.by:
+            logger.debug(f"usage {label} user={user_id}: {led.summary()['totals']}")
+
+
+# ─────────────────── persistence ────────────────────────────────
+class UsageStore:
+    """Per-user, per-day totals in the `usage` table of users.db."""
+
+    def __init__(self, path: Path, daily_tokens: int = 0):
+        self.path   = Path(path)
+        self.daily_tokens = daily_tokens
+        self._local = threading.local()          # one sqlite connection per thread
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS usage (
+                user_id    INTEGER,
+                day        TEXT,     -- UTC, YYYY-MM-DD
+                kind       TEXT,     -- 'llm' | 'embed'
+                calls      INTEGER,
+                in_tokens  INTEGER,
+                out_tokens INTEGER,
+                bytes      INTEGER,
+                seconds    REAL,
+                PRIMARY KEY (user_id, day, kind)
+              )
+            """)
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+    def add(self, user_id: int, totals: Dict[str, Usage]) -> None:
+        db = self._db()
+        with db:
+            for kind, u in totals.items():
+                db.execute("""
+                  INSERT INTO usage (user_id, day, kind, calls, in_tokens, out_tokens, bytes, seconds)
+                  VALUES (?,?,?,?,?,?,?,?)
+                  ON CONFLICT(user_id, day, kind) DO UPDATE SET
+                    calls=calls+excluded.calls, in_tokens=in_tokens+excluded.in_tokens,
+                    out_tokens=out_tokens+excluded.out_tokens, bytes=bytes+excluded.bytes,
+                    seconds=seconds+excluded.seconds
+                """, (user_id, self._today(), kind, u.calls, u.in_tokens, u.out_tokens,
+                      u.bytes, u.seconds))
+
+    def for_user(self, user_id: int, day: str | None = None) -> Dict[str, Dict]:
+        """{kind: totals} for one day (default today), or all time with day='*'."""
+        day = day or self._today()
+        where, args = ("user_id=?", (user_id,)) if day == "*" else ("user_id=? AND day=?", (user_id, day))
+        rows = self._db().execute(
+            f"SELECT kind, SUM(calls), SUM(in_tokens), SUM(out_tokens), SUM(bytes), SUM(seconds) "
+            f"FROM usage WHERE {where} GROUP BY kind", args).fetchall()
+        return {r[0]: asdict(Usage(r[1], r[2], r[3], r[4], round(r[5], 3))) for r in rows}
+
+    def check_quota(self, user_id: int | None) -> None:
+        """Raise QuotaExceeded once today's in + out tokens reach the limit."""
+        if not self.daily_tokens or user_id is None:
+            return
+        used = sum(u["in_tokens"] + u["out_tokens"] for u in self.for_user(user_id).values())
+        if used >= self.daily_tokens:
+            raise QuotaExceeded(f"daily token quota of {self.daily_tokens} reached ({used} used)")
+
+
+USAGE = UsageStore(
+    Path(os.getenv("USAGE_DB_PATH", Path(__file__).parent / "users.db")),
+    daily_tokens=int(os.getenv("USER_DAILY_TOKENS", "0")),
+)
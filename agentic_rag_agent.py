@@ -1,13 +1,10 @@
 
 from __future__ import annotations
-import os
 import functools
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.agents import initialize_agent, AgentType
-import google.generativeai as genai
 from tools_registry import build_tools
+from llm_providers import get_chat_model
 from dotenv import load_dotenv
-import os
 from logging_config import logger
 from langchain.callbacks.base import BaseCallbackHandler
 
@@ -21,21 +18,9 @@ class StepLogger(BaseCallbackHandler):
 
 load_dotenv()
 
-# ─────────────────── API keys & model names ────────────────────
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")      # ← Set your own Gemini API key here
-MODEL_GEN      = "models/gemini-1.5-flash-latest"
-if not GEMINI_API_KEY:
-    raise RuntimeError("Set GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
-
-
 # ---- 1) Build tool set for the single-user demo -----------------------
-_llm = ChatGoogleGenerativeAI(
-    model="models/gemini-1.5-flash",
-    temperature=0,
-    google_api_key=os.getenv("GEMINI_API_KEY"), 
-    callbacks=[StepLogger()],
-)
+# provider (Gemini or the HTTP stub) is picked in llm_providers.py
+_llm = get_chat_model("models/gemini-1.5-flash", temperature=0, callbacks=[StepLogger()])
 
 SYSTEM_PREFIX = """
 You are an agent for a Retrieval-Augmented-Generation system with the following tools:
@@ -47,7 +32,7 @@ You are an agent for a Retrieval-Augmented-Generation system with the following
 • code_writer, python_repl – programming tools (use if question explicitly needs code)
 
 Protocol:
-1. Call retrieve_rag first.
+1. Call retrieve_rag first (unless the question says it already returned NO_RESULTS).
 2. If it returns 'NO_RESULTS', then call search_web.
 3. If retrieve_rag returns >1 candidate papers, ask the user to choose.
 4. When you have the final answer, respond in markdown.
@@ -2,17 +2,22 @@
 import faulthandler
 faulthandler.enable()      # prints traceback even inside threads
 
-import os, uuid, datetime, markdown2
+import os, uuid, datetime, json, markdown2
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 import threading, secrets
 import sqlite3, hashlib, secrets
 import re
+import time
 from config import ALL_DOMAINS
 from agentic_rag_agent import get_agent
+from rag_scipdf_core import NO_RESULTS, smart_query, smart_query_stream
+from ingest_jobs import queue_from_env
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Histogram, span
+from accounting import USAGE, QuotaExceeded, ledger
 from flask import (
     Flask, request, jsonify, render_template,
-    send_from_directory ,redirect, url_for,abort
+    send_from_directory ,redirect, url_for,abort, g, Response
     )
 
 # ---------- your RAG core (imported) ---------------------------
@@ -30,10 +35,26 @@ SESSION_COOKIE_KEY = "sid"
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
 
+# ---------- request metrics (GET /metrics) -----------------------
+HTTP_SECONDS = Histogram("http_request_seconds", "Flask request wall time",
+                         ("endpoint", "method", "status"))
+
+@app.before_request
+def _start_timer():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    t0 = g.pop("t0", None)
+    if t0 is not None:
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        HTTP_SECONDS.observe(time.perf_counter() - t0, endpoint=rule,
+                             method=request.method, status=response.status_code)
+    return response
+
 # ---------- in-memory session store ------------------------------
 # { session_id : [ {role, html, ts}, ... ] }
 CHAT_LOGS = {}
-INGEST_TASKS = {}
 
 
 # ---------------- helper -----------------------------------------j
@@ -66,18 +87,64 @@ TABLE_DIRS = {cfg.object_store_dirs["table"].resolve()
 
 MEDIA_TOKEN_RE = re.compile(r"<<(img|tbl):([0-9A-Fa-f]{8}|[0-9A-Fa-f\-]{32,36})>>")
 
-def _run_rag(prompt: str) -> Tuple[str, List[Tuple[str, str]]]:
+# ---------- chat routing ------------------------------------------
+# Plain questions go straight to smart_query: the agent would only spend
+# one or two Gemini round trips deciding to call retrieve_rag (its
+# mandatory first, return_direct tool) anyway. The agent runs when the
+# question asks for its other tools or when retrieval finds nothing.
+CHAT_FAST_PATH = os.getenv("CHAT_FAST_PATH", "1") != "0"
+AGENT_INTENT_RE = re.compile(
+    r"```"
+    r"|\b(write|generate|implement)\b.{0,40}\b(code|script|snippet)s?\b"
+    r"|\b(write|implement)\b.{0,40}\bin (python|bash|sql|javascript|java|c\+\+|rust|r)\b"
+    r"|\bgive me (some |the )?code\b"
+    r"|\b(python|bash|sql|javascript|r)\s+(code|script|snippet|function)s?\b"
+    r"|\b(search|look up|google|browse)\b.{0,30}\b(web|internet|online)\b"
+    r"|\b(on the web|web search|latest news|news about)\b"
+    r"|\b(ingest|classify|upload)\b.{0,40}\b(pdf|document|file|paper)\b"
+    r"|\.pdf\b",
+    re.I,
+)
+RAG_TRIED_NOTE = "\n\n(retrieve_rag was already called for this question and returned NO_RESULTS.)"
+NO_RESULTS_ANSWER = "I couldn't find anything about this in your papers."
+CHAT_ROUTES = Counter("rag_chat_route_total", "Chats by route: fast (smart_query only), "
+                      "agent (tool intent), fallback (agent after NO_RESULTS)", ("route",))
+
+
+def _route(prompt: str) -> str:
+    """Return "rag" for a plain retrieval question, "agent" when it needs code / web / ingest tools."""
+    if not CHAT_FAST_PATH or AGENT_INTENT_RE.search(prompt):
+        return "agent"
+    return "rag"
+
+
+def _run_rag(prompt: str, uid: int | None, rag_tried: bool = False) -> Tuple[str, List[Tuple[str, str]]]:
     """
-    Pure agent wrapper — no direct smart_query.
+    Answer one chat message: smart_query first for plain questions, the
+    user-scoped agent for tool requests or when retrieval returns
+    NO_RESULTS (`rag_tried`: the caller already got NO_RESULTS).
 
     Returns
     -------
     html_answer : safe HTML string
     media_list  : [("img", url), ("tbl", url), …]  (may be empty)
     """
-    uid = _current_uid(request)
-    agent = get_agent(uid)                   # ← user-scoped agent
-    answer_md = agent.run(prompt)
+    answer_md = None
+    if not rag_tried and _route(prompt) == "rag":
+        with span("chat.fast_path"):
+            answer_md = smart_query(prompt, user_id=uid)
+        rag_tried = True
+        if answer_md.strip() == NO_RESULTS:
+            answer_md = None
+        else:
+            CHAT_ROUTES.inc(route="fast")
+    if answer_md is None:
+        CHAT_ROUTES.inc(route="fallback" if rag_tried else "agent")
+        agent = get_agent(uid)                   # ← user-scoped agent
+        with span("chat.agent"):
+            answer_md = agent.run(prompt + RAG_TRIED_NOTE if rag_tried else prompt)
+        if answer_md.strip() == NO_RESULTS:      # retrieve_rag is return_direct: never show the token
+            answer_md = NO_RESULTS_ANSWER
     html_answer = markdown2.markdown(
         answer_md, extras=["fenced-code-blocks", "tables"]
     )
@@ -133,46 +200,125 @@ def chat_api():
     user_msg = (data or {}).get("message", "").strip()
     if not user_msg:
         return jsonify({"error": "empty"}), 400
+    uid = _current_uid(request)
+    try:
+        USAGE.check_quota(uid)
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e)}), 429
+    return jsonify(_answer_chat(uid, user_msg))
 
-    key = _chat_key(request)
 
-# 1) store user message
-    # 1) store user msg
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    /chat as Server-Sent Events: `status` lines while retrieving, the
+    `sources` list, answer `token`s as Gemini writes them, `media` as
+    soon as a figure / table token completes, and a final `done` with
+    the rendered HTML. Plain questions go straight to smart_query_stream;
+    tool requests (see `_route`) and NO_RESULTS go to the agent.
+    """
+    data = request.get_json(force=True)
+    user_msg = (data or {}).get("message", "").strip()
+    if not user_msg:
+        return jsonify({"error": "empty"}), 400
     uid = _current_uid(request)
+    try:
+        USAGE.check_quota(uid)
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e)}), 429
+    return Response(_chat_events(uid, user_msg), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# ---------------- chat bodies (also served by asgi.py) -----------
+def _store_chat(uid: int | None, role: str, html: str) -> None:
     db = _get_db()
     db.execute("INSERT INTO chats (user_id,role,html,ts) VALUES (?,?,?,?)",
-            (uid, "user", markdown2.markdown(user_msg), datetime.datetime.utcnow().isoformat(timespec="seconds")   # Fix A
-))
+               (uid, role, html, datetime.datetime.utcnow().isoformat(timespec="seconds")))
     db.commit()
 
 
+def _answer_chat(uid: int | None, user_msg: str) -> dict:
+    """Store the question, answer it, store the answer; the /chat JSON."""
+    # 1) store user msg
+    _store_chat(uid, "user", markdown2.markdown(user_msg))
 
-    # 2) call RAG
-    try:
-        answer_html, media = _run_rag(user_msg)
-    except Exception as e:
-        answer_html = f"<p style='color:red'>Server error: {e}</p>"
-        media = []
-
-    # 3) store assistant answer
-    # 3) build <img> / <iframe> tags once so history can replay them
-    media_html = []
+    # 2) call RAG – every LLM / embedding call lands on this request's ledger
+    with ledger(uid, "chat") as led:
+        try:
+            answer_html, media = _run_rag(user_msg, uid)
+        except Exception as e:
+            answer_html = f"<p style='color:red'>Server error: {e}</p>"
+            media = []
+
+    # 3) store assistant answer with <img> / <iframe> tags so history can replay them
+    _store_chat(uid, "assistant", answer_html + _media_html(media))
+    return {
+        "answer_html": answer_html,
+        "media": media,
+        "usage": led.summary()["totals"],
+    }
+
+
+def _chat_events(uid: int | None, user_msg: str) -> Iterator[str]:
+    """The /chat/stream body: SSE frames, question and answer stored like /chat."""
+    yield _sse("status", "Working on it…")           # first byte before any model call
+    _store_chat(uid, "user", markdown2.markdown(user_msg))
+    with ledger(uid, "chat") as led:
+        answer_html, media = "", []
+        try:
+            found = False
+            if _route(user_msg) == "rag":
+                for event, payload in smart_query_stream(user_msg, user_id=uid):
+                    if event == "media":
+                        kind, path = payload
+                        payload = (kind, f"/media/{'image' if kind == 'img' else 'table'}/{Path(path).name}")
+                        media.append(payload)
+                    elif event == "done":
+                        found = payload["found"]
+                        if found:
+                            CHAT_ROUTES.inc(route="fast")
+                            answer_html = markdown2.markdown(
+                                payload["answer"], extras=["fenced-code-blocks", "tables"])
+                        continue
+                    yield _sse(event, payload)
+                if not found:
+                    yield _sse("status", "No matching papers – asking the agent…")
+                    answer_html, media = _run_rag(user_msg, uid, rag_tried=True)
+            else:
+                yield _sse("status", "Handing over to the agent…")
+                answer_html, media = _run_rag(user_msg, uid)
+            if not found:
+                for m in media:
+                    yield _sse("media", m)
+        except Exception as e:
+            answer_html = f"<p style='color:red'>Server error: {e}</p>"
+        yield _sse("done", {"answer_html": answer_html, "media": media,
+                            "usage": led.summary()["totals"]})
+    _store_chat(uid, "assistant", answer_html + _media_html(media))
+
+
+def _media_html(media: List[Tuple[str, str]]) -> str:
+    """<img> / <iframe> tags for the media list, stored with the answer."""
+    tags = []
     for kind, url in media:
         if kind == "img":
-            media_html.append(f'<img src="{url}" class="inline-img">')
+            tags.append(f'<img src="{url}" class="inline-img">')
         else:  # tables
-            media_html.append(f'<iframe src="{url}" class="tbl-frame"></iframe>')
+            tags.append(f'<iframe src="{url}" class="tbl-frame"></iframe>')
+    return "".join(tags)
 
-    db.execute("INSERT INTO chats (user_id,role,html,ts) VALUES (?,?,?,?)",
-           (uid, "assistant", answer_html + "".join(media_html),
-           datetime.datetime.utcnow().isoformat(timespec="seconds") ))
-    db.commit()
 
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    return jsonify({
-        "answer_html": answer_html,
-        "media": media
-    })
+
+@app.route("/usage")
+def usage():
+    """LLM / embedding totals of the logged-in user: today and all time."""
+    uid = _current_uid(request)
+    return jsonify({"today": USAGE.for_user(uid), "total": USAGE.for_user(uid, day="*"),
+                    "daily_token_quota": USAGE.daily_tokens or None})
 
 
 
@@ -314,7 +460,7 @@ from flask import redirect, url_for
 # ───────────────────────────────────────────────────────────────
 #  GLOBAL LOGIN REQUIRED (except a few routes)
 # ───────────────────────────────────────────────────────────────
-PUBLIC_PATHS = {"/login", "/register", "/static/", "/media/"}
+PUBLIC_PATHS = {"/login", "/register", "/static/", "/media/", "/metrics"}
 
 @app.before_request
 def force_login():
@@ -362,49 +508,89 @@ def upload():
     return jsonify({"file_path": str(save_path)}), 200
 
 
+def _run_ingest_job(job: dict, stop_flag: threading.Event) -> None:
+    from rag_scipdf_core import ingest_documents
+
+    def publish(snap: dict) -> None:
+        # the cancel may have been written by another process
+        if INGEST_QUEUE.update_progress(job["id"], snap) in ("cancelled", None):
+            stop_flag.set()
+
+    with ledger(job["user_id"], "ingest"):
+        ingest_documents(
+            job["file_path"], stop_event=stop_flag, user_id=job["user_id"],
+            progress_cb=publish,
+        )
+
+
+# SQLite-backed queue (users.db) served by a fixed-size worker pool.
+# asgi.py sets INGEST_AUTOSTART=0 and starts it per worker process at
+# ASGI startup instead (threads do not survive gunicorn's preload fork).
+# Under `python app.py` the werkzeug reloader parent only watches files
+# and serves nothing, so it must not claim jobs either.
+DEBUG = os.getenv("FLASK_DEBUG", "1") != "0"
+_RELOADER_PARENT = (__name__ == "__main__" and DEBUG
+                    and os.environ.get("WERKZEUG_RUN_MAIN") != "true")
+INGEST_QUEUE = queue_from_env(DB_PATH, _run_ingest_job)
+if os.getenv("INGEST_AUTOSTART", "1") != "0" and not _RELOADER_PARENT:
+    INGEST_QUEUE.start()
+
+
+def _own_job(task_id: str) -> dict | None:
+    """The job row if it belongs to the logged-in user, else None."""
+    job = INGEST_QUEUE.get(task_id)
+    if job is None or job["user_id"] != _current_uid(request):
+        return None
+    return job
+
+
 @app.route("/ingest", methods=["POST"])
 def ingest():
-    """Kick off ingestion in a background thread, return task_id."""
+    """Queue the uploaded PDF for ingestion, return task_id."""
     uid = _current_uid(request)
     data = request.get_json(force=True)
     path = Path(data.get("file_path", ""))
     if not path.exists():
         return "file not found", 400
+    try:
+        USAGE.check_quota(uid)
+    except QuotaExceeded as e:
+        return jsonify({"error": str(e)}), 429
 
-    stop_flag = threading.Event()
-    task_id   = secrets.token_hex(8)
-
-    def worker():
-        from rag_scipdf_core import ingest_documents
-        try:
-            ingest_documents(str(path), stop_event=stop_flag, user_id=uid)
-            INGEST_TASKS[task_id]["status"] = "complete"
-        except Exception as e:
-            INGEST_TASKS[task_id]["status"] = f"failed: {e}"
-        finally:
-            # leave dict entry until front-end fetches status once more
-            pass
-
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
-    INGEST_TASKS[task_id] = {"thread": t, "stop": stop_flag,"status":"running"}
+    task_id = INGEST_QUEUE.submit(uid, str(path))
     return jsonify({"task_id": task_id}), 202
 
 
 @app.route("/ingest/cancel/<task_id>", methods=["POST"])
 def cancel_ingest(task_id):
-    task = INGEST_TASKS.get(task_id)
-    if not task: return "task not found", 404
-    task["stop"].set()
-    task["status"] = "cancelled"
+    if not _own_job(task_id): return "task not found", 404
+    INGEST_QUEUE.cancel(task_id)
     return "cancelled", 200
 
 @app.route("/ingest/status/<task_id>")
 def ingest_status(task_id):
-    task = INGEST_TASKS.get(task_id)
-    if not task:
+    job = _own_job(task_id)
+    if not job:
         return jsonify({"status": "unknown"}), 404
-    return jsonify({"status": task.get("status", "running")})
+    status = job["status"]
+    if status == "failed":
+        status = f"failed: {job['error']}"
+    progress = json.loads(job["progress"]) if job["progress"] else None
+    return jsonify({"status": status, "progress": progress})
+
+
+# ───────────────────────────────────────────────────────────────
+# 4)  Prometheus scrape endpoint
+#     Stage latencies (rag_stage_seconds{stage="query.answer"} …),
+#     HTTP latencies and cache / router counters. Set METRICS_TOKEN
+#     to require "Authorization: Bearer <token>".
+# ───────────────────────────────────────────────────────────────
+@app.route("/metrics")
+def metrics():
+    token = os.getenv("METRICS_TOKEN")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 
 
@@ -413,6 +599,6 @@ def ingest_status(task_id):
 
 # ───────── main ─────────
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000,debug=True)   # ← add this
+    app.run(host="127.0.0.1", port=5000, debug=DEBUG)
 
 
@@ -0,0 +1,254 @@
+# asgi.py
+# -------------------------------------------------------------
+# ASGI entry point for production serving:
+#     gunicorn -c gunicorn.conf.py asgi:app        (uvicorn workers)
+#     uvicorn asgi:app --port 5000                 (single process)
+#
+#   • /chat and /chat/stream sit behind ChatLimiter, an admission queue in
+#     front of a thread-capped executor: CHAT_CONCURRENCY chats run at
+#     once, up to CHAT_QUEUE_MAX more wait on the event loop, and beyond
+#     that, or after CHAT_QUEUE_TIMEOUT s of waiting, the chat is refused
+#     (503 / an SSE error) instead of piling up threads
+#   • an admitted chat holds one pool thread for its whole agent /
+#     retrieval / Gemini run (that code is synchronous), so throughput is
+#     still WEB_CONCURRENCY × CHAT_CONCURRENCY chats at a time; SSE frames
+#     are handed back to the loop as they are produced
+#   • every other route (pages, upload, ingest, media, /metrics) goes to
+#     the Flask app through a2wsgi's thread pool
+# Metrics (per worker process): rag_chat_queue_seconds{route},
+# rag_chat_rejected_total{route,reason}, rag_chat_slots{kind}.
+# -------------------------------------------------------------
+from __future__ import annotations
+import asyncio
+import contextvars
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from http.cookies import SimpleCookie
+from types import SimpleNamespace
+from typing import Dict
+
+os.environ.setdefault("INGEST_AUTOSTART", "0")          # started per worker, see lifespan
+
+from a2wsgi import WSGIMiddleware
+
+import app as flask_app
+from accounting import USAGE, QuotaExceeded
+from logging_config import logger
+from metrics import Counter, Histogram, gauge_fn
+
+CHAT_CONCURRENCY   = int(os.getenv("CHAT_CONCURRENCY", "32"))
+CHAT_QUEUE_MAX     = int(os.getenv("CHAT_QUEUE_MAX", "512"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "60"))
+WSGI_THREADS       = int(os.getenv("WSGI_THREADS", "16"))
+
+QUEUE_SECONDS = Histogram("rag_chat_queue_seconds", "Time a chat waited for a slot", ("route",),
+                          buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+REJECTED      = Counter("rag_chat_rejected_total", "Chats refused by the limiter", ("route", "reason"))
+
+
+class Overloaded(Exception):
+    """No chat slot became free (queue full or waited too long)."""
+
+
+class ChatLimiter:
+    """Per-process cap on chats in flight, with a bounded, timed wait queue."""
+
+    def __init__(self, limit: int, max_waiting: int, timeout_s: float):
+        self.limit       = max(1, limit)
+        self.max_waiting = max_waiting
+        self.timeout_s   = timeout_s
+        self.inflight    = 0
+        self.waiting     = 0
+        self._sem: asyncio.Semaphore | None = None     # bound to the running loop on first use
+
+    @asynccontextmanager
+    async def slot(self, route: str):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+        t0 = time.perf_counter()
+        if not self._sem.locked():                     # free slot: acquire() returns at once
+            await self._sem.acquire()
+        else:
+            if self.waiting >= self.max_waiting:
+                REJECTED.inc(route=route, reason="queue_full")
+                raise Overloaded(f"{self.waiting} chats already waiting")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._sem.acquire(), self.timeout_s)
+            except asyncio.TimeoutError:
+                REJECTED.inc(route=route, reason="timeout")
+                raise Overloaded(f"no free slot within {self.timeout_s:g} s") from None
+            finally:
+                self.waiting -= 1
+        QUEUE_SECONDS.observe(time.perf_counter() - t0, route=route)
+        self.inflight += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._sem.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {"inflight": self.inflight, "waiting": self.waiting, "limit": self.limit}
+
+
+LIMITER = ChatLimiter(CHAT_CONCURRENCY, CHAT_QUEUE_MAX, CHAT_QUEUE_TIMEOUT)
+gauge_fn("rag_chat_slots", "Chat limiter occupancy", LIMITER.stats)
+
+_POOL = ThreadPoolExecutor(max_workers=LIMITER.limit, thread_name_prefix="chat")
+
+
+def _in_pool(fn, *args):
+    """Run blocking `fn` on the chat pool, keeping the caller's contextvars."""
+    ctx = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(_POOL, ctx.run, fn, *args)
+
+
+# ─────────────────── tiny ASGI helpers ──────────────────────────
+def _uid(scope) -> int | None:
+    """Same cookie as the Flask app (app._current_uid)."""
+    raw = b"; ".join(v for k, v in scope["headers"] if k == b"cookie").decode("latin-1")
+    cookies = {k: m.value for k, m in SimpleCookie(raw).items()}
+    return flask_app._current_uid(SimpleNamespace(cookies=cookies))
+
+
+async def _read_json(receive) -> dict:
+    body = b""
+    while True:
+        msg = await receive()
+        body += msg.get("body", b"")
+        if not msg.get("more_body"):
+            break
+    try:
+        return json.loads(body or b"{}") or {}
+    except ValueError:
+        return {}
+
+
+async def _start(send, status: int, content_type: str, extra=()) -> None:
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()), *extra]})
+
+
+async def _send_json(send, status: int, payload, extra=()) -> None:
+    await _start(send, status, "application/json", extra)
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode("utf-8")})
+
+
+async def _wait_disconnect(receive, gone: asyncio.Event) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    gone.set()
+
+
+# ─────────────────── chat routes ────────────────────────────────
+async def _chat_request(scope, receive, send):
+    """((uid, message), 200), or (None, status) once an error response went out."""
+    uid = _uid(scope)
+    if uid is None:
+        await _send_json(send, 401, {"error": "login required"})
+        return None, 401
+    msg = str((await _read_json(receive)).get("message", "")).strip()
+    if not msg:
+        await _send_json(send, 400, {"error": "empty"})
+        return None, 400
+    try:
+        USAGE.check_quota(uid)
+    except QuotaExceeded as e:
+        await _send_json(send, 429, {"error": str(e)})
+        return None, 429
+    return (uid, msg), 200
+
+
+async def chat(scope, receive, send) -> int:
+    req, status = await _chat_request(scope, receive, send)
+    if req is None:
+        return status
+    try:
+        async with LIMITER.slot("/chat"):
+            payload = await _in_pool(flask_app._answer_chat, *req)
+    except Overloaded as e:
+        await _send_json(send, 503, {"error": f"Server busy: {e}"}, [(b"retry-after", b"5")])
+        return 503
+    await _send_json(send, 200, payload)
+    return 200
+
+
+async def chat_stream(scope, receive, send) -> int:
+    req, status = await _chat_request(scope, receive, send)
+    if req is None:
+        return status
+    await _start(send, 200, "text/event-stream",
+                 [(b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")])
+
+    async def emit(frame: str) -> None:
+        await send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": True})
+
+    gone = asyncio.Event()
+    watcher = asyncio.create_task(_wait_disconnect(receive, gone))
+    try:
+        if LIMITER.inflight >= LIMITER.limit:
+            await emit(flask_app._sse("status", f"Queued – {LIMITER.waiting} chats ahead of you…"))
+        async with LIMITER.slot("/chat/stream"):
+            loop   = asyncio.get_running_loop()
+            frames: asyncio.Queue = asyncio.Queue()
+
+            def produce() -> None:                # pool thread: drive the sync generator
+                gen = flask_app._chat_events(*req)
+                try:
+                    for frame in gen:
+                        if gone.is_set():          # client left → stop paying for tokens
+                            break
+                        loop.call_soon_threadsafe(frames.put_nowait, frame)
+                finally:
+                    gen.close()
+                    loop.call_soon_threadsafe(frames.put_nowait, None)
+
+            done = _in_pool(produce)
+            while (frame := await frames.get()) is not None:
+                if not gone.is_set():
+                    await emit(frame)
+            await done
+    except Overloaded as e:
+        await emit(flask_app._sse("done", {"answer_html": f"<p style='color:red'>Server busy: {e}</p>",
+                                           "media": []}))
+    except Exception as e:                         # the headers are out: report in-band
+        logger.exception("chat stream failed")
+        await emit(flask_app._sse("done", {"answer_html": f"<p style='color:red'>Server error: {e}</p>",
+                                           "media": []}))
+    finally:
+        watcher.cancel()
+    await send({"type": "http.response.body", "body": b""})
+    return 200
+
+
+_ROUTES = {("POST", "/chat"): chat, ("POST", "/chat/stream"): chat_stream}
+_WSGI = WSGIMiddleware(flask_app.app, workers=WSGI_THREADS)
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            flask_app.INGEST_QUEUE.start()         # per worker process, after the fork
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            flask_app.INGEST_QUEUE.stop()
+            _POOL.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    handler = _ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await _WSGI(scope, receive, send)
+    t0 = time.perf_counter()
+    status = await handler(scope, receive, send)
+    flask_app.HTTP_SECONDS.observe(time.perf_counter() - t0, endpoint=scope["path"],
+                                   method=scope["method"], status=status)
@@ -0,0 +1,45 @@
+# benchmarks/bench_chroma.py
+# -------------------------------------------------------------
+# Raw Chroma cost by collection size: add throughput and user-scoped
+# top-k query latency against a throwaway PersistentClient.
+# -------------------------------------------------------------
+from __future__ import annotations
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from .harness import Stopwatch, latency_summary, peak_rss_mb
+
+
+def run(root: Path, sizes: List[int], dim: int = 256, n_queries: int = 100,
+        top_k: int = 5, users: int = 4, seed: int = 0) -> Dict:
+    import chromadb
+
+    rng = np.random.default_rng(seed)
+    client = chromadb.PersistentClient(path=str(root))
+    out: Dict[str, Dict] = {}
+    for size in sizes:
+        col = client.get_or_create_collection(f"bench_{size}")
+        with Stopwatch() as add:
+            for lo in range(0, size, 5000):
+                n = min(5000, size - lo)
+                col.add(
+                    ids=[f"v{i}" for i in range(lo, lo + n)],
+                    embeddings=rng.standard_normal((n, dim)).astype(np.float32).tolist(),
+                    metadatas=[{"user_id": int(i % users)} for i in range(lo, lo + n)],
+                )
+        queries = rng.standard_normal((n_queries, dim)).astype(np.float32).tolist()
+        samples = []
+        for q in queries:
+            t0 = time.perf_counter()
+            col.query(query_embeddings=[q], n_results=top_k, where={"user_id": 1})
+            samples.append(time.perf_counter() - t0)
+        out[str(size)] = {
+            "add_per_sec": round(size / add.seconds, 1) if add.seconds else 0.0,
+            "query": latency_summary(samples),
+        }
+        client.delete_collection(f"bench_{size}")
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
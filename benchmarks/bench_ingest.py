@@ -0,0 +1,32 @@
+# benchmarks/bench_ingest.py
+# -------------------------------------------------------------
+# ingest_documents throughput: pages/sec, chunks/sec, per-stage busy
+# time and queue depths (from the pipeline's own metrics).
+# -------------------------------------------------------------
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict
+
+from .harness import Stopwatch, peak_rss_mb
+
+
+def run(pdf_dir: Path, user_id: int = 1, **ingest_kw) -> Dict:
+    from rag_scipdf_core import ingest_documents
+
+    snapshots = []
+    with Stopwatch() as sw:
+        stats = ingest_documents(str(pdf_dir / "*.pdf"), user_id=user_id, force=True,
+                                 progress_cb=snapshots.append, **ingest_kw)
+    pages = snapshots[-1]["pages_converted"] if snapshots else 0
+    return {
+        "pdfs": stats["pdfs"],
+        "pages": pages,
+        "chunks": stats["chunks"],
+        "images": stats["images"],
+        "tables": stats["tables"],
+        "seconds": round(sw.seconds, 3),
+        "pages_per_sec": round(pages / sw.seconds, 3) if sw.seconds else 0.0,
+        "chunks_per_sec": round(stats["chunks"] / sw.seconds, 3) if sw.seconds else 0.0,
+        "stages": stats.get("stages", {}),
+        "peak_rss_mb": peak_rss_mb(),
+    }
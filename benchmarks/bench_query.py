@@ -0,0 +1,37 @@
+# benchmarks/bench_query.py
+# -------------------------------------------------------------
+# smart_query latency distribution, cold (result cache bypassed) at the
+# requested concurrency, plus the latency of result-cache hits.
+# -------------------------------------------------------------
+from __future__ import annotations
+import contextlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from .harness import Stopwatch, latency_summary, peak_rss_mb
+
+
+def _timed_query(question: str, user_id: int, use_cache: bool) -> float:
+    from rag_scipdf_core import smart_query
+    t0 = time.perf_counter()
+    smart_query(question, user_id=user_id, use_cache=use_cache)
+    return time.perf_counter() - t0
+
+
+def run(questions: List[str], user_id: int = 1, concurrency: int = 1) -> Dict:
+    # smart_query renders its answer for notebooks; keep that off the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        _timed_query(questions[0], user_id, use_cache=False)          # warm-up
+        with Stopwatch() as sw, ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            cold = list(pool.map(lambda q: _timed_query(q, user_id, False), questions))
+        _timed_query(questions[0], user_id, use_cache=True)
+        hits = [_timed_query(questions[0], user_id, use_cache=True) for _ in range(20)]
+    return {
+        "concurrency": concurrency,
+        "cold": latency_summary(cold),
+        "throughput_qps": round(len(questions) / sw.seconds, 3) if sw.seconds else 0.0,
+        "cache_hit": latency_summary(hits),
+        "peak_rss_mb": peak_rss_mb(),
+    }
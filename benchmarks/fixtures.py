@@ -0,0 +1,115 @@
+# benchmarks/fixtures.py
+# -------------------------------------------------------------
+# Synthetic, deterministic inputs for the benchmark suite:
+#   • write_pdf        – a plain text PDF (headings + paragraphs) built by
+#                        hand, so no PDF library is needed
+#   • synthetic_corpus – N such papers with gene-symbol / CVE-style tokens
+#   • questions        – queries that hit the generated vocabulary
+# -------------------------------------------------------------
+from __future__ import annotations
+import random
+from pathlib import Path
+from typing import List, Tuple
+
+_VOCAB = ("gene expression variant pathway protein cohort assay sequencing "
+          "mutation tumour regulation transcription binding promoter enhancer "
+          "phenotype genotype allele methylation chromatin receptor signalling "
+          "inhibitor kinase model analysis result significant sample control").split()
+_GENES = ["BRCA1", "TP53", "EGFR", "KRAS", "MYC", "PTEN", "IL-6", "TNF", "APOE", "CFTR"]
+_SECTIONS = ["Abstract", "Introduction", "Methods", "Results", "Discussion"]
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _wrap(text: str, width: int = 90) -> List[str]:
+    lines, cur = [], ""
+    for w in text.split():
+        if len(cur) + len(w) + 1 > width:
+            lines.append(cur)
+            cur = w
+        else:
+            cur = f"{cur} {w}".strip()
+    if cur:
+        lines.append(cur)
+    return lines
+
+
+def write_pdf(path: Path, pages: List[List[Tuple[str, str]]]) -> None:
+    """
+    pages: per page a list of (kind, text), kind "h" (heading) or "p".
+    Produces a minimal PDF 1.4 file with Helvetica text.
+    """
+    objs: List[bytes] = []
+    page_ids = []
+    n_fixed = 3                                          # catalog, pages, font
+    for i, blocks in enumerate(pages):
+        ops = ["BT", "72 740 Td", "14 TL"]
+        for kind, text in blocks:
+            size = 15 if kind == "h" else 10
+            ops.append(f"/F1 {size} Tf")
+            for line in (_wrap(text) if kind == "p" else [text]):
+                ops.append(f"({_escape(line)}) '")
+            ops.append("() '")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        content_id = n_fixed + 2 * i + 1
+        page_id    = content_id + 1
+        objs.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objs.append((f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                     f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>").encode())
+        page_ids.append(page_id)
+    kids = " ".join(f"{p} 0 R" for p in page_ids)
+    fixed = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, body in enumerate(fixed + objs, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref)
+    Path(path).write_bytes(bytes(out))
+
+
+def _paragraph(rng: random.Random, n_words: int = 80) -> str:
+    words = [rng.choice(_GENES) if rng.random() < 0.06 else rng.choice(_VOCAB) for _ in range(n_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def synthetic_corpus(out_dir: Path, n_docs: int = 4, pages_per_doc: int = 6,
+                     seed: int = 0) -> List[Path]:
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for d in range(n_docs):
+        pages = []
+        for pg in range(pages_per_doc):
+            blocks = []
+            if pg == 0:
+                blocks.append(("h", f"Synthetic study {d}: {rng.choice(_GENES)} and {rng.choice(_VOCAB)}"))
+            blocks.append(("h", f"{_SECTIONS[pg % len(_SECTIONS)]} {pg + 1}"))
+            blocks += [("p", _paragraph(rng)) for _ in range(3)]
+            pages.append(blocks)
+        path = out_dir / f"synthetic_{d:03d}.pdf"
+        write_pdf(path, pages)
+        paths.append(path)
+    return paths
+
+
+def questions(n: int = 50, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    templates = [
+        "What is the role of {g} in {v}?",
+        "How does {g} {v} affect the {w}?",
+        "Summarise the {w} results for {g}.",
+        "Which {v} was measured in the {w} cohort?",
+    ]
+    return [rng.choice(templates).format(g=rng.choice(_GENES), v=rng.choice(_VOCAB), w=rng.choice(_VOCAB))
+            for _ in range(n)]
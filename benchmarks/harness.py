@@ -0,0 +1,42 @@
+# benchmarks/harness.py
+# -------------------------------------------------------------
+# Small measurement helpers shared by the benchmark modules.
+# -------------------------------------------------------------
+from __future__ import annotations
+import resource
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+
+def latency_summary(samples_s: List[float]) -> Dict[str, float]:
+    """Milliseconds: count, mean, p50 / p95 / p99, max."""
+    if not samples_s:
+        return {"count": 0}
+    ms = np.asarray(samples_s) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+def peak_rss_mb() -> float:
+    """High-water mark of this process's resident memory."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+class Stopwatch:
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.t0
@@ -0,0 +1,159 @@
+# benchmarks/run.py
+# -------------------------------------------------------------
+# End-to-end benchmark suite, fully offline:
+#   • LLM calls go to llm_stub_server (in-process) with injected latency
+#   • embeddings use the hashing backend with injected latency
+#   • all state (Chroma, caches, manifests) lives in a temp work dir
+#
+#   python -m benchmarks.run --out benchmarks/results/$(git rev-parse --short HEAD).json
+#   python -m benchmarks.run --compare benchmarks/results/<baseline>.json
+#
+# Phases: ingest (pages/sec, chunks/sec), query (smart_query p50/p95/p99),
+# chroma (query latency by collection size). Every phase reports the
+# process's peak RSS so far. The JSON report is meant to be diffed
+# between commits.
+# -------------------------------------------------------------
+from __future__ import annotations
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO))                # root-level modules (rag_scipdf_core, …)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "-C", str(REPO), "rev-parse", "--short", "HEAD"],
+                                       text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def _setup_env(workdir: Path, args, port: int) -> None:
+    """Must run before any repo module is imported – they read these at import."""
+    env = {
+        "LLM_PROVIDER": "http",
+        "LLM_BASE_URL": f"http://127.0.0.1:{port}",
+        "EMBED_BACKEND": f"hash:{args.embed_dim}",
+        "HASH_EMBED_LATENCY_MS": str(args.embed_latency_ms),
+        "EMBED_CACHE_PATH": str(workdir / "embed_cache.sqlite3"),
+        "INGEST_MANIFEST_PATH": str(workdir / "ingest_manifest.sqlite3"),
+        "CORPUS_VERSIONS_PATH": str(workdir / "corpus_versions.sqlite3"),
+        "DOMAIN_CENTROIDS_PATH": str(workdir / "domain_centroids.sqlite3"),
+    }
+    os.environ.update(env)
+
+
+def _flatten(d, prefix=""):
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            yield from _flatten(v, key + ".")
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield key, v
+
+
+def compare(report: dict, baseline: dict) -> None:
+    base = dict(_flatten(baseline.get("results", {})))
+    print(f"\n{'metric':55s} {'baseline':>12s} {'now':>12s} {'change':>8s}")
+    for key, now in _flatten(report["results"]):
+        if key not in base:
+            continue
+        was = base[key]
+        change = f"{(now - was) / was * 100:+.1f}%" if was else "n/a"
+        print(f"{key:55s} {was:12.3f} {now:12.3f} {change:>8s}")
+
+
+def main(argv=None) -> dict:
+    ap = argparse.ArgumentParser(description="Offline ingest / query / Chroma benchmarks")
+    ap.add_argument("--out", type=Path, help="write the JSON report here")
+    ap.add_argument("--compare", type=Path, help="baseline report to diff against")
+    ap.add_argument("--only", nargs="+", choices=["ingest", "query", "chroma"],
+                    default=["ingest", "query", "chroma"])
+    ap.add_argument("--pdfs", help="glob of fixture PDFs (default: synthetic corpus)")
+    ap.add_argument("--docs", type=int, default=4, help="synthetic PDFs")
+    ap.add_argument("--pages", type=int, default=6, help="pages per synthetic PDF")
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--chroma-sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    ap.add_argument("--llm-latency-ms", type=float, default=300.0)
+    ap.add_argument("--llm-tokens-per-sec", type=float, default=80.0)
+    ap.add_argument("--embed-latency-ms", type=float, default=20.0)
+    ap.add_argument("--embed-dim", type=int, default=256)
+    ap.add_argument("--keep", action="store_true", help="keep the temp work dir")
+    args = ap.parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix="rag_bench_"))
+    port = _free_port()
+    _setup_env(workdir, args, port)
+
+    import llm_stub_server
+    from benchmarks import bench_chroma, bench_ingest, bench_query
+    from benchmarks.fixtures import questions, synthetic_corpus
+
+    stub = llm_stub_server.serve(port=port, settings=llm_stub_server.StubSettings(
+        latency_ms=args.llm_latency_ms, tokens_per_sec=args.llm_tokens_per_sec))
+    cwd = os.getcwd()
+    os.chdir(workdir)                       # DomainConfig roots are relative paths
+    results: dict = {}
+    try:
+        pdf_dir = workdir / "pdfs"
+        if args.pdfs:
+            pdf_dir.mkdir()
+            for p in glob.glob(os.path.join(cwd, args.pdfs)):
+                shutil.copy(p, pdf_dir)
+        else:
+            synthetic_corpus(pdf_dir, n_docs=args.docs, pages_per_doc=args.pages)
+
+        if "ingest" in args.only or "query" in args.only:
+            ingest = bench_ingest.run(pdf_dir)
+            if "ingest" in args.only:
+                results["ingest"] = ingest
+        if "query" in args.only:
+            results["query"] = bench_query.run(questions(args.queries), concurrency=args.concurrency)
+        if "chroma" in args.only:
+            results["chroma"] = bench_chroma.run(workdir / "chroma_bench", args.chroma_sizes,
+                                                 dim=args.embed_dim)
+    finally:
+        os.chdir(cwd)
+        stub.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, default=str)
+    if args.out:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(text)
+    print(text)
+    if args.compare:
+        compare(report, json.loads(args.compare.read_text()))
+    return report
+
+
+if __name__ == "__main__":
+    main()
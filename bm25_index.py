@@ -0,0 +1,226 @@
+# bm25_index.py
+# -------------------------------------------------------------
+# Persisted BM25 inverted index over text chunks, one per (domain, user),
+# stored next to the domain's chroma_root:
+#     <chroma_root>/bm25/user_<id>.pkl   snapshot (postings + per-doc term counts)
+#     <chroma_root>/bm25/user_<id>.log   JSON lines appended by every add
+#                                        and remove ({"id", "tf": null})
+# Loading unpickles the snapshot and replays the log – nothing is
+# re-tokenized – and the log is folded into the snapshot once it grows
+# past `compact_every` documents. Searches pick up lines appended by
+# other processes before scoring. Appends and compaction hold an
+# exclusive flock on user_<id>.lock (POSIX only), so a compaction never
+# truncates lines another process wrote after its last replay.
+# Tokens keep identifiers whole (BRCA1, CVE-2021-44228, IL-6) and also
+# index their hyphen / dot parts.
+# -------------------------------------------------------------
+from __future__ import annotations
+import json
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+try:
+    import fcntl
+except ImportError:                                   # Windows: single-process use only
+    fcntl = None
+
+_TOKEN_RE = re.compile(r"[a-z0-9](?:[a-z0-9_.\-]*[a-z0-9])?")
+_STOP = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the "
+    "this to was were what which with how does do did why when who".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    out: List[str] = []
+    for tok in _TOKEN_RE.findall(text.lower()):
+        if tok in _STOP:
+            continue
+        out.append(tok)
+        if "-" in tok or "." in tok:
+            out.extend(p for p in re.split(r"[.\-]", tok) if p and p not in _STOP)
+    return out
+
+
+class BM25Index:
+    def __init__(self, path: Path, k1: float = 1.5, b: float = 0.75, compact_every: int = 2_000):
+        self.path = Path(path)                        # snapshot; the log sits next to it
+        self.log_path = self.path.with_suffix(".log")
+        self.lock_path = self.path.with_suffix(".lock")
+        self.k1, self.b = k1, b
+        self.compact_every = compact_every
+        self.postings: Dict[str, Dict[str, int]] = {}     # term → {doc_id: tf}
+        self.doc_terms: Dict[str, Dict[str, int]] = {}    # doc_id → {term: tf}
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+        self._lock = threading.RLock()
+        self._snap_mtime = None
+        self._log_offset = 0
+        self._log_docs = 0
+        self._load()
+
+    # ---------------- persistence ---------------------------------
+    def _load(self) -> None:
+        self.postings, self.doc_terms, self.doc_len, self.total_len = {}, {}, {}, 0
+        self._snap_mtime = None
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                snap = pickle.load(f)
+            self.postings, self.doc_terms = snap["postings"], snap["doc_terms"]
+            self.doc_len = {d: sum(tf.values()) for d, tf in self.doc_terms.items()}
+            self.total_len = sum(self.doc_len.values())
+            self._snap_mtime = self.path.stat().st_mtime_ns
+        self._log_offset = self._log_docs = 0
+        self._replay()
+
+    def _replay(self) -> None:
+        """Apply log lines appended since the last look (ours or another process's)."""
+        if not self.log_path.exists():
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if not line.endswith(b"\n"):          # a writer is mid-line – next time
+                    break
+                rec = json.loads(line)
+                if rec["tf"] is None:
+                    self._drop(rec["id"])
+                else:
+                    self._apply(rec["id"], rec["tf"])
+                self._log_offset += len(line)
+                self._log_docs += 1
+
+    def _refresh(self) -> None:
+        snap_mtime = self.path.stat().st_mtime_ns if self.path.exists() else None
+        if snap_mtime != self._snap_mtime:
+            self._load()                              # compacted elsewhere
+        elif self.log_path.exists() and self.log_path.stat().st_size != self._log_offset:
+            if self.log_path.stat().st_size < self._log_offset:
+                self._load()
+            else:
+                self._replay()
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock shared by every process writing this index."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _compact(self) -> None:
+        """Fold the log into the snapshot; caller holds _file_lock and has just replayed."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump({"postings": self.postings, "doc_terms": self.doc_terms}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        open(self.log_path, "wb").close()             # no writer can append until we unlock
+        self._snap_mtime = self.path.stat().st_mtime_ns
+        self._log_offset = self._log_docs = 0
+
+    # ---------------- updates -------------------------------------
+    def _drop(self, doc_id: str) -> None:
+        old = self.doc_terms.pop(doc_id, None)
+        if old:
+            self.total_len -= self.doc_len.pop(doc_id)
+            for term in old:
+                docs = self.postings.get(term)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del self.postings[term]
+
+    def _apply(self, doc_id: str, tf: Dict[str, int]) -> None:
+        self._drop(doc_id)                            # re-adding an id replaces it
+        self.doc_terms[doc_id] = tf
+        self.doc_len[doc_id] = sum(tf.values())
+        self.total_len += self.doc_len[doc_id]
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[doc_id] = n
+
+    def add(self, ids: List[str], texts: List[str]) -> None:
+        self._append([(i, dict(Counter(tokenize(t)))) for i, t in zip(ids, texts)])
+
+    def remove(self, ids: List[str]) -> None:
+        self._append([(i, None) for i in ids])
+
+    def _append(self, recs: List[Tuple[str, Dict[str, int] | None]]) -> None:
+        with self._lock, self._file_lock():
+            self._refresh()                           # everything up to now is in memory
+            with open(self.log_path, "ab") as f:
+                for doc_id, tf in recs:
+                    line = (json.dumps({"id": doc_id, "tf": tf}) + "\n").encode("utf-8")
+                    f.write(line)
+                    if tf is None:
+                        self._drop(doc_id)
+                    else:
+                        self._apply(doc_id, tf)
+                    self._log_offset += len(line)
+                    self._log_docs += 1
+            if self._log_docs >= self.compact_every:
+                self._compact()
+
+    # ---------------- scoring -------------------------------------
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Top-k (doc_id, score) by BM25."""
+        with self._lock:
+            self._refresh()
+            n_docs = len(self.doc_terms)
+            if not n_docs:
+                return []
+            avg_len = self.total_len / n_docs
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, tf in docs.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda kv: -kv[1])[:k]
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+
+# ─────────────────── registry ───────────────────────────────────
+_LOCK = threading.Lock()
+_INDEXES: Dict[Tuple[str, int], BM25Index] = {}
+
+
+def get_bm25(cfg, user_id: int) -> BM25Index:
+    """The (domain, user) index, loaded once per process."""
+    key = (str(cfg.chroma_root), user_id)
+    idx = _INDEXES.get(key)
+    if idx is None:
+        with _LOCK:
+            idx = _INDEXES.get(key)
+            if idx is None:
+                idx = BM25Index(Path(cfg.chroma_root) / "bm25" / f"user_{user_id}.pkl")
+                _INDEXES[key] = idx
+    return idx
+
+
+def rrf_fuse(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """Reciprocal-rank fusion of several ranked id lists (best first)."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda d: -scores[d])
@@ -0,0 +1,213 @@
+# chunking.py
+# -------------------------------------------------------------
+# Structure-aware chunker for DoclingDocuments.
+# Walks the document tree (section headers, paragraphs, list items,
+# tables) and packs whole blocks into chunks up to a token budget, so
+# chunks no longer cut through sentences, tables or headings.
+# Every chunk records the page span it covers.
+# -------------------------------------------------------------
+from __future__ import annotations
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+from docling_core.types.doc import DocItemLabel, PictureItem, SectionHeaderItem, TableItem
+
+_SKIP_LABELS = {DocItemLabel.PAGE_HEADER, DocItemLabel.PAGE_FOOTER}
+_SENT_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")
+_TABLE_SEP_RE = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?\s*$")
+
+
+def approx_tokens(text: str) -> int:
+    """~4 characters per token – close enough for budgeting Gemini / embedding input."""
+    return max(1, len(text) // 4)
+
+
+@dataclass
+class Chunk:
+    text: str
+    page_start: int
+    page_end: int
+    headings: List[str] = field(default_factory=list)
+
+
+@dataclass
+class _Block:
+    text: str
+    page: int
+    tokens: int
+    path: List[str] = field(default_factory=list)     # heading path the block sits under
+
+
+def _split_oversized(text: str, page: int, budget: int,
+                     count: Callable[[str], int]) -> List[_Block]:
+    """Break one block that exceeds the budget at sentence, then word, boundaries."""
+    out: List[_Block] = []
+    buf = ""
+    for sent in _SENT_RE.split(text):
+        cand = f"{buf} {sent}".strip()
+        if buf and count(cand) > budget:
+            out.append(_Block(buf, page, count(buf)))
+            buf = sent
+        else:
+            buf = cand
+        while count(buf) > budget:                      # a single giant "sentence"
+            words, head = buf.split(" "), ""
+            while words and count(f"{head} {words[0]}".strip()) <= budget:
+                head = f"{head} {words.pop(0)}".strip()
+            if not head:                                # no spaces at all → hard cut
+                cut = max(1, len(buf) * budget // count(buf))
+                head, words = buf[:cut], [buf[cut:]]
+            out.append(_Block(head, page, count(head)))
+            buf = " ".join(words)
+    if buf:
+        out.append(_Block(buf, page, count(buf)))
+    return out
+
+
+def _split_table(text: str, page: int, budget: int,
+                 count: Callable[[str], int]) -> List[_Block]:
+    """
+    Break a Markdown table that exceeds the budget between rows only;
+    every piece repeats the header and separator lines so it keeps its
+    column names. A single row longer than the budget stays whole.
+    """
+    lines = text.split("\n")
+    n_head = 2 if len(lines) > 1 and _TABLE_SEP_RE.match(lines[1].strip()) else 1
+    head, rows = lines[:n_head], lines[n_head:]
+    out: List[_Block] = []
+    piece: List[str] = []
+    for row in rows:
+        if piece and count("\n".join(head + piece + [row])) > budget:
+            out.append(_Block("\n".join(head + piece), page, count("\n".join(head + piece))))
+            piece = []
+        piece.append(row)
+    if piece or not out:
+        out.append(_Block("\n".join(head + piece), page, count("\n".join(head + piece))))
+    return out
+
+
+def _blocks(ddoc, budget: int, count: Callable[[str], int]) -> List[Tuple[_Block, bool]]:
+    """
+    Flatten the document into (block, is_header) pairs in reading order;
+    header blocks let the packer cut at section boundaries.
+    """
+    out: List[Tuple[_Block, bool]] = []
+    path: List[str] = []
+    page = 1
+    for item, _level in ddoc.iterate_items():
+        if getattr(item, "label", None) in _SKIP_LABELS or isinstance(item, PictureItem):
+            continue
+        if getattr(item, "prov", None):
+            page = item.prov[0].page_no
+
+        if isinstance(item, SectionHeaderItem) or getattr(item, "label", None) == DocItemLabel.TITLE:
+            level = getattr(item, "level", 1) or 1
+            path = path[: level - 1] + [item.text.strip()]
+            head = f"### {item.text.strip()}"
+            out.append((_Block(head, page, count(head), list(path)), True))
+            continue
+
+        if isinstance(item, TableItem):
+            text = item.export_to_markdown(ddoc).strip()
+        elif getattr(item, "label", None) == DocItemLabel.LIST_ITEM:
+            text = f"{getattr(item, 'marker', '') or '-'} {item.text}".strip()
+        else:
+            text = (getattr(item, "text", "") or "").strip()
+        if not text:
+            continue
+
+        n = count(text)
+        if n > budget:
+            split = _split_table if isinstance(item, TableItem) else _split_oversized
+            for b in split(text, page, budget, count):
+                b.path = list(path)
+                out.append((b, False))
+        else:
+            out.append((_Block(text, page, n, list(path)), False))
+    return out
+
+
+def chunk_document(ddoc, max_tokens: int = 400, overlap_tokens: int = 40,
+                   count: Callable[[str], int] = approx_tokens) -> List[Chunk]:
+    """
+    Pack the document's blocks into chunks of at most `max_tokens`
+    (plus the heading line).
+      • a section header closes the current chunk once it holds at least
+        a quarter of the budget; smaller sections are merged into the next
+        one, keeping their heading inline
+      • the last blocks of a chunk, up to `overlap_tokens`, are repeated at
+        the start of the next chunk in the same section
+      • each chunk starts with the heading path of its first block
+    """
+    chunks: List[Chunk] = []
+    cur: List[_Block] = []
+    cur_tokens = 0
+
+    def flush(carry: bool) -> None:
+        nonlocal cur, cur_tokens
+        if not cur:
+            return
+        path = cur[0].path
+        head = f"## {' / '.join(path)}\n\n" if path else ""
+        chunks.append(Chunk(
+            text=head + "\n\n".join(b.text for b in cur),
+            page_start=min(b.page for b in cur),
+            page_end=max(b.page for b in cur),
+            headings=list(path),
+        ))
+        keep: List[_Block] = []
+        if carry and overlap_tokens > 0:
+            kept = 0
+            for b in reversed(cur):
+                if kept + b.tokens > overlap_tokens:
+                    break
+                keep.insert(0, b)
+                kept += b.tokens
+        cur, cur_tokens = keep, sum(b.tokens for b in keep)
+
+    for block, is_header in _blocks(ddoc, max_tokens, count):
+        if is_header:
+            if cur_tokens >= max_tokens // 4:
+                flush(carry=False)
+            if not cur:                  # section opens a fresh chunk; its path is the prefix
+                continue
+        if cur and cur_tokens + block.tokens > max_tokens:
+            flush(carry=True)
+            if cur_tokens + block.tokens > max_tokens:    # overlap + block still too big
+                cur, cur_tokens = [], 0
+        cur.append(block)
+        cur_tokens += block.tokens
+    flush(carry=False)
+    return chunks
+
+
+def page_chunk_index(chunks: List[Chunk]) -> Dict[int, Tuple[int, int]]:
+    """page → (first, last) position of the chunks covering that page."""
+    index: Dict[int, Tuple[int, int]] = {}
+    for i, c in enumerate(chunks):
+        for pg in range(c.page_start, c.page_end + 1):
+            lo, hi = index.get(pg, (i, i))
+            index[pg] = (min(lo, i), max(hi, i))
+    return index
+
+
+def owning_chunk(index: Dict[int, Tuple[int, int]], chunk_texts: List[str],
+                 page: int, anchor: str = "") -> int:
+    """
+    Position of the chunk a figure / table on `page` belongs to.
+    Among the chunks covering the page, the one containing `anchor`
+    (caption or the table's first Markdown row) wins, else the first.
+    Pages without text fall back to the nearest page that has some.
+    """
+    if not index:
+        return 0
+    if page not in index:
+        page = min(index, key=lambda pg: (abs(pg - page), pg))
+    lo, hi = index[page]
+    anchor = anchor.strip()[:80]
+    if anchor:
+        for i in range(lo, hi + 1):
+            if anchor in chunk_texts[i]:
+                return i
+    return lo
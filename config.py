@@ -1,3 +1,4 @@
+import os
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable, Dict, Any, List
@@ -14,12 +15,24 @@ class DomainConfig:
     name: str
     chroma_root: Path
     collection_names: Dict[str, str]          # text/table/image
-    embed_models:   Dict[str, str]            # text/table/image
+    embed_models:   Dict[str, str]            # text/table/image – Gemini name, "local:<model>" or "hash:<dim>"
     object_store_dirs: Dict[str, Path]        # image/table
     meta_schema:    Dict[str, Callable[[Any], Any]]
     allowed_meta_keys: List[str]
     ctx_builder:    Callable
     prompt_builders: Dict[str, Callable]      
+    # figures/tables are linked to their exact owning chunk at ingest, so the
+    # extra per-query nearest-neighbour search over the media collections is
+    # optional; turn it off to save two Chroma queries per question
+    semantic_media_search: bool = True
+    # fuse BM25 (bm25_index.py) hits with the dense text hits – exact
+    # identifiers (gene symbols, CVE IDs, acronyms) embed poorly
+    lexical_search: bool = True
+    # an unroutable question is answered from the speculative all-domain
+    # search only with hits at most this far away (Chroma's squared L2 on
+    # unit vectors, 2 − 2·cos); with none left it is NO_RESULTS and the
+    # agent / web fallback takes over. None keeps every hit
+    speculative_max_distance: float | None = float(os.getenv("SPECULATIVE_MAX_DISTANCE", "1.0"))
   
 
 
@@ -1,23 +1,25 @@
 
 from __future__ import annotations
 import os
-import google.generativeai as genai
+import sqlite3
+import threading
+import time
+import numpy as np
 from pathlib import Path
+from typing import Dict, List, Tuple
 from config import ALL_DOMAINS
 from docling.document_converter import DocumentConverter
 from dotenv import load_dotenv
-import os
+from utils import _embed, get_chroma_collections
+from embedding_backends import get_backend
+from llm_providers import MODEL_GEN, get_llm
+from metrics import gauge_fn
 
 
 load_dotenv()
 
-# ─────────────────── API keys & model names ────────────────────
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")      # ← Set your own Gemini API key here
-MODEL_GEN      = "models/gemini-1.5-flash-latest"
-if not GEMINI_API_KEY:
-    raise RuntimeError("Set GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
-_LLM = genai.GenerativeModel(MODEL_GEN)
+# ─────────────────── model names ───────────────────────────────
+_LLM = get_llm(MODEL_GEN)
 
 _KEYS = list(ALL_DOMAINS.keys())      #  ["GENOMIC", "CYBERSEC"]
 
@@ -48,13 +50,214 @@ def _peek_text(pdf_path: Path, n_chars: int = 2000) -> str:
     d = DocumentConverter().convert(pdf_path).document
     return d.export_to_markdown()[:n_chars]
 
-def choose_domain(text_or_path: str | Path) -> str:
-    """Accept raw text *or* a PDF path, return domain string."""
+# ─────────────────── centroid classifier ───────────────────────
+class CentroidRouter:
+    """
+    Scores an embedding against one centroid per domain (the normalized
+    sum of every ingested chunk vector of that domain). Sums and counts
+    are persisted in SQLite and grow incrementally with each ingest, so
+    the centroids never need a full rebuild.
+
+    classify() answers only when the best domain is clear: at least two
+    domains with `min_chunks` chunks, best cosine ≥ `min_sim` and a lead
+    of ≥ `margin` over the runner-up. Otherwise it returns None and the
+    caller falls back to the LLM prompt.
+    """
+
+    def __init__(self, path: Path, model: str, margin: float = 0.04,
+                 min_sim: float = 0.25, min_chunks: int = 50, reload_s: float = 30.0):
+        self.path       = Path(path)
+        self.model      = model
+        self.margin     = margin
+        self.min_sim    = min_sim
+        self.min_chunks = min_chunks
+        self.reload_s   = reload_s
+        self._local     = threading.local()          # one sqlite connection per thread
+        self._lock      = threading.Lock()
+        self._loaded_at = 0.0
+        self._keys: List[str] = []
+        self._matrix    = np.zeros((0, 0))
+        self.counters   = {"centroid": 0, "llm": 0}
+
+    @property
+    def backend(self) -> str:
+        """Rows are keyed by the backend actually producing the vectors (EMBED_BACKEND aware)."""
+        return get_backend(self.model).name
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS domain_centroids (
+                domain  TEXT,
+                model   TEXT,
+                n       INTEGER,   -- chunks folded in
+                vec_sum BLOB,      -- float64 sum of unit-length chunk vectors
+                updated REAL,
+                PRIMARY KEY (domain, model)
+              )
+            """)
+            self._local.db = db
+        return db
+
+    # ---------------- updates -------------------------------------
+    def add(self, domain: str, vectors: List[List[float]]) -> None:
+        """Fold freshly ingested chunk vectors into `domain`'s centroid."""
+        if not len(vectors):
+            return
+        v = np.asarray(vectors, dtype=np.float64)
+        lens = np.linalg.norm(v, axis=1, keepdims=True)
+        s = (v / np.where(lens == 0, 1.0, lens)).sum(axis=0)
+        db = self._db()
+        with db:                                   # one transaction: read-modify-write
+            row = db.execute(
+                "SELECT n, vec_sum FROM domain_centroids WHERE domain=? AND model=?",
+                (domain, self.backend),
+            ).fetchone()
+            n = len(v)
+            if row is not None and len(row[1]) == s.nbytes:
+                n += row[0]
+                s += np.frombuffer(row[1], dtype=np.float64)
+            db.execute(
+                "INSERT OR REPLACE INTO domain_centroids (domain, model, n, vec_sum, updated) "
+                "VALUES (?,?,?,?,?)",
+                (domain, self.backend, n, s.tobytes(), time.time()),
+            )
+        self._loaded_at = 0.0                      # reload on next classify
+
+    def remove(self, domain: str, vectors: List[List[float]]) -> None:
+        """Take the vectors of deleted chunks back out of `domain`'s centroid."""
+        if not len(vectors):
+            return
+        v = np.asarray(vectors, dtype=np.float64)
+        lens = np.linalg.norm(v, axis=1, keepdims=True)
+        s = (v / np.where(lens == 0, 1.0, lens)).sum(axis=0)
+        db = self._db()
+        with db:
+            row = db.execute(
+                "SELECT n, vec_sum FROM domain_centroids WHERE domain=? AND model=?",
+                (domain, self.backend),
+            ).fetchone()
+            if row is None or len(row[1]) != s.nbytes:
+                return
+            n = row[0] - len(v)
+            if n <= 0:
+                db.execute("DELETE FROM domain_centroids WHERE domain=? AND model=?",
+                           (domain, self.backend))
+            else:
+                db.execute(
+                    "UPDATE domain_centroids SET n=?, vec_sum=?, updated=? WHERE domain=? AND model=?",
+                    (n, (np.frombuffer(row[1], dtype=np.float64) - s).tobytes(), time.time(),
+                     domain, self.backend),
+                )
+        self._loaded_at = 0.0
+
+    def reset(self, domain: str) -> None:
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM domain_centroids WHERE domain=? AND model=?", (domain, self.backend))
+        self._loaded_at = 0.0
+
+    # ---------------- scoring -------------------------------------
+    def _load(self) -> Tuple[List[str], np.ndarray]:
+        # other processes (ingest workers) update the table → re-read periodically
+        if time.monotonic() - self._loaded_at < self.reload_s:
+            return self._keys, self._matrix
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT domain, vec_sum FROM domain_centroids WHERE model=? AND n>=?",
+                (self.backend, self.min_chunks),
+            ).fetchall()
+            rows = [(d, np.frombuffer(b, dtype=np.float64)) for d, b in rows if d in ALL_DOMAINS]
+            if rows and len({len(v) for _, v in rows}) == 1:
+                m = np.stack([v for _, v in rows])
+                self._keys, self._matrix = [d for d, _ in rows], m / np.linalg.norm(m, axis=1, keepdims=True)
+            else:
+                self._keys, self._matrix = [], np.zeros((0, 0))
+            self._loaded_at = time.monotonic()
+        return self._keys, self._matrix
+
+    def ready(self) -> bool:
+        return len(self._load()[0]) >= 2
+
+    def classify(self, vec: List[float]) -> str | None:
+        keys, m = self._load()
+        q = np.asarray(vec, dtype=np.float64)
+        if len(keys) < 2 or q.shape[0] != m.shape[1] or not q.any():
+            return None
+        sims = m @ (q / np.linalg.norm(q))
+        second, best = np.argsort(sims)[-2:]
+        if sims[best] < self.min_sim or sims[best] - sims[second] < self.margin:
+            return None
+        return keys[best]
+
+    def count(self, how: str) -> None:
+        with self._lock:
+            self.counters[how] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            c = dict(self.counters)
+        total = c["centroid"] + c["llm"]
+        c["centroid_rate"] = c["centroid"] / total if total else 0.0
+        c["domains_ready"] = len(self._load()[0])
+        return c
+
+
+CENTROIDS = CentroidRouter(
+    Path(os.getenv("DOMAIN_CENTROIDS_PATH", "domain_centroids.sqlite3")),
+    model=os.getenv("ROUTER_EMBED_MODEL", "models/text-embedding-004"),
+    margin=float(os.getenv("ROUTER_MARGIN", "0.04")),
+    min_sim=float(os.getenv("ROUTER_MIN_SIM", "0.25")),
+    min_chunks=int(os.getenv("ROUTER_MIN_CHUNKS", "50")),
+)
+gauge_fn("rag_router", "Centroid router decisions and LLM fallbacks", CENTROIDS.stats)
+
+
+def rebuild_centroids(page: int = 1000) -> Dict[str, int]:
+    """Recompute every domain's centroid from the vectors already in Chroma."""
+    out = {}
+    for key, cfg in ALL_DOMAINS.items():
+        if cfg.embed_models["text"] != CENTROIDS.model:
+            continue
+        collection_txt, _, _ = get_chroma_collections(cfg)
+        CENTROIDS.reset(key)
+        n, offset = 0, 0
+        while True:
+            res = collection_txt.get(include=["embeddings"], limit=page, offset=offset)
+            vecs = res.get("embeddings") or []
+            if not len(vecs):
+                break
+            CENTROIDS.add(key, vecs)
+            n += len(vecs)
+            offset += page
+        out[key] = n
+    return out
+
+
+def choose_domain(text_or_path: str | Path, vec: List[float] | None = None) -> str:
+    """
+    Accept raw text *or* a PDF path, return domain string.
+    Clear cases are settled by the centroid classifier (pass `vec`, the
+    text's embedding under CENTROIDS.model, to skip embedding it here);
+    ambiguous ones go to the LLM prompt.
+    """
     if isinstance(text_or_path, (str, Path)) and Path(text_or_path).is_file():
         text = _peek_text(Path(text_or_path))
     else:
         text = str(text_or_path)[:2000]
-    rsp = _LLM.generate_content(_PROMPT.format(text)).text.strip()
+    if vec is None and CENTROIDS.ready():
+        vec = _embed([text], model=CENTROIDS.model)[0]
+    if vec is not None:
+        dom = CENTROIDS.classify(vec)
+        if dom is not None:
+            CENTROIDS.count("centroid")
+            return dom
+    CENTROIDS.count("llm")
+    rsp = _LLM.generate(_PROMPT.format(text)).strip()
     return rsp if rsp in ALL_DOMAINS else "No domain"
 
 
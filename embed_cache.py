@@ -0,0 +1,161 @@
+# embed_cache.py
+# -------------------------------------------------------------
+# Two-tier, content-addressed cache for embedding vectors.
+#   tier 1 : in-process LRU  (OrderedDict, bounded by item count)
+#   tier 2 : on-disk SQLite  (WAL mode → shared by several worker processes)
+# Keys are sha256(model ␟ task_type ␟ text), so repeated text never
+# needs another network round trip.
+# -------------------------------------------------------------
+from __future__ import annotations
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+
+class EmbeddingCache:
+    """
+    mem_items : max vectors kept in the in-process LRU
+    max_rows  : max vectors kept on disk; the least-recently-used 10 %
+                are evicted whenever the cap is exceeded
+    """
+
+    def __init__(self, path: Path, mem_items: int = 50_000, max_rows: int = 1_000_000):
+        self.path      = Path(path)
+        self.mem_items = mem_items
+        self.max_rows  = max_rows
+        self._mem: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock  = threading.Lock()
+        self._local = threading.local()          # one sqlite connection per thread
+        self._since_check = 0
+        self.counters = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    # ---------------- keys ----------------------------------------
+    @staticmethod
+    def key(model: str | None, task_type: str, text: str) -> str:
+        h = hashlib.sha256()
+        h.update(f"{model}\x1f{task_type}\x1f".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    # ---------------- sqlite helpers ------------------------------
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS embeddings (
+                key       TEXT PRIMARY KEY,
+                vec       BLOB,
+                last_used REAL
+              )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS ix_last_used ON embeddings(last_used)")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _pack(vec: Iterable[float]) -> bytes:
+        return array("f", vec).tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> List[float]:
+        a = array("f")
+        a.frombytes(blob)
+        return a.tolist()
+
+    # ---------------- LRU helpers ---------------------------------
+    def _remember(self, key: str, vec: List[float]) -> None:
+        # caller holds self._lock
+        self._mem[key] = vec
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items:
+            self._mem.popitem(last=False)
+
+    # ---------------- public API ----------------------------------
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return {key: vector} for every key found in either tier."""
+        out: Dict[str, List[float]] = {}
+        with self._lock:
+            for k in keys:
+                if k in self._mem:
+                    self._mem.move_to_end(k)
+                    out[k] = self._mem[k]
+            self.counters["mem_hits"] += len(out)
+
+        todo = [k for k in dict.fromkeys(keys) if k not in out]
+        if todo:
+            db  = self._db()
+            now = time.time()
+            for lo in range(0, len(todo), 500):          # stay under SQLite's variable limit
+                part = todo[lo:lo + 500]
+                marks = ",".join("?" * len(part))
+                rows = db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                if rows:
+                    db.execute(
+                        f"UPDATE embeddings SET last_used=? WHERE key IN ({marks})",
+                        [now, *part],
+                    )
+                for k, blob in rows:
+                    out[k] = self._unpack(blob)
+            db.commit()
+            with self._lock:
+                for k in todo:
+                    if k in out:
+                        self._remember(k, out[k])
+                        self.counters["disk_hits"] += 1
+                    else:
+                        self.counters["misses"] += 1
+        return out
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        db  = self._db()
+        db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vec, last_used) VALUES (?,?,?)",
+            [(k, self._pack(v), now) for k, v in items.items()],
+        )
+        db.commit()
+        with self._lock:
+            for k, v in items.items():
+                self._remember(k, list(v))
+            self._since_check += len(items)
+            check = self._since_check >= min(1000, max(1, self.max_rows // 10))
+            if check:
+                self._since_check = 0
+        if check:
+            self._evict()
+
+    def _evict(self) -> None:
+        db = self._db()
+        (n,) = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if n <= self.max_rows:
+            return
+        drop = n - int(self.max_rows * 0.9)
+        db.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (drop,),
+        )
+        db.commit()
+        with self._lock:
+            self.counters["evictions"] += drop
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            c = dict(self.counters)
+            c["mem_items"] = len(self._mem)
+        lookups = c["mem_hits"] + c["disk_hits"] + c["misses"]
+        c["hit_rate"] = (c["mem_hits"] + c["disk_hits"]) / lookups if lookups else 0.0
+        return c
@@ -0,0 +1,161 @@
+# embedding_backends.py
+# -------------------------------------------------------------
+# Embedding backends behind utils._embed, picked by the model string in
+# DomainConfig.embed_models:
+#   "models/…"            → Gemini (genai.embed_content), network
+#   "local:<st-model>"    → sentence-transformers on CPU, batched over a
+#                           small thread pool (optional dependency)
+#   "hash:<dim>"          → deterministic feature hashing, no model at all
+#                           (tests / offline benchmarks)
+# EMBED_BACKEND=<model string> overrides every domain at once.
+# Each backend reports `dim`, which get_chroma_collections checks against
+# the dimension a collection was created with.
+# -------------------------------------------------------------
+from __future__ import annotations
+import hashlib
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from bm25_index import tokenize
+from llm_providers import configure_gemini
+
+
+class EmbeddingBackend(ABC):
+    """name: stable identifier (cache keys, collection metadata); dim: vector size."""
+    name: str = ""
+
+    @property
+    @abstractmethod
+    def dim(self) -> int:
+        ...
+
+    @abstractmethod
+    def embed(self, texts: List[str], task_type: str = "retrieval_document") -> List[List[float]]:
+        ...
+
+
+class GeminiBackend(EmbeddingBackend):
+    _KNOWN_DIMS = {"models/text-embedding-004": 768, "models/embedding-001": 768}
+    _MAX_BATCH  = 100                              # embed_content's per-request limit
+
+    def __init__(self, model: str):
+        self.name  = model
+        self._dim  = self._KNOWN_DIMS.get(model)
+
+    @property
+    def dim(self) -> int:
+        if self._dim is None:                      # unknown model → ask once
+            self._dim = len(self.embed(["dimension probe"])[0])
+        return self._dim
+
+    def embed(self, texts, task_type="retrieval_document"):
+        out: List[List[float]] = []
+        for lo in range(0, len(texts), self._MAX_BATCH):
+            out.extend(configure_gemini().embed_content(
+                model=self.name,
+                content=texts[lo:lo + self._MAX_BATCH],
+                task_type=task_type
+            )["embedding"])
+        return out
+
+
+class LocalBackend(EmbeddingBackend):
+    """
+    sentence-transformers model on CPU; texts are split into `batch_size`
+    slices encoded on `threads` worker threads (torch releases the GIL).
+    The model loads on first use.
+    """
+
+    def __init__(self, model: str, batch_size: int = 32, threads: int = 2):
+        self.name       = f"local:{model}"
+        self.model_name = model
+        self.batch_size = batch_size
+        self._pool      = ThreadPoolExecutor(max_workers=max(1, threads),
+                                             thread_name_prefix="embed-local")
+        self._model     = None
+        self._lock      = threading.Lock()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError(
+                            "local embeddings need `pip install sentence-transformers`") from e
+                    self._model = SentenceTransformer(self.model_name, device="cpu")
+        return self._model
+
+    @property
+    def dim(self) -> int:
+        return self._get_model().get_sentence_embedding_dimension()
+
+    def embed(self, texts, task_type="retrieval_document"):
+        model = self._get_model()
+        parts = [texts[lo:lo + self.batch_size] for lo in range(0, len(texts), self.batch_size)]
+        encode = lambda part: model.encode(part, batch_size=self.batch_size,
+                                           normalize_embeddings=True).tolist()
+        return [v for vecs in self._pool.map(encode, parts) for v in vecs]
+
+
+class HashingBackend(EmbeddingBackend):
+    """
+    Signed feature hashing of tokens into `dim` buckets, L2-normalized.
+    `latency_s` is slept once per call to imitate a remote model in benchmarks.
+    """
+
+    def __init__(self, dim: int = 256, latency_s: float = 0.0):
+        self.name = f"hash:{dim}"
+        self._dim = dim
+        self.latency_s = latency_s
+
+    @property
+    def dim(self) -> int:
+        return self._dim
+
+    def _one(self, text: str) -> List[float]:
+        vec = [0.0] * self._dim
+        for tok in tokenize(text):
+            h = int.from_bytes(hashlib.blake2b(tok.encode("utf-8"), digest_size=8).digest(), "little")
+            vec[h % self._dim] += 1.0 if (h >> 63) & 1 else -1.0
+        n = math.sqrt(sum(x * x for x in vec)) or 1.0
+        return [x / n for x in vec]
+
+    def embed(self, texts, task_type="retrieval_document"):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return [self._one(t) for t in texts]
+
+
+# ─────────────────── registry ───────────────────────────────────
+_LOCK = threading.Lock()
+_BACKENDS: Dict[str, EmbeddingBackend] = {}
+
+
+def _build(model: str) -> EmbeddingBackend:
+    if model.startswith("local:"):
+        return LocalBackend(model[len("local:"):],
+                            batch_size=int(os.getenv("LOCAL_EMBED_BATCH", "32")),
+                            threads=int(os.getenv("LOCAL_EMBED_THREADS", "2")))
+    if model.startswith("hash:"):
+        return HashingBackend(int(model[len("hash:"):] or 256),
+                              latency_s=float(os.getenv("HASH_EMBED_LATENCY_MS", "0")) / 1000)
+    return GeminiBackend(model)
+
+
+def get_backend(model: str | None) -> EmbeddingBackend:
+    """Backend for a DomainConfig.embed_models entry (EMBED_BACKEND wins if set)."""
+    model = os.getenv("EMBED_BACKEND") or model or "models/text-embedding-004"
+    backend = _BACKENDS.get(model)
+    if backend is None:
+        with _LOCK:
+            backend = _BACKENDS.get(model)
+            if backend is None:
+                backend = _BACKENDS[model] = _build(model)
+    return backend
@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+# -------------------------------------------------------------
+#     gunicorn -c gunicorn.conf.py asgi:app
+#
+#   • uvicorn workers: each process runs one event loop (see asgi.py)
+#   • preload_app – Flask, LangChain, Chroma client code and the prompt
+#     modules are imported once in the master and shared copy-on-write;
+#     per-process state (SQLite connections, Gemini clients, ingest
+#     workers) is opened lazily or at ASGI startup, i.e. after the fork
+#   • timeout is generous: a full-document ingest or a long agent run
+#     must not get the worker killed
+# -------------------------------------------------------------
+import os
+
+bind             = os.getenv("BIND", "127.0.0.1:5000")
+workers          = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class     = "uvicorn.workers.UvicornWorker"
+preload_app      = True
+timeout          = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive        = 5
+accesslog        = "-"
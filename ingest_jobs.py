@@ -0,0 +1,290 @@
+# ingest_jobs.py
+# -------------------------------------------------------------
+# Durable ingestion job queue for the web app.
+#   • jobs live in SQLite (table `ingest_jobs` in users.db) → they survive
+#     a restart; jobs interrupted by stop() are re-queued at once, jobs whose
+#     process died are re-queued once their heartbeat is stale, and both
+#     resume through the ingest manifest
+#   • a fixed pool of worker threads per process, and `max_running` jobs
+#     across all processes sharing the database, cap concurrent Docling
+#     conversions
+#   • fair scheduling: at most `per_user` running jobs per user, and the
+#     user served least recently goes first
+#   • cancel is a row update: whichever process runs the job sees it on
+#     its next janitor tick and sets the job's stop flag; a cancelled job
+#     still counts against `per_user` (and is not purged) until it stops
+#   • finished entries are purged after `ttl_s`
+# -------------------------------------------------------------
+from __future__ import annotations
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict
+
+from logging_config import logger
+
+
+class IngestJobQueue:
+    """
+    run_fn(job, stop_event) performs one job; `job` is the row as a dict.
+    Raising marks the job failed; returning normally marks it complete
+    (unless it was cancelled meanwhile).
+    """
+
+    def __init__(self, db_path: Path, run_fn: Callable[[Dict, threading.Event], None],
+                 workers: int = 2, per_user: int = 1, ttl_s: float = 86_400,
+                 tick_s: float = 5.0, stale_s: float = 60.0, max_running: int | None = None):
+        self.db_path  = Path(db_path)
+        self.run_fn   = run_fn
+        self.workers  = max(1, workers)
+        self.per_user = max(1, per_user)
+        self.max_running = max(1, max_running or self.workers)
+        self.ttl_s    = ttl_s
+        self.tick_s   = tick_s
+        self.stale_s  = stale_s
+        self._wake    = threading.Condition()
+        self._stops: Dict[str, threading.Event] = {}      # job_id → stop flag (running here)
+        self._lock    = threading.Lock()
+        self._closing = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._init_db()
+
+    # ---------------- sqlite helpers ------------------------------
+    @contextmanager
+    def _db(self):
+        """Short-lived autocommit connection (threads / processes never share one)."""
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _init_db(self) -> None:
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id         TEXT PRIMARY KEY,
+                user_id    INTEGER,
+                file_path  TEXT,
+                status     TEXT,     -- queued / running / complete / cancelled / failed
+                error      TEXT,
+                progress   TEXT,     -- JSON, written by the running job
+                created    REAL,
+                started    REAL,
+                finished   REAL,
+                heartbeat  REAL
+              )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON ingest_jobs(status, created)")
+
+    # ---------------- public API ----------------------------------
+    def submit(self, user_id: int, file_path: str) -> str:
+        job_id = secrets.token_hex(8)
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO ingest_jobs (id,user_id,file_path,status,created) VALUES (?,?,?,?,?)",
+                (job_id, user_id, file_path, "queued", time.time()),
+            )
+        with self._wake:
+            self._wake.notify()
+        return job_id
+
+    def get(self, job_id: str) -> Dict | None:
+        with self._db() as db:
+            row = db.execute("SELECT * FROM ingest_jobs WHERE id=?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update_progress(self, job_id: str, snapshot: Dict) -> str | None:
+        """
+        Publish the running job's progress counters (see
+        ingest_pipeline.IngestProgress) and return the row's status, so
+        the job notices a cancel at its next progress step.
+        """
+        with self._db() as db:
+            db.execute("UPDATE ingest_jobs SET progress=?, heartbeat=? WHERE id=?",
+                       (json.dumps(snapshot), time.time(), job_id))
+            row = db.execute("SELECT status FROM ingest_jobs WHERE id=?", (job_id,)).fetchone()
+        return row["status"] if row else None
+
+    def cancel(self, job_id: str) -> bool:
+        with self._db() as db:
+            cur = db.execute(
+                "UPDATE ingest_jobs SET status='cancelled', finished=? "
+                "WHERE id=? AND status IN ('queued','running')",
+                (time.time(), job_id),
+            )
+        self._signal_stop([job_id])                   # other processes: see _janitor
+        return cur.rowcount > 0
+
+    def _signal_stop(self, job_ids) -> None:
+        """Set the stop flag of those jobs that run in this process."""
+        with self._lock:
+            for job_id in job_ids:
+                stop = self._stops.get(job_id)
+                if stop is not None:
+                    stop.set()
+
+    # ---------------- lifecycle -----------------------------------
+    def start(self) -> None:
+        if self._threads:
+            return
+        self._requeue_stale()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, daemon=True, name=f"ingest-job-{i}")
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._janitor, daemon=True, name="ingest-job-janitor")
+        t.start()
+        self._threads.append(t)
+
+    def stop(self) -> None:
+        self._closing.set()
+        with self._lock:
+            for ev in self._stops.values():
+                ev.set()
+        with self._wake:
+            self._wake.notify_all()
+
+    # ---------------- scheduling ----------------------------------
+    def _claim(self) -> Dict | None:
+        """Atomically move the fairest queued job to running (safe across processes)."""
+        with self._db() as db:
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                live = time.time() - self.stale_s       # cancelled but maybe not stopped yet
+                busy = db.execute(
+                    "SELECT COUNT(*) FROM ingest_jobs WHERE status='running' "
+                    "OR (status='cancelled' AND heartbeat >= ?)", (live,)).fetchone()[0]
+                row = None if busy >= self.max_running else db.execute("""
+                  SELECT j.* FROM ingest_jobs j
+                  WHERE j.status='queued'
+                    AND (SELECT COUNT(*) FROM ingest_jobs r
+                         WHERE r.user_id=j.user_id
+                           AND (r.status='running'
+                                OR (r.status='cancelled' AND r.heartbeat >= ?))) < ?
+                  ORDER BY (SELECT COALESCE(MAX(s.started), 0) FROM ingest_jobs s
+                            WHERE s.user_id=j.user_id),
+                           j.created
+                  LIMIT 1
+                """, (live, self.per_user)).fetchone()
+                if row is not None:
+                    now = time.time()
+                    db.execute(
+                        "UPDATE ingest_jobs SET status='running', started=?, heartbeat=? WHERE id=?",
+                        (now, now, row["id"]),
+                    )
+                db.execute("COMMIT")
+            except sqlite3.OperationalError:              # busy – retry on the next tick
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                return None
+            return dict(row) if row else None
+
+    def _finish(self, job_id: str, status: str, error: str | None = None) -> None:
+        with self._db() as db:
+            db.execute(
+                "UPDATE ingest_jobs SET status=?, error=?, finished=? "
+                "WHERE id=? AND status='running'",              # keep a 'cancelled'
+                (status, error, time.time(), job_id),
+            )
+            # a cancelled job that really stopped no longer holds its user's slot
+            db.execute("UPDATE ingest_jobs SET heartbeat=NULL WHERE id=? AND status='cancelled'",
+                       (job_id,))
+
+    def _requeue(self, job_id: str) -> None:
+        """Hand a job interrupted by stop() back to the queue; it resumes via the manifest."""
+        with self._db() as db:
+            db.execute(
+                "UPDATE ingest_jobs SET status='queued', started=NULL, heartbeat=NULL "
+                "WHERE id=? AND status='running'",
+                (job_id,),
+            )
+        logger.info(f"Ingest job {job_id} re-queued at shutdown")
+
+    def _work(self) -> None:
+        while not self._closing.is_set():
+            job = self._claim()
+            if job is None:
+                with self._wake:
+                    self._wake.wait(timeout=self.tick_s)
+                continue
+            stop = threading.Event()
+            with self._lock:
+                self._stops[job["id"]] = stop
+            try:
+                self.run_fn(job, stop)
+                if self._closing.is_set():        # stopped by shutdown, not finished
+                    self._requeue(job["id"])
+                else:
+                    self._finish(job["id"], "complete")
+            except Exception as e:
+                if self._closing.is_set():
+                    self._requeue(job["id"])
+                else:
+                    logger.exception(f"Ingest job {job['id']} failed")
+                    self._finish(job["id"], "failed", str(e))
+            finally:
+                with self._lock:
+                    self._stops.pop(job["id"], None)
+            with self._wake:
+                self._wake.notify()               # a per-user slot just freed up
+
+    # ---------------- housekeeping --------------------------------
+    def _requeue_stale(self) -> None:
+        """
+        Running jobs nobody has heart-beaten for `stale_s` (their process
+        died or restarted) go back to the queue.
+        """
+        cutoff = time.time() - self.stale_s
+        with self._lock:
+            mine = list(self._stops)
+        marks = ",".join("?" * len(mine))
+        with self._db() as db:
+            db.execute(
+                "UPDATE ingest_jobs SET status='queued', started=NULL "
+                "WHERE status='running' AND COALESCE(heartbeat, 0) < ?"
+                + (f" AND id NOT IN ({marks})" if mine else ""),
+                (cutoff, *mine),
+            )
+
+    def _janitor(self) -> None:
+        while not self._closing.wait(self.tick_s):
+            try:
+                now = time.time()
+                with self._lock:
+                    mine = list(self._stops)
+                with self._db() as db:
+                    if mine:
+                        marks = ",".join("?" * len(mine))
+                        db.execute(f"UPDATE ingest_jobs SET heartbeat=? WHERE id IN ({marks})",
+                                   (now, *mine))
+                        # cancels may have been written by another process
+                        cancelled = [r["id"] for r in db.execute(
+                            f"SELECT id FROM ingest_jobs WHERE status='cancelled' AND id IN ({marks})",
+                            mine)]
+                        self._signal_stop(cancelled)
+                    db.execute(                       # a fresh heartbeat = still running somewhere
+                        "DELETE FROM ingest_jobs WHERE status IN ('complete','cancelled','failed') "
+                        "AND finished < ? AND COALESCE(heartbeat, 0) < ?",
+                        (now - self.ttl_s, now - self.stale_s),
+                    )
+                self._requeue_stale()
+            except sqlite3.OperationalError:
+                pass                                  # busy – try again next tick
+
+
+def queue_from_env(db_path: Path, run_fn) -> IngestJobQueue:
+    return IngestJobQueue(
+        db_path, run_fn,
+        workers=int(os.getenv("INGEST_JOB_WORKERS", "2")),
+        per_user=int(os.getenv("INGEST_JOBS_PER_USER", "1")),
+        ttl_s=float(os.getenv("INGEST_JOB_TTL", "86400")),
+        max_running=int(os.getenv("INGEST_JOBS_MAX", "0")) or None,
+    )
@@ -0,0 +1,133 @@
+# ingest_manifest.py
+# -------------------------------------------------------------
+# Content-hash manifest for idempotent, resumable ingestion.
+#   • one row per (PDF sha256, user_id)
+#   • per-stage completion markers ("text", "media", "done")
+#   • cached routing + metadata, so a resumed PDF skips those LLM calls
+#   • the page → chunk-range index used to link figures / tables
+# IDs handed to Chroma / the object store are derived from the same
+# hash (uuid5), so re-running a PDF overwrites instead of duplicating.
+# -------------------------------------------------------------
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+_ID_NAMESPACE = uuid.UUID("6f1c64d4-8a0e-4c55-9d0b-2f6a4b0f5e21")
+
+
+def file_sha256(path: Path, bufsize: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(bufsize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def stable_id(doc_hash: str, user_id: int, kind: str, offset) -> str:
+    """Deterministic UUID for one chunk / figure / table of a document."""
+    return str(uuid.uuid5(_ID_NAMESPACE, f"{user_id}:{doc_hash}:{kind}:{offset}"))
+
+
+class IngestManifest:
+    def __init__(self, path: Path):
+        self.path   = Path(path)
+        self._local = threading.local()          # one sqlite connection per thread
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS documents (
+                doc_hash  TEXT,
+                user_id   INTEGER,
+                path      TEXT,
+                domain    TEXT,
+                meta      TEXT,     -- JSON, flattened metadata
+                stages    TEXT,     -- JSON list of completed stages
+                updated   REAL,
+                page_index TEXT,    -- JSON {page: [first_chunk, last_chunk]}
+                PRIMARY KEY (doc_hash, user_id)
+              )
+            """)
+            try:                                    # manifests created before page_index
+                db.execute("ALTER TABLE documents ADD COLUMN page_index TEXT")
+            except sqlite3.OperationalError:
+                pass
+            self._local.db = db
+        return db
+
+    def get(self, doc_hash: str, user_id: int) -> Dict | None:
+        row = self._db().execute(
+            "SELECT path, domain, meta, stages, updated, page_index FROM documents "
+            "WHERE doc_hash=? AND user_id=?", (doc_hash, user_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "domain": row[1],
+            "meta": json.loads(row[2]) if row[2] else None,
+            "stages": json.loads(row[3] or "[]"),
+            "updated": row[4],
+            "page_index": {int(k): tuple(v) for k, v in json.loads(row[5]).items()} if row[5] else None,
+        }
+
+    def record(self, doc_hash: str, user_id: int, path: str,
+               domain: str | None = None, meta: Dict | None = None,
+               page_index: Dict[int, tuple] | None = None) -> None:
+        """Create the row (or refresh path / routing / metadata / page index) without touching stages."""
+        db = self._db()
+        db.execute(
+            "INSERT INTO documents (doc_hash, user_id, path, stages, updated) VALUES (?,?,?,?,?) "
+            "ON CONFLICT(doc_hash, user_id) DO UPDATE SET path=excluded.path, updated=excluded.updated",
+            (doc_hash, user_id, path, "[]", time.time()),
+        )
+        if domain is not None or meta is not None:
+            db.execute(
+                "UPDATE documents SET domain=COALESCE(?, domain), meta=COALESCE(?, meta) "
+                "WHERE doc_hash=? AND user_id=?",
+                (domain, json.dumps(meta, ensure_ascii=False) if meta is not None else None,
+                 doc_hash, user_id),
+            )
+        if page_index is not None:
+            db.execute(
+                "UPDATE documents SET page_index=? WHERE doc_hash=? AND user_id=?",
+                (json.dumps(page_index), doc_hash, user_id),
+            )
+        db.commit()
+
+    def mark_stage(self, doc_hash: str, user_id: int, stage: str) -> None:
+        db = self._db()
+        with db:                                   # one transaction: read-modify-write
+            row = db.execute(
+                "SELECT stages FROM documents WHERE doc_hash=? AND user_id=?", (doc_hash, user_id)
+            ).fetchone()
+            stages: List[str] = json.loads(row[0] or "[]") if row else []
+            if stage not in stages:
+                stages.append(stage)
+            db.execute(
+                "UPDATE documents SET stages=?, updated=? WHERE doc_hash=? AND user_id=?",
+                (json.dumps(stages), time.time(), doc_hash, user_id),
+            )
+
+    def has_stage(self, doc_hash: str, user_id: int, stage: str) -> bool:
+        entry = self.get(doc_hash, user_id)
+        return bool(entry and stage in entry["stages"])
+
+    def forget(self, doc_hash: str, user_id: int) -> None:
+        db = self._db()
+        db.execute("DELETE FROM documents WHERE doc_hash=? AND user_id=?", (doc_hash, user_id))
+        db.commit()
+
+
+MANIFEST = IngestManifest(Path(os.getenv("INGEST_MANIFEST_PATH", "ingest_manifest.sqlite3")))
@@ -0,0 +1,246 @@
+# ingest_pipeline.py
+# -------------------------------------------------------------
+# Small staged pipeline: each stage owns a bounded inbox queue and a
+# fixed number of worker threads, so a slow stage back-pressures the
+# ones before it instead of letting work pile up in memory.
+# Used by rag_scipdf_core.ingest_documents (convert → prepare →
+# store_text → summarize → store_media).
+# -------------------------------------------------------------
+from __future__ import annotations
+import contextvars
+import heapq
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from threading import Event
+from typing import Any, Callable, Dict, Iterable, List
+
+from metrics import span
+
+_DONE = object()          # end-of-stream marker, one per stage worker
+
+
+@dataclass
+class Stage:
+    """
+    name    : label used in metrics / logs
+    fn      : item → item for the next stage (None drops the item)
+    workers : threads running `fn`
+    maxsize : capacity of this stage's inbox queue
+    ordered : process items strictly in input order (forces workers=1)
+    """
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    maxsize: int = 2
+    ordered: bool = False
+
+    inbox: queue.Queue = field(init=False, repr=False)
+    processed: int   = field(default=0, init=False)
+    busy_s: float    = field(default=0.0, init=False)
+    max_depth: int   = field(default=0, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _finished: int   = field(default=0, init=False)
+
+    def __post_init__(self):
+        if self.ordered:
+            self.workers = 1
+        self.workers = max(1, self.workers)
+        self.inbox = queue.Queue(maxsize=max(1, self.maxsize))
+
+    def put(self, msg) -> None:
+        self.inbox.put(msg)
+        depth = self.inbox.qsize()
+        if depth > self.max_depth:
+            with self._lock:
+                self.max_depth = max(self.max_depth, depth)
+
+
+class Pipeline:
+    """
+    Run `items` through `stages`. Items travel as (seq, value); a stage
+    returning None turns the value into None, which later stages pass
+    through untouched so ordered stages never wait on a missing seq.
+    `run` returns the final values in input order.
+    """
+
+    def __init__(self, stages: List[Stage], stop_event: Event | None = None):
+        self.stages     = stages
+        self.stop_event = stop_event or Event()
+        self._abort     = Event()
+        self._error: BaseException | None = None
+        self._results: Dict[int, Any] = {}
+        self._res_lock  = threading.Lock()
+
+    # ---------------- metrics -------------------------------------
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        """Per-stage queue depth (now / max), items processed and busy time."""
+        return {
+            st.name: {
+                "workers": st.workers,
+                "queue_depth": st.inbox.qsize(),
+                "queue_max": st.max_depth,
+                "processed": st.processed,
+                "busy_s": round(st.busy_s, 3),
+            }
+            for st in self.stages
+        }
+
+    # ---------------- workers -------------------------------------
+    def _halted(self) -> bool:
+        return self.stop_event.is_set() or self._abort.is_set()
+
+    def _emit(self, idx: int, seq: int, value) -> None:
+        if idx + 1 < len(self.stages):
+            self.stages[idx + 1].put((seq, value))
+        else:
+            with self._res_lock:
+                self._results[seq] = value
+
+    def _apply(self, idx: int, st: Stage, seq: int, value) -> None:
+        if value is not None and not self._halted():
+            t0 = time.perf_counter()
+            try:
+                with span(f"ingest.{st.name}"):
+                    value = st.fn(value)
+            except BaseException as e:          # surface in run(), stop the rest
+                if self._error is None:
+                    self._error = e
+                self._abort.set()
+                value = None
+            with st._lock:
+                st.processed += 1
+                st.busy_s    += time.perf_counter() - t0
+        else:
+            value = None
+        self._emit(idx, seq, value)
+
+    def _worker(self, idx: int) -> None:
+        st = self.stages[idx]
+        heap: list = []
+        next_seq = 0
+        while True:
+            msg = st.inbox.get()
+            if msg is _DONE:
+                break
+            if not st.ordered:
+                self._apply(idx, st, *msg)
+                continue
+            heapq.heappush(heap, msg)
+            while heap and heap[0][0] == next_seq:
+                seq, value = heapq.heappop(heap)
+                self._apply(idx, st, seq, value)
+                next_seq += 1
+
+        # last worker of this stage closes the next one
+        with st._lock:
+            st._finished += 1
+            last = st._finished == st.workers
+        if last and idx + 1 < len(self.stages):
+            nxt = self.stages[idx + 1]
+            for _ in range(nxt.workers):
+                nxt.put(_DONE)
+
+    # ---------------- driver --------------------------------------
+    def run(self, items: Iterable) -> List[Any]:
+        # every worker runs in its own copy of the caller's context, so
+        # request-scoped state (accounting ledger) follows the work
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._worker, i),
+                             daemon=True, name=f"ingest-{st.name}-{w}")
+            for i, st in enumerate(self.stages)
+            for w in range(st.workers)
+        ]
+        for t in threads:
+            t.start()
+
+        first = self.stages[0]
+        n = 0
+        for item in items:
+            if self._halted():
+                break
+            first.put((n, item))
+            n += 1
+        for _ in range(first.workers):
+            first.put(_DONE)
+
+        for t in threads:
+            t.join()
+        if self._error is not None:
+            raise self._error
+        return [self._results.get(i) for i in range(n)]
+
+
+class IngestCancelled(Exception):
+    """Raised at a cancellation checkpoint once the stop flag is set."""
+
+
+def checkpoint(stop_event: Event | None) -> None:
+    if stop_event is not None and stop_event.is_set():
+        raise IngestCancelled()
+
+
+class IngestProgress:
+    """
+    Thread-safe ingestion counters. `publish(snapshot)` is called at most
+    every `min_interval` seconds (plus once on `flush`), e.g. to write
+    the snapshot into the job record polled by /ingest/status.
+    """
+
+    FIELDS = (
+        "pdfs_total", "pdfs_converted", "pdfs_prepared", "pdfs_done",
+        "pages_converted",
+        "chunks_total", "chunks_embedded",
+        "figures_total", "figures_summarized",
+        "tables_total", "tables_summarized",
+    )
+
+    def __init__(self, publish: Callable[[Dict], None] | None = None,
+                 min_interval: float = 1.0):
+        self.publish      = publish
+        self.min_interval = min_interval
+        self.counts       = dict.fromkeys(self.FIELDS, 0)
+        self.t0           = time.perf_counter()
+        self._last_pub    = 0.0
+        self._lock        = threading.Lock()
+
+    def add(self, **deltas: int) -> None:
+        with self._lock:
+            for k, v in deltas.items():
+                self.counts[k] += v
+            now = time.perf_counter()
+            due = self.publish is not None and now - self._last_pub >= self.min_interval
+            if due:
+                self._last_pub = now
+        if due:
+            self._publish()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            c = dict(self.counts)
+        # per-item work of the PDFs prepared so far, scaled by how many
+        # PDFs have been prepared out of the total
+        units_total = c["chunks_total"] + c["figures_total"] + c["tables_total"]
+        units_done  = c["chunks_embedded"] + c["figures_summarized"] + c["tables_summarized"]
+        if c["pdfs_total"]:
+            per_pdf  = (units_done / units_total) if units_total else 0.0
+            fraction = max(c["pdfs_done"],
+                           per_pdf * c["pdfs_prepared"]) / c["pdfs_total"]
+        else:
+            fraction = 0.0
+        elapsed = time.perf_counter() - self.t0
+        c["fraction"]  = round(min(fraction, 1.0), 4)
+        c["elapsed_s"] = round(elapsed, 1)
+        c["eta_s"]     = round(elapsed * (1 - fraction) / fraction, 1) if fraction > 0 else None
+        return c
+
+    def flush(self) -> None:
+        if self.publish is not None:
+            self._publish()
+
+    def _publish(self) -> None:
+        try:
+            self.publish(self.snapshot())
+        except Exception:
+            pass                      # progress reporting must never break ingestion
@@ -0,0 +1,250 @@
+# llm_providers.py
+# -------------------------------------------------------------
+# One place for every text-generation call in the app.
+#   LLM_PROVIDER=gemini (default) → google.generativeai, configured once
+#   LLM_PROVIDER=http             → POST {LLM_BASE_URL}/v1/generate, e.g.
+#                                   llm_stub_server.py for offline load tests
+# get_llm(model)        → provider with .generate(prompt) -> str and
+#                         .generate_stream(prompt) -> iterator of text deltas
+#                         (prompt: str, or a Gemini-style parts list with
+#                          {"mime_type", "data"} image dicts)
+# get_chat_model(model) → LangChain chat model / LLM for the ReAct agent
+#                         and tools, backed by the same provider choice
+# Every call is recorded in accounting.py (tokens, bytes, wall time).
+# -------------------------------------------------------------
+from __future__ import annotations
+import base64
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Tuple
+
+from dotenv import load_dotenv
+
+from accounting import record_llm
+
+load_dotenv()
+
+MODEL_GEN = "models/gemini-1.5-flash-latest"
+
+_CONFIGURED = False
+_CONF_LOCK  = threading.Lock()
+
+
+def configure_gemini():
+    """genai.configure exactly once per process; returns the genai module."""
+    global _CONFIGURED
+    import google.generativeai as genai
+    if not _CONFIGURED:
+        with _CONF_LOCK:
+            if not _CONFIGURED:
+                api_key = os.getenv("GEMINI_API_KEY")      # ← Set your own Gemini API key here
+                if not api_key:
+                    raise RuntimeError("Set GEMINI_API_KEY")
+                genai.configure(api_key=api_key)
+                _CONFIGURED = True
+    return genai
+
+
+def provider_name() -> str:
+    return os.getenv("LLM_PROVIDER", "gemini").lower()
+
+
+class LLMProvider(ABC):
+    name: str = ""
+
+    def generate(self, prompt) -> str:
+        t0 = time.perf_counter()
+        text, (in_tokens, out_tokens) = self._generate(prompt)
+        record_llm(prompt, text, time.perf_counter() - t0, in_tokens, out_tokens)
+        return text
+
+    @abstractmethod
+    def _generate(self, prompt) -> Tuple[str, Tuple[int | None, int | None]]:
+        """(text, (input tokens, output tokens)); None where the backend does not say."""
+
+    def generate_stream(self, prompt) -> Iterator[str]:
+        """Yield the reply in pieces as the backend produces them."""
+        t0 = time.perf_counter()
+        usage: list = [None, None]
+        pieces: List[str] = []
+        try:
+            for piece in self._stream(prompt, usage):
+                pieces.append(piece)
+                yield piece
+        finally:                                 # also when the consumer hangs up
+            record_llm(prompt, "".join(pieces), time.perf_counter() - t0, usage[0], usage[1])
+
+    def _stream(self, prompt, usage: list) -> Iterator[str]:
+        """Text deltas; fills usage[0] / usage[1] with token counts if known."""
+        text, (usage[0], usage[1]) = self._generate(prompt)
+        yield text
+
+
+class GeminiProvider(LLMProvider):
+    def __init__(self, model: str):
+        self.name   = model
+        self._model = None
+
+    def _generate(self, prompt):
+        if self._model is None:
+            self._model = configure_gemini().GenerativeModel(self.name)
+        rsp = self._model.generate_content(prompt)
+        um = getattr(rsp, "usage_metadata", None)
+        return rsp.text, (getattr(um, "prompt_token_count", None),
+                          getattr(um, "candidates_token_count", None))
+
+    def _stream(self, prompt, usage):
+        if self._model is None:
+            self._model = configure_gemini().GenerativeModel(self.name)
+        rsp = self._model.generate_content(prompt, stream=True)
+        for chunk in rsp:
+            if chunk.parts:
+                yield chunk.text
+        um = getattr(rsp, "usage_metadata", None)
+        usage[0] = getattr(um, "prompt_token_count", None)
+        usage[1] = getattr(um, "candidates_token_count", None)
+
+
+class HTTPProvider(LLMProvider):
+    """
+    Minimal JSON protocol:
+      POST /v1/generate {"model", "prompt": [parts]} → {"text": "...", "usage": {...}}
+    where each part is a string or {"mime_type", "data": base64}; the
+    optional usage carries "input_tokens" / "output_tokens".
+    With "stream": true the reply is JSON lines, {"text": delta} … and a
+    last {"usage": {...}}.
+    """
+
+    def __init__(self, model: str, base_url: str, timeout: float = 120.0):
+        self.name     = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout  = timeout
+
+    @staticmethod
+    def _parts(prompt) -> List:
+        parts = prompt if isinstance(prompt, list) else [prompt]
+        return [
+            {"mime_type": p["mime_type"], "data": base64.b64encode(p["data"]).decode("ascii")}
+            if isinstance(p, dict) else str(p)
+            for p in parts
+        ]
+
+    def _request(self, prompt, stream: bool = False):
+        payload = {"model": self.name, "prompt": self._parts(prompt)}
+        if stream:
+            payload["stream"] = True
+        req = urllib.request.Request(f"{self.base_url}/v1/generate",
+                                     data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(req, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"LLM server returned {e.code}: {e.read()[:200]!r}") from e
+
+    def _generate(self, prompt):
+        with self._request(prompt) as rsp:
+            out = json.loads(rsp.read())
+        usage = out.get("usage") or {}
+        return out["text"], (usage.get("input_tokens"), usage.get("output_tokens"))
+
+    def _stream(self, prompt, usage):
+        with self._request(prompt, stream=True) as rsp:
+            for line in rsp:
+                if not line.strip():
+                    continue
+                msg = json.loads(line)
+                if "error" in msg:
+                    raise RuntimeError(f"LLM server stream failed: {msg['error']}")
+                if msg.get("text"):
+                    yield msg["text"]
+                if "usage" in msg:
+                    usage[0] = msg["usage"].get("input_tokens")
+                    usage[1] = msg["usage"].get("output_tokens")
+
+
+# ─────────────────── registry ───────────────────────────────────
+_LOCK = threading.Lock()
+_PROVIDERS: Dict[tuple, LLMProvider] = {}
+
+
+def get_llm(model: str = MODEL_GEN) -> LLMProvider:
+    kind = provider_name()
+    key  = (kind, model)
+    llm  = _PROVIDERS.get(key)
+    if llm is None:
+        with _LOCK:
+            llm = _PROVIDERS.get(key)
+            if llm is None:
+                if kind == "http":
+                    llm = HTTPProvider(model, os.getenv("LLM_BASE_URL", "http://127.0.0.1:8700"),
+                                       timeout=float(os.getenv("LLM_TIMEOUT", "120")))
+                elif kind == "gemini":
+                    llm = GeminiProvider(model)
+                else:
+                    raise ValueError(f"Unknown LLM_PROVIDER {kind!r}")
+                _PROVIDERS[key] = llm
+    return llm
+
+
+def _usage_callback():
+    """LangChain handler accounting ChatGoogleGenerativeAI calls (they bypass get_llm)."""
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class UsageCallback(BaseCallbackHandler):
+        def __init__(self):
+            self._open: Dict = {}                   # run_id → (t0, prompt text)
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            prompt = "\n".join(str(m.content) for batch in messages for m in batch)
+            self._open[run_id] = (time.perf_counter(), prompt)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            t0, prompt = self._open.pop(run_id, (time.perf_counter(), ""))
+            gens = [g for batch in response.generations for g in batch]
+            usage = next((g.message.usage_metadata for g in gens
+                          if getattr(getattr(g, "message", None), "usage_metadata", None)), {})
+            record_llm(prompt, "".join(g.text for g in gens), time.perf_counter() - t0,
+                       usage.get("input_tokens"), usage.get("output_tokens"))
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._open.pop(run_id, None)
+
+    return UsageCallback()
+
+
+def get_chat_model(model: str = MODEL_GEN, temperature: float = 0, callbacks=None):
+    """LangChain model for the agent / tools on the configured provider."""
+    if provider_name() == "gemini":
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        configure_gemini()
+        return ChatGoogleGenerativeAI(
+            model=model,
+            temperature=temperature,
+            google_api_key=os.getenv("GEMINI_API_KEY"),
+            callbacks=list(callbacks or []) + [_usage_callback()],
+        )
+
+    from langchain_core.language_models.llms import LLM
+
+    class ProviderLLM(LLM):
+        """LangChain LLM delegating to an llm_providers provider."""
+        model_name: str
+
+        @property
+        def _llm_type(self) -> str:
+            return f"provider:{provider_name()}"
+
+        def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+            text = get_llm(self.model_name).generate(prompt)
+            for s in stop or []:                # ReAct relies on stop sequences
+                cut = text.find(s)
+                if cut != -1:
+                    text = text[:cut]
+            return text
+
+    return ProviderLLM(model_name=model, callbacks=callbacks)
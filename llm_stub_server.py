@@ -0,0 +1,152 @@
+# llm_stub_server.py
+# -------------------------------------------------------------
+# Stand-in LLM server for load tests without network or quota.
+# Speaks the llm_providers.HTTPProvider protocol:
+#     POST /v1/generate {"model", "prompt": [parts]} → {"text": "...", "usage": {...}}
+#     … with "stream": true → chunked JSON lines {"text": delta} …, {"usage"}
+#
+#   python llm_stub_server.py --port 8700 --latency-ms 400 \
+#          --tokens-per-sec 80 --answer-tokens 150 --error-rate 0.01
+#   LLM_PROVIDER=http LLM_BASE_URL=http://127.0.0.1:8700 python app.py
+#
+# Latency per call = latency-ms + output tokens / tokens-per-sec; a
+# streamed reply sends its first word after latency-ms, then the rest at
+# tokens-per-sec.
+# Replies are shaped after the prompt so the app's parsers keep working:
+# the domain classifier gets a domain key, JSON prompts get "{}", the
+# ReAct agent gets a retrieve_rag action, everything else filler text.
+# -------------------------------------------------------------
+from __future__ import annotations
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = ("gene expression variant pathway protein cohort assay exploit patch "
+          "firewall malware network model result table figure analysis").split()
+
+
+class StubSettings:
+    def __init__(self, latency_ms=300.0, tokens_per_sec=60.0, answer_tokens=120,
+                 error_rate=0.0, domain="GENOMIC", seed=0):
+        self.latency_ms     = latency_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.answer_tokens  = answer_tokens
+        self.error_rate     = error_rate
+        self.domain         = domain
+        self.rng            = random.Random(seed)
+        self.lock           = threading.Lock()
+        self.calls          = 0
+        self.errors         = 0
+
+
+def stub_reply(prompt: str, settings: StubSettings) -> str:
+    if "domain classifier" in prompt:
+        return settings.domain
+    if "valid JSON" in prompt:
+        return "{}"
+    if "Action Input" in prompt:                       # LangChain ReAct prompt
+        if "Observation:" in prompt.rsplit("Question:", 1)[-1]:
+            return "Thought: I now know the final answer\nFinal Answer: NO_RESULTS"
+        q = re.findall(r"Question:\s*(.+)", prompt)
+        return f"Thought: look it up\nAction: retrieve_rag\nAction Input: {q[-1] if q else ''}"
+    with settings.lock:
+        words = [settings.rng.choice(_WORDS) for _ in range(settings.answer_tokens)]
+    return "Stub answer (Doc 1): " + " ".join(words) + "."
+
+
+def make_handler(settings: StubSettings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):                   # keep load tests quiet
+            pass
+
+        def _send(self, code: int, payload: dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, payload: dict) -> None:
+            data = (json.dumps(payload) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def _stream(self, text: str, usage: dict) -> None:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(settings.latency_ms / 1000)
+            pieces = re.findall(r"\S+\s*", text) or [text]
+            per_piece = usage["output_tokens"] / max(settings.tokens_per_sec, 1e-9) / len(pieces)
+            for piece in pieces:
+                self._chunk({"text": piece})
+                time.sleep(per_piece)
+            self._chunk({"usage": usage})
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, {"calls": settings.calls, "errors": settings.errors})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/v1/generate":
+                return self._send(404, {"error": "not found"})
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            prompt = "\n".join(p for p in req.get("prompt", []) if isinstance(p, str))
+            with settings.lock:
+                settings.calls += 1
+                fail = settings.rng.random() < settings.error_rate
+                if fail:
+                    settings.errors += 1
+            text = stub_reply(prompt, settings)
+            n_tokens = max(1, len(text) // 4)
+            n_images = sum(1 for p in req.get("prompt", []) if isinstance(p, dict))
+            usage = {"input_tokens": max(1, len(prompt) // 4) + 258 * n_images,   # Gemini: 258 / image
+                     "output_tokens": n_tokens}
+            if req.get("stream") and not fail:
+                return self._stream(text, usage)
+            time.sleep(settings.latency_ms / 1000 + n_tokens / max(settings.tokens_per_sec, 1e-9))
+            if fail:
+                return self._send(503, {"error": "injected failure"})
+            self._send(200, {"text": text, "usage": usage})
+
+    return Handler
+
+
+def serve(host: str = "127.0.0.1", port: int = 8700,
+          settings: StubSettings | None = None) -> ThreadingHTTPServer:
+    """Start the stub in a background thread (benchmarks); returns the server."""
+    srv = ThreadingHTTPServer((host, port), make_handler(settings or StubSettings()))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True, name="llm-stub").start()
+    return srv
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Stand-in LLM server for load tests")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8700)
+    ap.add_argument("--latency-ms", type=float, default=300.0, help="fixed latency per call")
+    ap.add_argument("--tokens-per-sec", type=float, default=60.0, help="simulated decode rate")
+    ap.add_argument("--answer-tokens", type=int, default=120, help="words in free-text answers")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with 503")
+    ap.add_argument("--domain", default="GENOMIC", help="reply of the domain classifier")
+    a = ap.parse_args()
+    settings = StubSettings(a.latency_ms, a.tokens_per_sec, a.answer_tokens, a.error_rate, a.domain)
+    srv = ThreadingHTTPServer((a.host, a.port), make_handler(settings))
+    srv.daemon_threads = True
+    print(f"LLM stub on http://{a.host}:{a.port}  (Ctrl-C to stop)")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,193 @@
+# metrics.py
+# -------------------------------------------------------------
+# In-process metrics with Prometheus text exposition (GET /metrics).
+#   Counter / Histogram / Gauge : labelled, lock-protected, ~1 µs per update
+#   span("query.answer")        : context manager / decorator timing one
+#                                 stage into the shared STAGE_SECONDS histogram
+#   gauge_fn(...)               : values pulled at scrape time (cache stats …)
+#   current_stage()             : innermost open span, used by accounting.py
+# No dependency on prometheus_client.
+# -------------------------------------------------------------
+from __future__ import annotations
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _esc(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_esc(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}"
+                                for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}    # key → [bucket counts…, sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            s[idx] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def collect(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(s)) for k, s in self._series.items()]
+        out = self.header()
+        for key, s in items:
+            cum = 0
+            for bound, n in zip(self.buckets + (float("inf"),), s[:-2]):
+                cum += n
+                le = f'le="{_fmt_value(bound)}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cum}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(s[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {s[-1]}")
+        return out
+
+
+class _FnGauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, fn: Callable[[], Dict[str, float]], label: str):
+        super().__init__(name, help, (label,))
+        self.fn = fn
+
+    def collect(self) -> List[str]:
+        try:
+            values = self.fn()
+        except Exception:
+            return []                     # a broken source must not break the scrape
+        return self.header() + [f"{self.name}{_fmt_labels(self.labelnames, (k,))} {_fmt_value(v)}"
+                                for k, v in values.items() if isinstance(v, (int, float))]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for m in metrics:
+            lines += m.collect()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def gauge_fn(name: str, help: str, fn: Callable[[], Dict[str, float]], label: str = "kind") -> None:
+    """Expose a dict-returning stats function (e.g. a cache's .stats) as one gauge family."""
+    _FnGauge(name, help, fn, label)
+
+
+# ─────────────────── shared stage timings ───────────────────────
+STAGE_SECONDS = Histogram("rag_stage_seconds", "Wall time per pipeline stage", ("stage",))
+STAGE_ERRORS  = Counter("rag_stage_errors_total", "Stages that raised", ("stage",))
+
+_STAGE: contextvars.ContextVar[str | None] = contextvars.ContextVar("stage", default=None)
+
+
+def current_stage() -> str | None:
+    return _STAGE.get()
+
+
+@contextmanager
+def span(stage: str):
+    t0 = time.perf_counter()
+    token = _STAGE.set(stage)
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        _STAGE.reset(token)
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of `span`."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
@@ -0,0 +1,162 @@
+# query_cache.py
+# -------------------------------------------------------------
+# Versioned result cache for rag_scipdf_core.smart_query.
+#   • entries: (user_id, normalized question, options) → answer + media,
+#     tagged with the domain the question was routed to and that
+#     (user, domain) corpus version at the time
+#   • corpus versions live in SQLite, so every process (web workers,
+#     ingest jobs) sees a bump as soon as ingestion writes new chunks;
+#     an entry whose version is behind is dropped on lookup
+#   • in-process LRU bounded by `max_items`, entries expire after `ttl_s`
+# -------------------------------------------------------------
+from __future__ import annotations
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Hashable, Tuple
+
+from metrics import gauge_fn
+
+_WS_RE    = re.compile(r"\s+")
+_TRAIL_RE = re.compile(r"[\s?!.]+$")
+
+
+def normalize_question(question: str) -> str:
+    """Case / whitespace / trailing-punctuation insensitive form of a question."""
+    q = unicodedata.normalize("NFKC", question).lower()
+    return _TRAIL_RE.sub("", _WS_RE.sub(" ", q).strip())
+
+
+@dataclass
+class _Entry:
+    domain: str
+    version: int
+    value: Any
+    expires: float
+
+
+class QueryCache:
+    """
+    versions_path : SQLite file holding the per-(user, domain) corpus versions
+    max_items     : entries kept in memory (least recently used go first)
+    ttl_s         : entry lifetime in seconds; 0 disables the cache
+    """
+
+    def __init__(self, versions_path: Path, max_items: int = 1_000, ttl_s: float = 600.0):
+        self.versions_path = Path(versions_path)
+        self.max_items = max_items
+        self.ttl_s     = ttl_s
+        self._mem: "OrderedDict[Tuple, _Entry]" = OrderedDict()
+        self._lock  = threading.Lock()
+        self._local = threading.local()          # one sqlite connection per thread
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "expired": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_s > 0 and self.max_items > 0
+
+    # ---------------- corpus versions -----------------------------
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.versions_path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.versions_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+              CREATE TABLE IF NOT EXISTS corpus_versions (
+                user_id INTEGER,
+                domain  TEXT,
+                version INTEGER,
+                PRIMARY KEY (user_id, domain)
+              )
+            """)
+            self._local.db = db
+        return db
+
+    def version(self, user_id: int, domain: str) -> int:
+        row = self._db().execute(
+            "SELECT version FROM corpus_versions WHERE user_id=? AND domain=?", (user_id, domain)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, user_id: int, domain: str) -> None:
+        """Called by ingestion after it writes to (user_id, domain)'s collections."""
+        db = self._db()
+        db.execute(
+            "INSERT INTO corpus_versions (user_id, domain, version) VALUES (?,?,1) "
+            "ON CONFLICT(user_id, domain) DO UPDATE SET version=version+1",
+            (user_id, domain),
+        )
+        db.commit()
+
+    # ---------------- entries -------------------------------------
+    @staticmethod
+    def key(user_id: int, question: str, *options: Hashable) -> Tuple:
+        return (user_id, normalize_question(question), *options)
+
+    def get(self, key: Tuple) -> Any | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._mem.get(key)
+        if entry is None:
+            return self._count("misses")
+        if entry.expires < time.time():
+            self._drop(key, entry)
+            return self._count("expired")
+        if entry.version != self.version(key[0], entry.domain):
+            self._drop(key, entry)
+            return self._count("stale")
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+            self.counters["hits"] += 1
+        return entry.value
+
+    def put(self, key: Tuple, domain: str, version: int, value: Any) -> None:
+        """`version` must be read *before* retrieval, so a concurrent ingest leaves it stale."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._mem[key] = _Entry(domain, version, value, time.time() + self.ttl_s)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            c = dict(self.counters)
+            c["items"] = len(self._mem)
+        lookups = c["hits"] + c["misses"] + c["stale"] + c["expired"]
+        c["hit_rate"] = c["hits"] / lookups if lookups else 0.0
+        return c
+
+    # ---------------- helpers -------------------------------------
+    def _drop(self, key: Tuple, entry: _Entry) -> None:
+        with self._lock:
+            if self._mem.get(key) is entry:
+                del self._mem[key]
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+        return None
+
+
+QUERY_CACHE = QueryCache(
+    Path(os.getenv("CORPUS_VERSIONS_PATH", "corpus_versions.sqlite3")),
+    max_items=int(os.getenv("QUERY_CACHE_ITEMS", "1000")),
+    ttl_s=float(os.getenv("QUERY_CACHE_TTL", "600")),
+)
+gauge_fn("rag_query_cache", "Query cache counters and hit rate", QUERY_CACHE.stats)
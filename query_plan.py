@@ -0,0 +1,96 @@
+# query_plan.py
+# -------------------------------------------------------------
+# Tiny dependency-graph executor for smart_query.
+# Each node is a function of its dependencies' results; it is submitted
+# to the shared thread pool only once all of them have finished, so no
+# pool thread ever blocks waiting on another node, and independent
+# nodes (LLM calls, embeddings, Chroma queries) overlap.
+# Nodes run in a copy of the caller's contextvars context, so
+# request-scoped state follows the work onto the pool threads.
+# Node durations also feed metrics.STAGE_SECONDS as "<prefix>.<node>"
+# (the part of the node name before ":", so per-domain nodes share one
+# series).
+# -------------------------------------------------------------
+from __future__ import annotations
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from metrics import span
+
+_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("QUERY_WORKERS", "16")),
+                           thread_name_prefix="query")
+
+
+class QueryPlan:
+    """
+    plan = QueryPlan()
+    plan.add("vec",  embed_question)
+    plan.add("hits", search, "vec")          # search(vec_result)
+    plan.result("hits")
+
+    A failing node fails every node depending on it; `result` re-raises.
+    Nodes may be added at any time, also depending on finished nodes.
+    """
+
+    def __init__(self, pool: ThreadPoolExecutor | None = None, prefix: str = "query"):
+        self.pool = pool or _POOL
+        self.prefix = prefix
+        self._nodes: Dict[str, Future] = {}
+        self._timings: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, fn: Callable[..., Any], *deps: str) -> None:
+        node: Future = Future()
+        deps_f = [self._nodes[d] for d in deps]
+        ctx = contextvars.copy_context()
+        remaining = [len(deps_f)]
+        stage = f"{self.prefix}.{name.split(':', 1)[0]}"
+
+        def timed(*args):
+            t0 = time.perf_counter()
+            try:
+                with span(stage):
+                    return fn(*args)
+            finally:
+                with self._lock:
+                    self._timings[name] = time.perf_counter() - t0
+
+        def finish(inner: Future) -> None:
+            if inner.exception() is not None:
+                node.set_exception(inner.exception())
+            else:
+                node.set_result(inner.result())
+
+        def launch() -> None:
+            failed = next((d.exception() for d in deps_f if d.exception() is not None), None)
+            if failed is not None:
+                node.set_exception(failed)
+                return
+            inner = self.pool.submit(ctx.run, timed, *[d.result() for d in deps_f])
+            inner.add_done_callback(finish)
+
+        def dep_done(_f: Future) -> None:
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        with self._lock:
+            self._nodes[name] = node
+        if not deps_f:
+            launch()
+        for d in deps_f:
+            d.add_done_callback(dep_done)     # runs immediately if `d` is already done
+
+    def result(self, name: str, timeout: float | None = None) -> Any:
+        return self._nodes[name].result(timeout)
+
+    def timings(self) -> Dict[str, float]:
+        """Seconds spent inside each finished node."""
+        with self._lock:
+            return dict(self._timings)
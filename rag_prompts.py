@@ -1,6 +1,6 @@
 import json
 from typing import Dict, List, Any
-from utils import _gem_chat, _safe_json ,_fmt_list
+from utils import _gem_chat, _gem_chat_stream, _safe_json ,_fmt_list
 import textwrap
 
 
@@ -179,10 +179,11 @@ def genomic_meta_from_question(question: str) -> Dict[str, Any]:
 # ───────────────────────────────────────────────────────────────
 #  2) FULL-ANSWER PROMPT   →  returns a prompt string
 # ───────────────────────────────────────────────────────────────
-def build_full_prompt_genomic(ctx_chunks: List[str], question: str) -> str:
+def build_full_prompt_genomic(ctx_chunks: List[str], question: str, stream: bool = False):
     """
     ctx_chunks : list of strings (built earlier)
     question   : user’s raw question
+    stream     : yield the answer in pieces as Gemini generates it
     Returns    : the long prompt EXACTLY as you wrote it, with ctx & question inserted
     """
     FULL_PROMPT_HEADER = textwrap.dedent("""
@@ -239,7 +240,8 @@ def build_full_prompt_genomic(ctx_chunks: List[str], question: str) -> str:
     Question: "{question}"
     """).strip()
 
-
+    if stream:
+        return _gem_chat_stream(prompt)
     return _gem_chat(prompt)
 
 
@@ -385,9 +387,10 @@ def cyber_meta_from_question(question: str) -> Dict[str, Any]:
     return _safe_json(_gem_chat(QUERY_PROMPT + question))
 
 # -----------------------------------------------------------------
-def build_full_prompt_cyber(ctx_chunks: List[str], question: str) -> str:
+def build_full_prompt_cyber(ctx_chunks: List[str], question: str, stream: bool = False):
     """
     Few-shot template adapted to cyber-security (CSIRT example).
+    `stream=True` yields the answer in pieces.
     """
     HEADER = textwrap.dedent("""
         You are given text chunks from cyber-security papers plus
@@ -429,6 +432,8 @@ def build_full_prompt_cyber(ctx_chunks: List[str], question: str) -> str:
     Question: "{question}"
     """).strip()
 
+    if stream:
+        return _gem_chat_stream(prompt)
     return _gem_chat(prompt)
 
 
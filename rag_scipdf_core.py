@@ -1,11 +1,17 @@
 # ----------------------------------------
 # rag_scipdf_core.py  – ingestion + retrieval
 from __future__ import annotations                      # later you can switch domains
+import contextvars
+import functools
 import glob
+import os
 import re
-import uuid
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Tuple
+from typing import Callable, Dict, Iterator, List, Tuple
 from threading import Event
 import nest_asyncio
 from docling.document_converter import DocumentConverter, PdfFormatOption
@@ -14,8 +20,15 @@ from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMo
 from IPython.display import display, Markdown, Image
 from utils import get_chroma_collections, ensure_dirs,_flatten_meta, _embed, CAP_RE, _find_caption,_candidate_filters, _fetch_media_linked,_zip_ids_meta,_top_media_by_similarity
 from config import ALL_DOMAINS
-from domain_routing import choose_domain
+from domain_routing import CENTROIDS, choose_domain
 from logging_config import logger
+from ingest_pipeline import IngestCancelled, IngestProgress, Pipeline, Stage, checkpoint
+from ingest_manifest import MANIFEST, file_sha256, stable_id
+from chunking import chunk_document, owning_chunk, page_chunk_index
+from query_cache import QUERY_CACHE
+from query_plan import QueryPlan
+from metrics import STAGE_SECONDS, span, timed
+from bm25_index import get_bm25, rrf_fuse
 
 
 
@@ -25,24 +38,420 @@ nest_asyncio.apply()
 
 
 # ─────────────────── Docling converter ────────────────────────
-pipe_opts = PdfPipelineOptions(
-    do_table_structure=True,
-    generate_page_images=True,
-    generate_picture_images=True,
-    save_picture_images=True,
-    images_scale=2.0
-)
-pipe_opts.table_structure_options.mode = TableFormerMode.ACCURATE
-converter = DocumentConverter(
-    format_options={ InputFormat.PDF: PdfFormatOption(pipeline_options=pipe_opts) }
-)
+def _make_converter() -> DocumentConverter:
+    pipe_opts = PdfPipelineOptions(
+        do_table_structure=True,
+        generate_page_images=True,
+        generate_picture_images=True,
+        save_picture_images=True,
+        images_scale=2.0
+    )
+    pipe_opts.table_structure_options.mode = TableFormerMode.ACCURATE
+    return DocumentConverter(
+        format_options={ InputFormat.PDF: PdfFormatOption(pipeline_options=pipe_opts) }
+    )
+
+
+# Built lazily: the web app only pays for Docling's models on first
+# ingest, and every pool worker process ends up with its own instance.
+_CONVERTER: DocumentConverter | None = None
+
+def _get_converter() -> DocumentConverter:
+    global _CONVERTER
+    if _CONVERTER is None:
+        _CONVERTER = _make_converter()
+    return _CONVERTER
+
+
+# ─────────────────── ingestion settings ───────────────────────
+INGEST_WORKERS  = int(os.getenv("INGEST_WORKERS", "1"))       # Docling conversions in parallel
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "8"))     # Gemini summary calls in flight
+INGEST_QUEUE    = int(os.getenv("INGEST_QUEUE", "2"))        # docs buffered between stages
+
+# ─────────────────── retrieval settings ───────────────────────
+SPECULATE_META  = os.getenv("QUERY_SPECULATE_META", "1") == "1"   # see smart_query step 0
+SPECULATIVE_RETRIEVAL = os.getenv("QUERY_SPECULATIVE", "1") == "1"  # search all domains while routing
+RRF_K           = int(os.getenv("RRF_K", "60"))                     # reciprocal-rank fusion constant
+
+def _init_convert_worker() -> None:
+    """Pool initializer: load Docling's models once per worker process."""
+    _get_converter()
+
+def _convert_pdf(path: str):
+    """Runs inside a pool worker; the DoclingDocument is pickled back."""
+    return _get_converter().convert(Path(path)).document
 
 
 
 # ═══════════════════════════════════════════════════════════════
 # INGESTION
 # ═══════════════════════════════════════════════════════════════
-def ingest_documents(pattern: str,user_id : int, chunk_size: int = 1500, stop_event: Event | None = None) -> None:
+@dataclass
+class _DocJob:
+    """One PDF travelling through the ingestion stages."""
+    path: Path
+    doc_hash: str = ""
+    ddoc: object | None = None
+    md: str = ""
+    cfg: object | None = None
+    domain: str = ""                                           # ALL_DOMAINS key
+    meta_flat: dict = field(default_factory=dict)
+    chunk_ids: List[str] = field(default_factory=list)
+    text_chunks: List[str] = field(default_factory=list)
+    chunk_meta: List[dict] = field(default_factory=list)        # page span + headings per chunk
+    media: Dict[str, dict] = field(default_factory=dict)     # "image"/"table" → ids, caps, metas, jobs, docs
+    t_start: float = field(default_factory=time.perf_counter)
+
+
+@dataclass
+class _IngestRun:
+    """Settings + shared state of one ingest_documents call, handed to every stage."""
+    user_id: int
+    chunk_tokens: int
+    chunk_overlap: int
+    batch_size: int
+    summary_workers: int
+    force: bool
+    stop_event: Event
+    progress: IngestProgress
+    pool: ProcessPoolExecutor | None = None
+
+
+def _store_batched(collection, ids: List[str], documents: List[str],
+                   embed_texts: List[str], metadatas: List[dict],
+                   model: str, batch_size: int,
+                   stop_event: Event | None = None,
+                   on_batch: Callable[[int], None] | None = None) -> List[List[float]]:
+    """
+    Embed `embed_texts` and write the records with one embed call and
+    one `collection.upsert` per batch of `batch_size` records (IDs are
+    deterministic, so a re-run overwrites instead of duplicating).
+    `stop_event` is checked before every batch; `on_batch(n)` runs after.
+    Returns the vectors written.
+    """
+    vectors: List[List[float]] = []
+    for lo in range(0, len(ids), max(1, batch_size)):
+        checkpoint(stop_event)
+        hi = lo + max(1, batch_size)
+        vecs = _embed(embed_texts[lo:hi], model=model)
+        collection.upsert(
+            ids=ids[lo:hi],
+            embeddings=vecs,
+            documents=documents[lo:hi],
+            metadatas=metadatas[lo:hi],
+        )
+        vectors.extend(vecs)
+        if on_batch is not None:
+            on_batch(len(ids[lo:hi]))
+    return vectors
+
+
+def _purge_document(doc_hash: str, user_id: int) -> None:
+    """
+    Delete a document's chunks (Chroma + BM25, with their share of the
+    routing centroid) and figure / table records in every domain, found
+    by the `doc_hash` metadata field.
+    """
+    where = {"$and": [{"user_id": user_id}, {"doc_hash": doc_hash}]}
+    for key, cfg in ALL_DOMAINS.items():
+        collection_txt, collection_img, collection_tbl = get_chroma_collections(cfg)
+        old = collection_txt.get(where=where, include=["embeddings"])
+        if old["ids"]:
+            if cfg.embed_models["text"] == CENTROIDS.model:
+                CENTROIDS.remove(key, old["embeddings"])
+            collection_txt.delete(ids=old["ids"])
+            if cfg.lexical_search:
+                get_bm25(cfg, user_id).remove(old["ids"])
+            QUERY_CACHE.bump(user_id, cfg.name)
+        collection_img.delete(where=where)
+        collection_tbl.delete(where=where)
+
+
+# ---------------- stage 1: convert ---------------------------------
+def _stage_convert(job: _DocJob, run: _IngestRun) -> _DocJob | None:
+    """
+    Docling → DoclingDocument (in a pool worker process when available).
+    PDFs whose content hash is already fully ingested for this user are
+    skipped before paying for the conversion.
+    """
+    user_id = run.user_id
+    checkpoint(run.stop_event)
+    job.doc_hash = file_sha256(job.path)
+    if run.force:                                    # re-chunking may yield fewer IDs:
+        _purge_document(job.doc_hash, user_id)       # drop every old record first
+        MANIFEST.forget(job.doc_hash, user_id)
+    entry = MANIFEST.get(job.doc_hash, user_id)
+    if entry and "done" in entry["stages"]:
+        print(f"\n▶ {job.path.name} unchanged since last ingest – skipped.")
+        run.progress.add(pdfs_done=1)
+        return None
+    MANIFEST.record(job.doc_hash, user_id, str(job.path))
+
+    print(f"\n▶ Processing {job.path.name} …")
+    if run.pool is None:
+        job.ddoc = _get_converter().convert(job.path).document
+    else:
+        job.ddoc = run.pool.submit(_convert_pdf, str(job.path)).result()
+    run.progress.add(pdfs_converted=1, pages_converted=job.ddoc.num_pages())
+    return job
+
+
+# ---------------- stage 2: prepare ---------------------------------
+def _stage_prepare(job: _DocJob, run: _IngestRun) -> _DocJob | None:
+    """
+    Route the document to a domain, extract its metadata, chunk the text
+    and write figures / tables to the object store. The DoclingDocument is
+    dropped afterwards so later stages only carry text + file paths.
+    """
+    user_id = run.user_id
+    checkpoint(run.stop_event)
+    p, ddoc = job.path, job.ddoc
+    md = ddoc.export_to_markdown()
+    entry = MANIFEST.get(job.doc_hash, user_id) or {}
+
+    # 2) Pick domain & CFG for this document (reused when resuming) -----
+    doc_domain = entry.get("domain") or choose_domain(md[:2000])
+    if doc_domain not in ALL_DOMAINS:
+        print(f" No domain found for {p.name} – skipped.")
+        return None
+    CFG = ALL_DOMAINS[doc_domain]
+    logger.info(f"Started ingesting {p.name} for domain {doc_domain}")
+
+    # one-time per PDF: make sure object-store dirs exist
+    ensure_dirs(CFG.object_store_dirs)
+    OBJ_DIR_IMG = CFG.object_store_dirs["image"]
+    OBJ_DIR_TBL = CFG.object_store_dirs["table"]
+
+    # 3) Extract “global” metadata (title/authors/etc) from first ~1500 chars
+    meta_flat = entry.get("meta")
+    if meta_flat is None:
+        checkpoint(run.stop_event)
+        meta_dict = CFG.prompt_builders["meta_generation"](md[:1500])
+        meta_dict["path"] = str(p)
+        meta_flat = _flatten_meta(meta_dict)
+        MANIFEST.record(job.doc_hash, user_id, str(p), domain=doc_domain, meta=meta_flat)
+
+    # 4) Walk the document tree into token-budgeted chunks (see chunking.py);
+    #    IDs derive from the document hash + chunk position so re-runs hit
+    #    the same records
+    chunks      = chunk_document(ddoc, max_tokens=run.chunk_tokens, overlap_tokens=run.chunk_overlap)
+    text_chunks = [c.text for c in chunks]
+    chunk_ids   = [stable_id(job.doc_hash, user_id, f"chunk{run.chunk_tokens}/{run.chunk_overlap}", i)
+                   for i in range(len(chunks))]
+    chunk_meta  = [{"page_start": c.page_start, "page_end": c.page_end,
+                    "headings": " / ".join(c.headings)} for c in chunks]
+    # page → (first, last) chunk covering it; kept in the manifest and used
+    # below to link every figure / table to its exact owning chunk
+    page_index  = page_chunk_index(chunks)
+    MANIFEST.record(job.doc_hash, user_id, str(p), page_index=page_index)
+
+    def _parent(pg: int, anchor: str) -> str:
+        if not chunk_ids:
+            return ""
+        return chunk_ids[owning_chunk(page_index, text_chunks, pg, anchor)]
+
+    # 5) Each figure in ddoc.pictures → save PNG; summary job queued
+    img = {"ids": [], "caps": [], "metas": [], "jobs": []}
+    for pic in ddoc.pictures:
+        checkpoint(run.stop_event)
+        pil = pic.get_image(ddoc)
+        if pil is None:
+            continue
+        pg = pic.prov[0].page_no if pic.prov else 1
+        # Save PNG to object_store/images/ (once – the name is deterministic)
+        img_id = stable_id(job.doc_hash, user_id, "image", pic.self_ref)   # one ID for both
+        fn     = f"{img_id}_{p.stem}_p{pg}.png"
+        fp     = OBJ_DIR_IMG / fn
+        if not fp.exists():
+            pil.save(fp, "PNG")
+        caption_image = pic.caption_text(ddoc) or ""
+        # The chunk covering this page (the one holding the caption, if any)
+        parent = _parent(pg, caption_image)
+
+        img["ids"].append(img_id)
+        img["caps"].append(caption_image)
+        img["jobs"].append({ "path": str(fp),"caption": caption_image,"meta": meta_flat})
+        img["metas"].append({
+            **meta_flat,
+            "id": img_id,
+            "parent_chunk_id": parent,
+            "page": pg,
+            "path": str(fp),
+            "caption": caption_image,
+            "doc_hash": job.doc_hash,
+            "user_id" :user_id
+        })
+
+    # 6) Tables → write Markdown; summary job queued
+    tbl = {"ids": [], "caps": [], "metas": [], "jobs": []}
+    for t in ddoc.tables:
+        checkpoint(run.stop_event)
+        tbl_md  = t.export_to_markdown(ddoc).strip()
+        pos     = md.find(tbl_md)
+
+        # 1) Docling’s own caption if it already starts with “Table …”
+        caption = (t.caption_text(ddoc) or "").strip()
+        if not CAP_RE.match(caption):
+            # 2) search ↑ above the grid
+            caption = _find_caption(md[:pos].splitlines(), "above") or caption
+
+        if not CAP_RE.match(caption):
+            # 3) search ↓ below the grid
+            caption = _find_caption(md[pos + len(tbl_md):].splitlines(), "below") or caption
+
+        # page → owning chunk (the one holding the grid's header row)
+        pg   = t.prov[0].page_no if t.prov else 1
+        parent = _parent(pg, tbl_md.splitlines()[0] if tbl_md else caption)
+
+        tid = stable_id(job.doc_hash, user_id, "table", t.self_ref)
+        fp  = OBJ_DIR_TBL / f"{tid}.md"
+        if not fp.exists():
+            fp.write_text(tbl_md, encoding="utf-8")
+
+        tbl["ids"].append(tid)
+        tbl["caps"].append(caption)
+        tbl["jobs"].append({"table_md": tbl_md, "caption" : caption, "meta" : meta_flat})
+        tbl["metas"].append({
+            **meta_flat,
+            "id": tid,
+            "parent_chunk_id": parent,
+            "page": pg,
+            "path": str(fp),
+            "caption": caption,
+            "doc_hash": job.doc_hash,
+            "user_id" :user_id
+        })
+
+    job.ddoc, job.md, job.cfg, job.domain, job.meta_flat = None, md, CFG, doc_domain, meta_flat
+    job.chunk_ids, job.text_chunks, job.chunk_meta = chunk_ids, text_chunks, chunk_meta
+    job.media = {"image": img, "table": tbl}
+    run.progress.add(pdfs_prepared=1, chunks_total=len(chunk_ids),
+                     figures_total=len(img["ids"]), tables_total=len(tbl["ids"]))
+    return job
+
+
+# ---------------- stage 3: embed + store text ----------------------
+def _stage_store_text(job: _DocJob, run: _IngestRun) -> _DocJob:
+    """Embed & store the text chunks into `collection_txt`, batch by batch."""
+    user_id = run.user_id
+    if MANIFEST.has_stage(job.doc_hash, user_id, "text"):
+        run.progress.add(chunks_embedded=len(job.chunk_ids))
+        return job                                   # resumed: chunks already stored
+    CFG = job.cfg
+    collection_txt, _, _ = get_chroma_collections(CFG)
+    # IDs already stored (a forced or interrupted re-run) are only upserted
+    # and must not count twice in the routing centroid
+    stored = set(collection_txt.get(ids=job.chunk_ids, include=[])["ids"]) if job.chunk_ids else set()
+    try:
+        vectors = _store_batched(
+            collection_txt,
+            ids=job.chunk_ids,
+            documents=job.text_chunks,
+            embed_texts=job.text_chunks,
+            metadatas=[{
+                **job.meta_flat,
+                **cmeta,
+                "chunk_id": cid,
+                "chunk_preview": chunk[:400],
+                "doc_hash": job.doc_hash,
+                "user_id" :user_id
+            } for cid, chunk, cmeta in zip(job.chunk_ids, job.text_chunks, job.chunk_meta)],
+            model=CFG.embed_models["text"],
+            batch_size=run.batch_size,
+            stop_event=run.stop_event,
+            on_batch=lambda n: run.progress.add(chunks_embedded=n),
+        )
+    finally:                                         # even a partial write changes answers
+        QUERY_CACHE.bump(user_id, CFG.name)
+    if CFG.embed_models["text"] == CENTROIDS.model:  # grow the routing centroid
+        CENTROIDS.add(job.domain, [v for cid, v in zip(job.chunk_ids, vectors) if cid not in stored])
+    if CFG.lexical_search:
+        get_bm25(CFG, user_id).add(job.chunk_ids, job.text_chunks)
+    MANIFEST.mark_stage(job.doc_hash, user_id, "text")
+    return job
+
+
+# ---------------- stage 4: summarize figures + tables --------------
+def _summarize_one(kind: str, CFG, kw: dict, run: _IngestRun) -> str:
+    """One figure / table summary call; skipped outright once cancelled."""
+    checkpoint(run.stop_event)
+    summ = CFG.prompt_builders[kind](**kw)
+    run.progress.add(**{"figures_summarized" if kind == "image" else "tables_summarized": 1})
+    return summ
+
+
+def _stage_summarize(job: _DocJob, run: _IngestRun) -> _DocJob:
+    """
+    Summarize figures + tables concurrently (≤ summary_workers Gemini
+    calls in flight); results come back in submission order.
+    Figures / tables already stored by an earlier (interrupted) run are
+    left out, so a resumed job only pays for the missing summaries.
+    """
+    CFG = job.cfg
+    _, collection_img, collection_tbl = get_chroma_collections(CFG)
+    for kind, collection in (("image", collection_img), ("table", collection_tbl)):
+        m = job.media[kind]
+        have = set(collection.get(ids=m["ids"], include=[])["ids"]) if m["ids"] else set()
+        keep = [i for i, mid in enumerate(m["ids"]) if mid not in have]
+        for key in ("ids", "caps", "metas", "jobs"):
+            m[key] = [m[key][i] for i in keep]
+        run.progress.add(**{"figures_summarized" if kind == "image" else "tables_summarized": len(have)})
+
+    img, tbl = job.media["image"], job.media["table"]
+    with ThreadPoolExecutor(max_workers=max(1, run.summary_workers)) as pool:
+        def submit(kind: str, kw: dict):             # calls stay on the caller's ledger
+            return pool.submit(contextvars.copy_context().run, _summarize_one, kind, CFG, kw, run)
+        img_futs = [submit("image", kw) for kw in img["jobs"]]
+        tbl_futs = [submit("table", kw) for kw in tbl["jobs"]]
+        try:
+            img["docs"] = [f.result() for f in img_futs]
+            tbl["docs"] = [f.result() for f in tbl_futs]
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return job
+
+
+# ---------------- stage 5: embed + store media ---------------------
+def _stage_store_media(job: _DocJob, run: _IngestRun) -> dict:
+    """Write figure / table summaries, mark the PDF done, report its counts."""
+    user_id = run.user_id
+    CFG = job.cfg
+    _, collection_img, collection_tbl = get_chroma_collections(CFG)
+    try:
+        for kind, collection in (("image", collection_img), ("table", collection_tbl)):
+            m = job.media[kind]
+            for meta, summ in zip(m["metas"], m["docs"]):
+                meta["summary"] = summ
+            texts = [f"{c}\n\n{s}" if c else s for c, s in zip(m["caps"], m["docs"])]
+            _store_batched(collection, m["ids"], m["docs"], texts, m["metas"],
+                           model=CFG.embed_models[kind], batch_size=run.batch_size,
+                           stop_event=run.stop_event)
+    finally:
+        QUERY_CACHE.bump(user_id, CFG.name)
+    MANIFEST.mark_stage(job.doc_hash, user_id, "media")
+    MANIFEST.mark_stage(job.doc_hash, user_id, "done")
+    run.progress.add(pdfs_done=1)
+
+    counts = {"chunks": len(job.chunk_ids),
+              "images": len(job.media["image"]["ids"]),
+              "tables": len(job.media["table"]["ids"])}
+    secs = time.perf_counter() - job.t_start
+    logger.info(
+        f"Ingested {counts['chunks']} chunks, {counts['images']} images, {counts['tables']} tables "
+        f"from {job.path.name} in {secs:.1f}s ({counts['chunks'] / max(secs, 1e-9):.1f} chunks/sec)"
+    )
+    return counts
+
+
+@timed("ingest.total")
+def ingest_documents(pattern: str,user_id : int, chunk_tokens: int = 400, stop_event: Event | None = None,
+                     batch_size: int = 64, workers: int | None = None,
+                     summary_workers: int | None = None,
+                     stage_workers: Dict[str, int] | None = None,
+                     queue_size: int | None = None, force: bool = False,
+                     progress_cb: Callable[[dict], None] | None = None,
+                     chunk_overlap: int = 40) -> dict:
     """
     Ingest all PDFs matching `pattern` into three Chroma collections:
       • scientific_chunks   (text chunks, embeddings & metadata)
@@ -52,170 +461,142 @@ def ingest_documents(pattern: str,user_id : int, chunk_size: int = 1500, stop_ev
     Also saves:
       - PNG figures under object_store/images/
       - Markdown tables under object_store/tables/
+
+    The work runs as a staged pipeline joined by bounded queues
+    (see ingest_pipeline.py), so converting PDF N+1 overlaps with
+    embedding / summarizing PDF N:
+
+        convert → prepare → store_text → summarize → store_media
+
+    workers         : Docling conversions in parallel; > 1 runs them on a
+                      process pool, one DocumentConverter per worker
+                      (default: INGEST_WORKERS env var)
+    summary_workers : figure/table summary calls in flight per PDF
+                      (default: SUMMARY_WORKERS env var)
+    stage_workers   : per-stage thread overrides, e.g. {"prepare": 2}
+    queue_size      : inbox capacity of every stage (default: INGEST_QUEUE)
+
+    Text is chunked along the Docling document structure (sections,
+    paragraphs, list items, tables) into chunks of ≤ `chunk_tokens` tokens
+    with `chunk_overlap` tokens of overlap; each chunk's metadata records
+    its page span (page_start / page_end) and heading path.
+
+    Chunks and summaries are embedded and written in batches of at most
+    `batch_size` records; both write stages run in glob order.
+
+    Ingestion is idempotent: every PDF is tracked in the content-hash
+    manifest (ingest_manifest.py) and all chunk / figure / table IDs are
+    derived from that hash. Unchanged PDFs are skipped, PDFs interrupted
+    by `stop_event` or a crash resume from their last completed stage,
+    and `force=True` re-ingests from scratch.
+
+    `stop_event` is checked between PDFs, before every embed batch and
+    before every figure / table summary call, so a cancel frees CPU and
+    API quota within one batch / call. `progress_cb(snapshot)` receives
+    the IngestProgress counters (pages converted, chunks embedded,
+    figures / tables summarized, fraction, eta_s) about once a second.
+    Returns throughput stats (pdfs / chunks / images / tables / seconds /
+    chunks_per_sec) plus the per-stage queue metrics.
     """
+    workers = INGEST_WORKERS if workers is None else workers
+    summary_workers = SUMMARY_WORKERS if summary_workers is None else summary_workers
+    queue_size = INGEST_QUEUE if queue_size is None else queue_size
+    n_workers = {"convert": max(1, workers), "prepare": 1, "store_text": 1,
+                 "summarize": 1, "store_media": 1, **(stage_workers or {})}
     stop_event = stop_event or Event()   # use dummy flag if caller passed None
 
     pdfs = glob.glob(pattern, recursive=True)
     if not pdfs:
         raise FileNotFoundError(f"No PDFs matched pattern: {pattern}")
 
-    for pdf in pdfs:
-        if stop_event.is_set():          # ← graceful early-exit
-            print("▶ Ingestion cancelled by user")
-            return
-
-        p = Path(pdf)
-        print(f"\n▶ Processing {p.name} …")
-        # 1) Use Docling to convert → Markdown + page images + saved PNGs
-        ddoc = converter.convert(p).document
-        md   = ddoc.export_to_markdown()
-        
-        # 2) Pick domain & CFG for this document --------------------------
-        doc_domain = choose_domain(md[:2000])
-        if doc_domain is None:
-            print(f" No domain found for {p.name} – skipped.")
+    t_start = time.perf_counter()
+    progress = IngestProgress(progress_cb)
+    progress.add(pdfs_total=len(pdfs))
+    run = _IngestRun(user_id=user_id, chunk_tokens=chunk_tokens, chunk_overlap=chunk_overlap,
+                     batch_size=batch_size,
+                     summary_workers=summary_workers, force=force,
+                     stop_event=stop_event, progress=progress)
+    if workers > 1 and len(pdfs) > 1:
+        run.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                                       initializer=_init_convert_worker)
+    pipe = Pipeline([
+        Stage("convert",     lambda j: _stage_convert(j, run),
+              workers=n_workers["convert"], maxsize=queue_size),
+        Stage("prepare",     lambda j: _stage_prepare(j, run),
+              workers=n_workers["prepare"], maxsize=queue_size),
+        Stage("store_text",  lambda j: _stage_store_text(j, run),
+              maxsize=queue_size, ordered=True),
+        Stage("summarize",   lambda j: _stage_summarize(j, run),
+              workers=n_workers["summarize"], maxsize=queue_size),
+        Stage("store_media", lambda j: _stage_store_media(j, run),
+              maxsize=queue_size, ordered=True),
+    ], stop_event=stop_event)
+    results: List = []
+    try:
+        results = pipe.run(_DocJob(path=Path(pdf)) for pdf in pdfs)
+    except IngestCancelled:
+        pass                                   # reported below; the manifest keeps what finished
+    finally:
+        if run.pool is not None:
+            run.pool.shutdown(wait=True, cancel_futures=True)
+        progress.flush()
+
+    if stop_event.is_set():
+        print("▶ Ingestion cancelled by user")
+
+    stats = {"pdfs": 0, "chunks": 0, "images": 0, "tables": 0}
+    for counts in results:
+        if counts is None:
             continue
-        CFG = ALL_DOMAINS[doc_domain]
-        logger.info(f"Started ingesting {p.name} for domain {doc_domain}")
-
+        stats["pdfs"] += 1
+        for k, v in counts.items():
+            stats[k] += v
+    stats["seconds"] = time.perf_counter() - t_start
+    stats["chunks_per_sec"] = stats["chunks"] / max(stats["seconds"], 1e-9)
+    stats["stages"] = pipe.metrics()
+    print(f"▶ Ingested {stats['chunks']} chunks from {stats['pdfs']} PDF(s) "
+          f"at {stats['chunks_per_sec']:.1f} chunks/sec")
+    logger.info(f"Ingestion throughput: {stats}")
+    return stats
 
-        # one-time per PDF: make sure object-store dirs exist
-        ensure_dirs(CFG.object_store_dirs)
-        collection_txt, collection_img, collection_tbl = get_chroma_collections(CFG)
-        OBJ_DIR_IMG = CFG.object_store_dirs["image"]
-        OBJ_DIR_TBL = CFG.object_store_dirs["table"]
-
-        # 3) Extract “global” metadata (title/authors/etc) from first ~1500 chars
 
+# ═══════════════════════════════════════════════════════════════
+# RETRIEVAL
+# ═══════════════════════════════════════════════════════════════
 
-        # 2) Extract “global” metadata (title/authors/etc) from first ~1500 chars
-        meta_dict = CFG.prompt_builders["meta_generation"](md[:1500])
-        meta_dict["path"] = str(p)
-        meta_flat = _flatten_meta(meta_dict)
-
+NO_RESULTS = "NO_RESULTS"           # nothing retrieved – the token the agent protocol expects
 
-        # 3) Split the full Markdown into ~chunk_size pieces
-        text_chunks = [md[i : i + chunk_size] for i in range(0, len(md), chunk_size)]
-        chunk_ids   = [str(uuid.uuid4()) for _ in text_chunks]
-
-        # 4) Embed & store each text chunk into `collection_txt`
-        for cid, chunk in zip(chunk_ids, text_chunks):
-            vec = _embed([chunk], model=CFG.embed_models["text"])[0]
-            flat = {
-                **meta_flat,
-                "chunk_id": cid,
-                "chunk_preview": chunk[:400],
-                "user_id" :user_id
-            }
-            collection_txt.add(
-                ids=[cid],
-                embeddings=[vec],
-                documents=[chunk],
-                metadatas=[flat]
-            )
-        
-        # 5) Process each figure in ddoc.pictures → save PNG + embed its 200-word summary
-        page_numbers = [pic.prov[0].page_no for pic in ddoc.pictures if pic.prov]
-        max_pg = max(page_numbers) if page_numbers else 1
-        for pic in ddoc.pictures:
-            img = pic.get_image(ddoc)
-            if img is None:
-                continue
-            pg = pic.prov[0].page_no if pic.prov else 1
-            # Save PNG to object_store/images/
-            img_id = str(uuid.uuid4())                       # one UUID for both
-            fn     = f"{img_id}_{p.stem}_p{pg}.png"
-            fp     = OBJ_DIR_IMG / fn
-            img.save(fp, "PNG")
-            caption_image = pic.caption_text(ddoc) or "" 
-            # Determine which text‐chunk “owns” this page:
-            idx = min(int((pg - 1) / max_pg * len(chunk_ids)), len(chunk_ids) - 1)
-            parent = chunk_ids[idx]
-            # Summarize that figure (send PNG → Gemini)
-            summ = CFG.prompt_builders["image"](**{ "path": str(fp),"caption": caption_image,"meta": meta_flat})
-
-            embed_text = f"{caption_image}\n\n{summ}" if caption_image else summ
-
-            collection_img.add(
-                ids=[img_id],
-                embeddings=[_embed([embed_text],model=CFG.embed_models["image"])[0]],
-                documents=[summ],
-                metadatas=[{
-                    **meta_flat,
-                    "id": img_id,
-                    "parent_chunk_id": parent,
-                    "path": str(fp),
-                    "caption": caption_image,
-                    "summary": summ,
-                    "user_id" :user_id
-                }]
-            )
-        
-        print("Images ingested")
-        page_nums_tbl = [t.prov[0].page_no for t in ddoc.tables   if t.prov]
-        max_pg_tbl = max(page_nums_tbl) if page_nums_tbl else 1
-
-    
-
-# --- Table summary generation -------------
-        for tbl in ddoc.tables:
-            tbl_md  = tbl.export_to_markdown(ddoc).strip()
-            pos     = md.find(tbl_md)
-
-            # 1) Docling’s own caption if it already starts with “Table …”
-            caption = (tbl.caption_text(ddoc) or "").strip()
-            if not CAP_RE.match(caption):
-                # 2) search ↑ above the grid
-                caption = _find_caption(md[:pos].splitlines(), "above") or caption
-
-            if not CAP_RE.match(caption):
-                # 3) search ↓ below the grid
-                caption = _find_caption(md[pos + len(tbl_md):].splitlines(), "below") or caption
-
-            # ---------- everything below is what you already had ---------------
-            # page → owning chunk
-            pg   = tbl.prov[0].page_no if tbl.prov else 1
-            idx  = min(int((pg - 1) / max_pg_tbl * len(chunk_ids)), len(chunk_ids) - 1)
-            parent = chunk_ids[idx]
-
-            tid = str(uuid.uuid4())
-            fp  = OBJ_DIR_TBL / f"{tid}.md"
-            fp.write_text(tbl_md, encoding="utf-8")
 
+@dataclass
+class _Retrieved:
+    """Answer material of one question, ready for the final prompt."""
+    cfg: object
+    docs: List[str]
+    metas: List[dict]
+    imgs: Dict[str, dict]                  # re-ranked, id → media metadata
+    tbls: Dict[str, dict]
+    ctx_chunks: List[str]
+    corpus_version: int | None             # None for merged cross-domain answers
 
-            summ       = summ = CFG.prompt_builders["table"](**{"table_md": tbl_md, "caption" : caption, "meta" : meta_flat})
-            embed_text = f"{caption}\n\n{summ}" if caption else summ
-            collection_tbl.add(
-                ids        =[tid],
-                embeddings =[_embed([embed_text],model=CFG.embed_models["table"])[0]],
-                documents  =[summ],
-                metadatas  =[{
-                    **meta_flat,
-                    "id": tid,
-                    "parent_chunk_id": parent,
-                    "path": str(fp),
-                    "caption": caption,
-                    "summary": summ,
-                    "user_id" :user_id
-                }]
-            )
-        logger.info(f"Ingested {len(chunk_ids)} chunks, {len(ddoc.pictures)} images")
-
-# ═══════════════════════════════════════════════════════════════
-# RETRIEVAL
-# ═══════════════════════════════════════════════════════════════
 
+@timed("query.total")
 def smart_query(
         question: str,
         user_id: int,
         top_k: int = 3,
-        return_media: bool = False   # ← new optional kw-arg
-    ) -> str | tuple[str, list[tuple[str,str]]]: 
+        return_media: bool = False,  # ← new optional kw-arg
+        semantic_media: bool | None = None,
+        use_cache: bool = True,
+        speculative: bool | None = None
+    ) -> str | tuple[str, list[tuple[str,str]]]:
     """
     Perform a “smart” RAG:
-     1) Metadata‐aware + semantic search in `scientific_chunks` to get top_k text chunks.
+     1) Metadata‐aware + semantic search in `scientific_chunks` to get top_k text chunks,
+        fused with the user's BM25 hits by reciprocal rank (CFG.lexical_search).
      2) Fetch media linked by chunk_id (images + tables).
-     3) Semantic‐nearest search on `image_summaries` + `table_summaries` to add any “closest” media.
+     3) Semantic‐nearest search on `image_summaries` + `table_summaries` to add any “closest” media
+        (skipped when `semantic_media` / CFG.semantic_media_search is False – linked media are
+        exact page → chunk lookups, so step 2 alone is usually enough).
      4) Re‐rank all candidate media by cosine similarity of their summary embeddings (keep top1 image & top2 tables).
      5) Build a single Gemini prompt that contains:
          • The top text chunks (with chunk_id, title, authors, chunk preview).
@@ -223,133 +604,373 @@ def smart_query(
          • A “## Linked tables” section listing each table’s 200-word summary, prefaced with `<<tbl:FULL_UUID>>`.
      6) Send to Gemini. If Gemini needs to actually show a figure or table, it writes exactly `<<img:ID8>>` or `<<tbl:ID8>>`
         (8 hex chars) or the full UUID (36 chars). We catch either format, look up path, and render inline.
+    Steps run as a QueryPlan (query_plan.py): independent steps – the
+    semantic media searches, the question embedding, metadata extraction –
+    overlap, so latency follows the critical path instead of the sum.
+    With `speculative` (default QUERY_SPECULATIVE=1) every domain's text store is
+    searched while routing is still in flight; a question no domain claims is
+    answered from the merged cross-domain hits within `speculative_max_distance`,
+    and is NO_RESULTS when there are none.
+    Answers are cached per (user, normalized question) in `QUERY_CACHE` until the routed
+    domain's corpus version changes (any ingest for this user) or the TTL runs out.
+    Every step's wall time lands in metrics.STAGE_SECONDS as "query.<step>".
+    `smart_query_stream` is the incremental variant for the web UI.
     """
+    cache_key = QUERY_CACHE.key(user_id, question, top_k, semantic_media)
+    cached = QUERY_CACHE.get(cache_key) if use_cache else None
+    if cached is not None:
+        answer, show = cached
+        _display_answer(answer, show)
+        return (answer, list(show)) if return_media else answer
+
+    steps = _retrieve(question, user_id, top_k, semantic_media, speculative)
+    try:
+        while True:
+            next(steps)                              # status messages: only the stream shows them
+    except StopIteration as done:
+        r = done.value
+    if r is None:
+        logger.info(f"smart_query: nothing retrieved for {question!r}")
+        return (NO_RESULTS, []) if return_media else NO_RESULTS
 
-    query_domain = choose_domain(question)
-    if query_domain is None:
-        return "❌ No domain found for this query.", [] if return_media else "❌ No domain found for this query."
-    CFG = ALL_DOMAINS[query_domain]
-    collection_txt, collection_img, collection_tbl = get_chroma_collections(CFG)
-
-    # ── 1) Embed question + attempt metadata filters one by one ───────────
-    q_vec = _embed([question],model=CFG.embed_models["text"])[0]
-    meta_raw = CFG.prompt_builders["meta_extraction"](question)
-    
-    hits_txt = None
-
-    # ------------------------------------------------------------------
-# Build a user-scoped WHERE clause and query Chroma
-# ------------------------------------------------------------------
-    for i, flt in enumerate(_candidate_filters(meta_raw), start=1):
-        # 1️⃣ Always restrict to the current user
-
-        # --------------------------------------------------------------
-#`````` 1) metadata-aware search, always scoped by user_id
-#`````` --------------------------------------------------------------
-        user_clause = {"user_id": user_id}                # simple equality form
-        hits_txt    = None
+    with span("query.answer"):
+        answer = r.cfg.prompt_builders["query"](r.ctx_chunks, question)
 
+    # ── 6) Inline render (Jupyter/VS Code) if Gemini emitted any media tokens ───
+    show = _media_in_answer(answer, r.imgs, r.tbls)
 
-        for flt in _candidate_filters(meta_raw):
-            # ----- build legal WHERE clause ---------------------------
-            if flt is None:                           # last pass = “no meta filter”
-                where_clause = user_clause            # user only
-            else:
-                where_clause = {                      # user AND metadata
-                    "$and": [user_clause, flt]
-                }
-
-            hits_txt = collection_txt.query(
-                query_embeddings=[q_vec],
-                n_results=top_k,
-                where=where_clause,
-                include=["documents", "metadatas"]
-            )
-            # stop at first non-empty result set
-            if hits_txt and hits_txt["ids"] and hits_txt["ids"][0]:
-                break
-
-        # --------------------------------------------------------------
-        # 2) pure semantic fallback (but still user-scoped)
-        # --------------------------------------------------------------
-        if not hits_txt or not hits_txt["ids"] or not hits_txt["ids"][0]:
-            hits_txt = collection_txt.query(
-                query_embeddings=[q_vec],
-                n_results=top_k,
-                where=user_clause,            # <-- user only, no metadata filter
-                include=["documents", "metadatas"]
-            )
-    docs  = hits_txt["documents"][0]
-    metas = hits_txt["metadatas"][0]
-    chunk_ids = [m["chunk_id"] for m in metas]
-
-    # ── 2) Fetch media directly linked by chunk_id ───────────────────────
-    imgs_link, tbls_link = imgs_link, tbls_link = _fetch_media_linked(
-        chunk_ids,
-        collection_img,          #To be added
-        collection_tbl,
-        user_id=user_id
-        )
+    if use_cache and r.corpus_version is not None:     # merged answers span domains → not cached
+        QUERY_CACHE.put(cache_key, r.cfg.name, r.corpus_version, (answer, tuple(show)))
+    _display_answer(answer, show)
 
-    # ── 3) Semantic‐nearest search in media stores ──────────────────────
-    imgs_sem_res = collection_img.query(
-        [q_vec],
-        n_results=top_k,
-        where={"user_id": user_id},  
-        include=["metadatas"]
-    )
-    tbls_sem_res = collection_tbl.query(
-        [q_vec],
-        n_results=top_k,
-        where={"user_id": user_id},  
-        include=["metadatas"]
-    )
-    imgs_sem = _zip_ids_meta(imgs_sem_res)
-    tbls_sem = _zip_ids_meta(tbls_sem_res)
+    # Return the tuple: (answer_text, list_of_(kind,path))
+    if return_media:
+        return answer, show
+    else:
+        return answer
 
-    # Combine linked + nearest, keyed by full “id”
-    imgs_all = {m["id"]: m for m in (imgs_link + imgs_sem)}
-    tbls_all = {t["id"]: t for t in (tbls_link + tbls_sem)}
 
+def smart_query_stream(
+        question: str,
+        user_id: int,
+        top_k: int = 3,
+        semantic_media: bool | None = None,
+        use_cache: bool = True,
+        speculative: bool | None = None
+    ) -> Iterator[Tuple[str, object]]:
+    """
+    `smart_query` as a stream of (event, data) pairs, for Server-Sent Events:
+      ("status",  "Searching genomic papers…")   while retrieving
+      ("sources", [{"doc", "title", "pages", "headings", "chunk_id"}, …])
+      ("token",   "text piece")                   as Gemini generates
+      ("media",   ("img" | "tbl", path))          as soon as its token is complete
+      ("done",    {"answer", "media", "cached", "found"})
+    The first event goes out before any model call, and answer pieces are
+    forwarded as they arrive, so time-to-first-byte no longer waits for
+    the whole answer. Caching is shared with `smart_query`.
+    """
+    t0 = time.perf_counter()
+    cache_key = QUERY_CACHE.key(user_id, question, top_k, semantic_media)
+    cached = QUERY_CACHE.get(cache_key) if use_cache else None
+    if cached is not None:
+        answer, show = cached
+        yield "token", answer
+        for m in show:
+            yield "media", m
+        yield "done", {"answer": answer, "media": list(show), "cached": True, "found": True}
+        return
+
+    steps = _retrieve(question, user_id, top_k, semantic_media, speculative)
+    try:
+        while True:
+            yield "status", next(steps)
+    except StopIteration as done:
+        r = done.value
+    if r is None:                                    # no token events: the caller may fall back
+        yield "done", {"answer": NO_RESULTS, "media": [], "cached": False, "found": False}
+        return
+    yield "sources", _sources(r.metas)
+
+    pieces: List[str] = []
+    show: List[Tuple[str, str]] = []
+    with span("query.answer"):
+        for piece in r.cfg.prompt_builders["query"](r.ctx_chunks, question, stream=True):
+            if not pieces:
+                STAGE_SECONDS.observe(time.perf_counter() - t0, stage="query.first_token")
+            pieces.append(piece)
+            yield "token", piece
+            if ">" in piece:                         # a media token may have completed
+                for m in _media_in_answer("".join(pieces), r.imgs, r.tbls):
+                    if m not in show:
+                        show.append(m)
+                        yield "media", m
+    answer = "".join(pieces)
+
+    if use_cache and r.corpus_version is not None:
+        QUERY_CACHE.put(cache_key, r.cfg.name, r.corpus_version, (answer, tuple(show)))
+    yield "done", {"answer": answer, "media": show, "cached": False, "found": True}
+
+
+def _retrieve(question: str, user_id: int, top_k: int,
+              semantic_media: bool | None, speculative: bool | None):
+    """
+    Steps 0–4 of `smart_query`. A generator: yields short status lines
+    while it works and returns the `_Retrieved` material (None when no
+    domain claims the question and no speculative hit exists, or when
+    the user's store holds no passage at all).
+    """
+    yield "Routing your question…"
+    # ── 0) Route: the question vector doubles as the routing input
+    #        (CENTROIDS.model is normally the domains' text model, so
+    #        retrieval reuses it as is). Every step below is a node of a
+    #        QueryPlan; independent nodes run concurrently and the latency
+    #        follows the critical path
+    #          route_vec → domain → meta_raw → hits_txt → linked
+    #        while the semantic media searches overlap with it.
+    plan = QueryPlan()
+    plan.add("route_vec", lambda: _embed([question], model=CENTROIDS.model)[0])
+    plan.add("domain", lambda vec: choose_domain(question, vec=vec), "route_vec")
+    # with no usable centroids routing is an LLM call → extract metadata
+    # for every domain alongside it and keep the winner's
+    speculate = SPECULATE_META and not CENTROIDS.ready()
+    if speculate:
+        for key, cfg in ALL_DOMAINS.items():
+            plan.add(f"meta:{key}", functools.partial(cfg.prompt_builders["meta_extraction"], question))
+
+    # speculative retrieval: the unfiltered top-k text search of every
+    # domain starts as soon as the question vector exists, in parallel
+    # with routing; the winner's result stands in for its last filter
+    # candidate, the rest are discarded (or merged if routing fails)
+    if speculative is None:
+        speculative = SPECULATIVE_RETRIEVAL
+    if speculative:
+        for key, cfg in ALL_DOMAINS.items():
+            vec_node = "route_vec"
+            if cfg.embed_models["text"] != CENTROIDS.model:
+                vec_node = f"vec:{key}"
+                plan.add(vec_node, lambda m=cfg.embed_models["text"]: _embed([question], model=m)[0])
+            plan.add(f"spec:{key}", lambda vec, c=cfg: _spec_search(c, vec, user_id, top_k), vec_node)
+
+    query_domain = plan.result("domain")
+    corpus_version = None
+    if query_domain in ALL_DOMAINS:
+        CFG = ALL_DOMAINS[query_domain]
+        yield f"Searching {CFG.name} papers…"
+        corpus_version = QUERY_CACHE.version(user_id, CFG.name)   # read before retrieving
+        collection_txt, collection_img, collection_tbl = get_chroma_collections(CFG)
+        if semantic_media is None:
+            semantic_media = CFG.semantic_media_search
 
-    # ── 4) Re‐rank media by cosine similarity of their summary embeddings ──
-    top_img_ids = _top_media_by_similarity(q_vec, imgs_all, CFG.embed_models["image"],1)   # keep best 1 image
-    top_tbl_ids = _top_media_by_similarity(q_vec, tbls_all, CFG.embed_models["table"],2)   # keep best 2 tables
+        # ── 1) Embed question + metadata-aware search in the text store ──────
+        if CFG.embed_models["text"] == CENTROIDS.model:
+            plan.add("q_vec", lambda vec: vec, "route_vec")
+        else:
+            plan.add("q_vec", lambda: _embed([question], model=CFG.embed_models["text"])[0])
+        meta_node = f"meta:{query_domain}" if speculate else "meta_raw"
+        if not speculate:
+            plan.add("meta_raw", functools.partial(CFG.prompt_builders["meta_extraction"], question))
+        plan.add("hits_dense",
+                 lambda vec, meta, *spec: _search_text(collection_txt, vec, meta, user_id, top_k,
+                                                       fallback=spec[0] if spec else None),
+                 "q_vec", meta_node, *([f"spec:{query_domain}"] if speculative else []))
+        if CFG.lexical_search:                 # BM25 runs alongside, fused by reciprocal rank
+            plan.add("hits_lex", lambda: get_bm25(CFG, user_id).search(question, k=top_k * 2))
+            plan.add("hits_txt",
+                     lambda dense, lex: _fuse_hits(collection_txt, dense, lex, top_k),
+                     "hits_dense", "hits_lex")
+        else:
+            plan.add("hits_txt", lambda dense: dense, "hits_dense")
+
+        # ── 2) Fetch media directly linked by chunk_id ───────────────────────
+        plan.add("linked",
+                 lambda hits: _fetch_media_linked([m["chunk_id"] for m in hits["metadatas"][0]],
+                                                  collection_img, collection_tbl, user_id=user_id),
+                 "hits_txt")
+
+        # ── 3) Semantic‐nearest search in media stores ──────────────────────
+        if semantic_media:
+            plan.add("imgs_sem", lambda vec: _nearest_media(collection_img, vec, user_id, top_k), "q_vec")
+            plan.add("tbls_sem", lambda vec: _nearest_media(collection_tbl, vec, user_id, top_k), "q_vec")
+
+        hits_txt = plan.result("hits_txt")
+        docs  = hits_txt["documents"][0]
+        metas = hits_txt["metadatas"][0]
+        imgs_link, tbls_link = plan.result("linked")
+        q_vec = plan.result("q_vec")
+        imgs_sem = plan.result("imgs_sem") if semantic_media else []
+        tbls_sem = plan.result("tbls_sem") if semantic_media else []
+
+        # Combine linked + nearest, keyed by full “id”
+        imgs_all = {m["id"]: m for m in (imgs_link + imgs_sem)}
+        tbls_all = {t["id"]: t for t in (tbls_link + tbls_sem)}
+    else:
+        # routing failed → answer from the merged speculative hits
+        merged = _merge_speculative(plan, user_id, top_k) if speculative else None
+        if merged is None:
+            return None
+        yield "No single domain matched – combining results from all domains…"
+        CFG, docs, metas, imgs_all, tbls_all = merged
+        q_vec = plan.result("route_vec")
+    if not docs:                               # empty store: don't let Gemini answer from nothing
+        return None
+
+    # ── 4) Re‐rank media by cosine similarity of their stored summary embeddings ──
+    yield f"Found {len(docs)} passages – writing the answer…"
+    with span("query.rerank"):
+        top_img_ids = _top_media_by_similarity(q_vec, imgs_all, CFG.embed_models["image"],1)   # keep best 1 image
+        top_tbl_ids = _top_media_by_similarity(q_vec, tbls_all, CFG.embed_models["table"],2)   # keep best 2 tables
 
     imgs_final = {mid: imgs_all[mid] for mid in top_img_ids if mid in imgs_all}
     tbls_final = {tid: tbls_all[tid] for tid in top_tbl_ids if tid in tbls_all}
-    
+
     ctx_chunks = CFG.ctx_builder(docs, metas, imgs_final, tbls_final)
-    answer = CFG.prompt_builders["query"](ctx_chunks, question)
-    
+    return _Retrieved(CFG, docs, metas, imgs_final, tbls_final, ctx_chunks, corpus_version)
 
-  
 
-    # ── 6) Inline render (Jupyter/VS Code) if Gemini emitted any media tokens ───
-    #    We match either 8-hex chars OR full 36-char UUID (with hyphens).
+_MEDIA_TOKEN = re.compile(r"<<(img|tbl):([0-9A-Fa-f]{8}|[0-9A-Fa-f\-]{32,36})>>")
+
+
+def _media_in_answer(answer: str, imgs: Dict[str, dict], tbls: Dict[str, dict]) -> List[Tuple[str, str]]:
+    """
+    (kind, path) of every figure / table the answer asks to show.
+    We match either 8-hex chars OR full 36-char UUID (with hyphens).
+    """
     show: List[Tuple[str, str]] = []
-    pattern = r"<<(img|tbl):([0-9A-Fa-f]{8}|[0-9A-Fa-f\-]{32,36})>>"
-    for kind, token in re.findall(pattern, answer):
+    for kind, token in _MEDIA_TOKEN.findall(answer):
         kind = kind.lower()
         # If 8 hex chars, find the first media whose ID startswith token
         if len(token) == 8:
             if kind == "img":
-                match = next((m for m in imgs_final.values() if m["id"].startswith(token)), None)
+                match = next((m for m in imgs.values() if m["id"].startswith(token)), None)
             else:
-                match = next((t for t in tbls_final.values() if t["id"].startswith(token)), None)
+                match = next((t for t in tbls.values() if t["id"].startswith(token)), None)
         else:
             # 32–36 chars → treat as full UUID
-            match = (imgs_final.get(token) if kind == "img" else tbls_final.get(token))
+            match = (imgs.get(token) if kind == "img" else tbls.get(token))
 
         if match:
             path = match["path"]
-            if Path(path).exists():
-                if show and (kind, path) in show:
-                    pass
-                else:
-                    show.append((kind, path))
+            if Path(path).exists() and (kind, path) not in show:
+                show.append((kind, path))
+    return show
+
+
+def _sources(metas: List[dict]) -> List[dict]:
+    """The retrieved chunks as (Doc n) citations: title, page span, section."""
+    out = []
+    for i, m in enumerate(metas, 1):
+        ps, pe = m.get("page_start"), m.get("page_end")
+        pages = "" if ps is None else (str(ps) if ps == pe or pe is None else f"{ps}–{pe}")
+        out.append({"doc": i, "title": m.get("title", ""), "pages": pages, "headings": m.get("headings", ""), "chunk_id": m.get("chunk_id")})
+    return out
+
 
-    # Display answer + inline media in Jupyter / VS Code if available
+def _search_text(collection_txt, q_vec, meta_raw: dict, user_id: int, top_k: int,
+                 fallback: dict | None = None) -> dict:
+    """
+    Metadata-aware search, always scoped by user_id: try each single-field
+    filter from `_candidate_filters` in turn and stop at the first non-empty
+    result; the final candidate (None) is the pure semantic, user-only query,
+    answered by `fallback` when the caller already ran it.
+    """
+    user_clause = {"user_id": user_id}                # simple equality form
+    hits_txt = None
+    for flt in _candidate_filters(meta_raw):
+        if flt is None and fallback is not None:
+            return fallback
+        where_clause = user_clause if flt is None else {"$and": [user_clause, flt]}
+        hits_txt = collection_txt.query(
+            query_embeddings=[q_vec],
+            n_results=top_k,
+            where=where_clause,
+            include=["documents", "metadatas", "distances"]
+        )
+        if hits_txt and hits_txt["ids"] and hits_txt["ids"][0]:
+            break
+    return hits_txt
+
+
+def _fuse_hits(collection_txt, dense: dict, lex: List[Tuple[str, float]], top_k: int) -> dict:
+    """
+    Reciprocal-rank fusion of the dense hits with the BM25 hits, returned
+    in the same shape as a Chroma query result. Lexical-only hits are
+    fetched from `collection_txt` in one `get`.
+    """
+    dense_ids = dense["ids"][0] if dense and dense["ids"] else []
+    lex_ids   = [doc_id for doc_id, _ in lex]
+    if not lex_ids:
+        return dense
+    fused = rrf_fuse([dense_ids, lex_ids], k=RRF_K)[:top_k]
+
+    records = {i: (d, m) for i, d, m in zip(dense_ids, dense["documents"][0], dense["metadatas"][0])} \
+        if dense_ids else {}
+    extra = [i for i in fused if i not in records]
+    if extra:
+        got = collection_txt.get(ids=extra, include=["documents", "metadatas"])
+        records.update({i: (d, m) for i, d, m in zip(got["ids"], got["documents"], got["metadatas"])})
+    fused = [i for i in fused if i in records]     # index can trail a deleted record
+    return {
+        "ids": [fused],
+        "documents": [[records[i][0] for i in fused]],
+        "metadatas": [[records[i][1] for i in fused]],
+    }
+
+
+def _spec_search(cfg, q_vec, user_id: int, top_k: int) -> dict | None:
+    """Unfiltered top-k text search in one domain; failures only cost the speculation."""
+    try:
+        return _search_text(get_chroma_collections(cfg)[0], q_vec, {}, user_id, top_k)
+    except Exception as e:
+        logger.warning(f"Speculative search in {cfg.name} failed: {e}")
+        return None
+
+
+def _merge_speculative(plan: QueryPlan, user_id: int, top_k: int):
+    """
+    Cross-domain answer material for an unroutable question: the best
+    top_k speculative hits over all domains by distance (every domain
+    embeds with the same model by default, so distances compare), plus
+    the media linked to them. The domain of the best hit supplies the
+    prompt builders. Hits beyond their domain's `speculative_max_distance`
+    are dropped; returns None when no hit is left.
+    """
+    hits = []
+    for key, cfg in ALL_DOMAINS.items():
+        res = plan.result(f"spec:{key}")
+        if not res or not res["ids"] or not res["ids"][0]:
+            continue
+        limit = cfg.speculative_max_distance
+        hits += [(dist, key, doc, meta) for doc, meta, dist in
+                 zip(res["documents"][0], res["metadatas"][0], res["distances"][0])
+                 if limit is None or dist <= limit]
+    if not hits:
+        logger.info("No domain for query and no speculative hit close enough")
+        return None
+    hits = sorted(hits, key=lambda h: h[0])[:top_k]
+    imgs_all, tbls_all = {}, {}
+    for key in dict.fromkeys(h[1] for h in hits):
+        _, collection_img, collection_tbl = get_chroma_collections(ALL_DOMAINS[key])
+        imgs, tbls = _fetch_media_linked([h[3]["chunk_id"] for h in hits if h[1] == key],
+                                         collection_img, collection_tbl, user_id=user_id)
+        imgs_all.update({m["id"]: m for m in imgs})
+        tbls_all.update({t["id"]: t for t in tbls})
+    logger.info(f"No domain for query – answering from {len(hits)} cross-domain hits")
+    return (ALL_DOMAINS[hits[0][1]], [h[2] for h in hits], [h[3] for h in hits],
+            imgs_all, tbls_all)
+
+
+def _nearest_media(collection, q_vec, user_id: int, top_k: int) -> List[dict]:
+    """Semantic‐nearest figures / tables of this user, with their stored vectors."""
+    return _zip_ids_meta(collection.query(
+        [q_vec],
+        n_results=top_k,
+        where={"user_id": user_id},
+        include=["metadatas", "embeddings"]
+    ))
+
+
+def _display_answer(answer: str, show) -> None:
+    """Display answer + inline media in Jupyter / VS Code if available."""
     try:
         display(Markdown(answer))
         for kind, p in show:
@@ -364,11 +985,10 @@ def smart_query(
         for kind, p in show:
             print(f"[{kind.upper()}]: {p}")
 
-    # Return the tuple: (answer_text, list_of_(kind,path))
-    if return_media:
-        return answer, show
-    else:
-        answer
+
+def query_cache_stats() -> dict:
+    """Hit / miss / stale counters of the smart_query result cache."""
+    return QUERY_CACHE.stats()
 
 
         
\ No newline at end of file
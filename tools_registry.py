@@ -2,13 +2,12 @@
 # -------------------------------------------------------------
 from __future__ import annotations
 from pathlib import Path
-import google.generativeai as genai
 from langchain.tools import Tool
 from langchain_experimental.tools.python.tool import PythonREPLTool
 from langchain_community.utilities import SerpAPIWrapper
-from langchain_google_genai import ChatGoogleGenerativeAI
 from domain_routing import choose_domain
 from rag_scipdf_core import ingest_documents, smart_query
+from llm_providers import MODEL_GEN, get_chat_model
 from dotenv import load_dotenv
 import os
 
@@ -16,21 +15,12 @@ import os
 load_dotenv()
 
 # ─────────────────── API keys & model names ────────────────────
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")      # ← Set your own Gemini API key here
-MODEL_GEN      = "models/gemini-1.5-flash-latest"
-if not GEMINI_API_KEY:
-    raise RuntimeError("Set GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
 if not SERPAPI_API_KEY:
     raise RuntimeError("Set SERPAPI_API_KEY")
 
 
-_GEMINI_CHAT = ChatGoogleGenerativeAI(
-    model="models/gemini-1.5-flash-latest",
-    temperature=0,
-    google_api_key=os.getenv("GEMINI_API_KEY"), 
-)
+_GEMINI_CHAT = get_chat_model(MODEL_GEN, temperature=0)
 
 # 1) classify_document tool (delegates to choose_domain, which may read a PDF)
 def _classify(inp: str) -> str:
@@ -1,24 +1,26 @@
-from numpy import dot
+import numpy as np
 from numpy.linalg import norm
 import json
 import time
-from typing import Dict, List, Tuple 
+from typing import Dict, Iterator, List, Tuple 
 import re
 from pathlib import Path
-import google.generativeai as genai
 from dotenv import load_dotenv
 import os
+import atexit
+import threading
+from embed_cache import EmbeddingCache
+from embedding_backends import get_backend
+from llm_providers import MODEL_GEN, get_llm
+from metrics import Counter, gauge_fn, span
+from accounting import estimate_tokens, record
 
 
 load_dotenv()
 
-# ─────────────────── API keys & model names ────────────────────
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")      # ← Set your own Gemini API key here
-MODEL_GEN      = "models/gemini-1.5-flash-latest"
-if not GEMINI_API_KEY:
-    raise RuntimeError("Set GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
-_gem = genai.GenerativeModel(MODEL_GEN)
+# ─────────────────── model names ───────────────────────────────
+# API keys / provider selection live in llm_providers.py
+_gem = get_llm(MODEL_GEN)
 
 
 
@@ -30,7 +32,8 @@ def _gem_chat(prompt: str, retry: int = 3) -> str:
     """
     for i in range(retry):
         try:
-            return _gem.generate_content(prompt).text.strip()
+            with span("llm.generate"):
+                return _gem.generate(prompt).strip()
         except Exception:
             if i == retry - 1:
                 raise
@@ -39,19 +42,74 @@ def _gem_chat(prompt: str, retry: int = 3) -> str:
     return ""
 
 
+def _gem_chat_stream(prompt, retry: int = 3) -> Iterator[str]:
+    """
+    Streaming `_gem_chat`: yields text pieces as Gemini produces them.
+    Retries like `_gem_chat`, but only until the first piece went out.
+    """
+    for i in range(retry):
+        started = False
+        try:
+            with span("llm.generate"):
+                for piece in _gem.generate_stream(prompt):
+                    started = True
+                    yield piece
+            return
+        except Exception:
+            if started or i == retry - 1:
+                raise
+            time.sleep(1 + i)
+
+
+
+# ─────────────────── embedding cache ──────────────────────────
+# in-process LRU + on-disk SQLite shared by every worker process
+_EMBED_CACHE = EmbeddingCache(
+    Path(os.getenv("EMBED_CACHE_PATH", "embed_cache.sqlite3")),
+    mem_items=int(os.getenv("EMBED_CACHE_MEM_ITEMS", "50000")),
+    max_rows=int(os.getenv("EMBED_CACHE_MAX_ROWS", "1000000")),
+)
+EMBED_TEXTS = Counter("rag_embed_texts_total", "Texts passed to _embed, by where the vector came from",
+                      ("source",))
+
 
 # utils.py
-def _embed(texts: List[str], model: str | None = None) -> List[List[float]]:
+def _embed(texts: List[str], model: str | None = None,
+           task_type: str = "retrieval_document") -> List[List[float]]:
     """
     texts : list[str]
-    model : overrides the default embedding model when provided
+    model : DomainConfig.embed_models entry – picks the backend
+            (Gemini, "local:…" or "hash:…", see embedding_backends.py)
+
+    Vectors are looked up in `_EMBED_CACHE` first, keyed by
+    (backend, task_type, text hash); only the misses are sent to the
+    backend, de-duplicated, in one call (recorded in accounting.py).
     """
-    model_name = model    # ← falls back to global defaul
-    return genai.embed_content(
-        model=model_name,
-        content=texts,
-        task_type="retrieval_document"
-    )["embedding"]
+    backend = get_backend(model)
+    keys  = [_EMBED_CACHE.key(backend.name, task_type, t) for t in texts]
+    found = _EMBED_CACHE.get_many(keys)
+
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in found))
+    EMBED_TEXTS.inc(len(texts) - len(missing), source="cache")
+    if missing:
+        EMBED_TEXTS.inc(len(missing), source="backend")
+        t0 = time.perf_counter()
+        with span(f"embed.{task_type}"):
+            vecs = backend.embed(missing, task_type=task_type)
+        record("embed", 1, sum(estimate_tokens(t) for t in missing), 0,
+               sum(len(t.encode("utf-8")) for t in missing), time.perf_counter() - t0)
+        fresh = {_EMBED_CACHE.key(backend.name, task_type, t): v for t, v in zip(missing, vecs)}
+        _EMBED_CACHE.put_many(fresh)
+        found.update(fresh)
+    return [found[k] for k in keys]
+
+
+def embed_cache_stats() -> Dict[str, float]:
+    """Hit/miss/eviction counters of the embedding cache."""
+    return _EMBED_CACHE.stats()
+
+
+gauge_fn("rag_embed_cache", "Embedding cache counters", embed_cache_stats)
 
 
 
@@ -124,20 +182,30 @@ def _zip_ids_meta(res) -> List[Dict]:
     """
     Convert a Chroma `get()` or `query()` result into a list of dicts,
     each containing the metadata plus an “id” field. If no hits, return [].
+    When the result was fetched with include=["embeddings"], the stored
+    vector is attached under “_vec”.
     """
     if not res or not res.get("ids"):
         return []
 
     # Chroma’s “query” returns nested lists; “get” returns flat lists.
-    ids_raw   = res["ids"][0]    if isinstance(res["ids"][0], list) else res["ids"]
-    metas_raw = res["metadatas"][0] if isinstance(res["metadatas"][0], list) else res["metadatas"]
+    nested    = isinstance(res["ids"][0], list)
+    ids_raw   = res["ids"][0]    if nested else res["ids"]
+    metas_raw = res["metadatas"][0] if nested else res["metadatas"]
+    vecs_raw  = res.get("embeddings")
+    if vecs_raw is not None and nested:
+        vecs_raw = vecs_raw[0]
+    if vecs_raw is None:
+        vecs_raw = [None] * len(ids_raw)
 
     out: List[Dict] = []
-    for _id, meta in zip(ids_raw, metas_raw):
+    for _id, meta, vec in zip(ids_raw, metas_raw, vecs_raw):
         if meta is None:
             continue
         d = dict(meta)
         d["id"] = _id
+        if vec is not None:
+            d["_vec"] = vec
         out.append(d)
     return out
 
@@ -156,8 +224,8 @@ def _fetch_media_linked(chunk_ids: List[str], collection_img, collection_tbl,use
             {"parent_chunk_id": {"$in": chunk_ids}}
         ]
     }
-    imgs = _zip_ids_meta(collection_img.get(where=where_clause, include=["metadatas"]))
-    tbls = _zip_ids_meta(collection_tbl.get(where=where_clause, include=["metadatas"]))
+    imgs = _zip_ids_meta(collection_img.get(where=where_clause, include=["metadatas", "embeddings"]))
+    tbls = _zip_ids_meta(collection_tbl.get(where=where_clause, include=["metadatas", "embeddings"]))
     return imgs, tbls
 
 def _candidate_filters(meta: Dict) -> List[Dict]:
@@ -185,33 +253,113 @@ def _top_media_by_similarity(question_vec: List[float],
                              top_n: int = 2) -> List[str]:
     """
     Given a dict of media (key=media_id, value=metadata including “summary”),
-    compute cosine similarity between question_vec and each media["summary"] embedding,
-    return the top_n media_ids, sorted by descending similarity.
+    compute cosine similarity between question_vec and each media item's
+    stored embedding (“_vec”, pulled from Chroma at fetch time), return the
+    top_n media_ids, sorted by descending similarity.
+    Items fetched without a stored vector fall back to embedding their
+    summary (served from the embedding cache after the first time).
+    All candidates are scored in one matrix-vector product.
     """
     if not media:
         return []
 
-    ids_list    = list(media.keys())
-    summaries   = [media[mid]["summary"] for mid in ids_list]
-    sum_vecs    = _embed(summaries, model=model)   # embeddings for all summaries
-    q = question_vec
-    sims = [ dot(q, v) / (norm(q)*norm(v) + 1e-9) for v in sum_vecs ]
+    ids_list = list(media.keys())
+    missing  = [mid for mid in ids_list if media[mid].get("_vec") is None]
+    fallback = dict(zip(missing, _embed([media[mid]["summary"] for mid in missing], model=model))) if missing else {}
 
-    id_sims = list(zip(ids_list, sims))
-    id_sims.sort(key=lambda t: t[1], reverse=True)
-    return [mid for mid, _ in id_sims[:top_n]]
+    mat  = np.asarray([media[mid]["_vec"] if mid not in fallback else fallback[mid]
+                       for mid in ids_list], dtype=np.float32)
+    q    = np.asarray(question_vec, dtype=np.float32)
+    sims = (mat @ q) / (norm(mat, axis=1) * norm(q) + 1e-9)
+
+    order = np.argsort(-sims, kind="stable")[:top_n]
+    return [ids_list[i] for i in order]
 
 
 def ensure_dirs(dirs: Dict[str, Path]) -> None:
     for p in dirs.values(): p.mkdir(parents=True, exist_ok=True)
 
-def get_chroma_collections(cfg) -> tuple:
+# ─────────────────── Chroma client registry ───────────────────
+# One PersistentClient per chroma_root per process; collection handles
+# are cached so smart_query / ingest never reopen SQLite + HNSW segments.
+_CHROMA_LOCK        = threading.Lock()
+_CHROMA_CLIENTS: Dict[str, object] = {}
+_CHROMA_COLLECTIONS: Dict[Tuple[str, str, str, str], tuple] = {}
+
+
+def _chroma_client(root: Path):
+    """Return the process-wide client for `root` (caller holds _CHROMA_LOCK)."""
     import chromadb
-    client = chromadb.PersistentClient(path=str(cfg.chroma_root))
-    return (
-        client.get_or_create_collection(cfg.collection_names["text"]),
-        client.get_or_create_collection(cfg.collection_names["image"]),
-        client.get_or_create_collection(cfg.collection_names["table"]),
+    key = str(Path(root).resolve())
+    client = _CHROMA_CLIENTS.get(key)
+    if client is None:
+        client = chromadb.PersistentClient(path=key)
+        _CHROMA_CLIENTS[key] = client
+    return client
+
+
+def get_chroma_collections(cfg) -> tuple:
+    """(text, image, table) collection handles for `cfg`, opened once per process."""
+    key = (
+        str(Path(cfg.chroma_root).resolve()),
+        cfg.collection_names["text"],
+        cfg.collection_names["image"],
+        cfg.collection_names["table"],
     )
+    cols = _CHROMA_COLLECTIONS.get(key)
+    if cols is not None:
+        return cols
+    with _CHROMA_LOCK:
+        cols = _CHROMA_COLLECTIONS.get(key)
+        if cols is None:
+            client = _chroma_client(cfg.chroma_root)
+            cols = tuple(
+                _check_embed_dim(client.get_or_create_collection(cfg.collection_names[kind]),
+                                 cfg.embed_models[kind])
+                for kind in ("text", "image", "table")
+            )
+            _CHROMA_COLLECTIONS[key] = cols
+    return cols
+
+
+def _check_embed_dim(collection, model: str):
+    """
+    Stamp a collection with its embedding backend + dimension on first
+    open; refuse to mix vectors from a backend of another dimension later.
+    """
+    backend = get_backend(model)
+    meta = dict(collection.metadata or {})
+    if "embed_dim" not in meta:
+        meta.update(embed_backend=backend.name, embed_dim=backend.dim)
+        collection.modify(metadata=meta)
+    elif meta["embed_dim"] != backend.dim:
+        raise ValueError(
+            f"Collection {collection.name!r} holds {meta['embed_dim']}-d vectors "
+            f"({meta.get('embed_backend')}), but {backend.name} produces {backend.dim}-d; "
+            f"use a new chroma_root / collection for this backend"
+        )
+    return collection
+
+
+def close_chroma_clients() -> None:
+    """Drop every cached handle and stop the underlying Chroma systems."""
+    with _CHROMA_LOCK:
+        clients = list(_CHROMA_CLIENTS.values())
+        _CHROMA_CLIENTS.clear()
+        _CHROMA_COLLECTIONS.clear()
+    for client in clients:
+        try:
+            system = getattr(client, "_system", None)
+            if system is not None:
+                system.stop()
+        except Exception:
+            pass
+    if clients:
+        try:
+            from chromadb.api.client import SharedSystemClient
+            SharedSystemClient.clear_system_cache()
+        except Exception:
+            pass
 
 
+atexit.register(close_chroma_clients)